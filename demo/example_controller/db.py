@@ -25,6 +25,21 @@ def enqueue_message(con, type: str, payload: dict) -> None:
     except Exception:
         exit(0)
 
+def read_uplink_state(con, max_age_ms=60_000):
+    """Return the uplink state reported by the gateway as a dict, or None if it is unknown or outdated."""
+    try:
+        row = con.execute("""
+            SELECT updated_at_ms, connected, state, queue_depth, queue_latency_ms, fill_rate, drain_rate,
+                recommended_interval_ms
+            FROM uplink_state WHERE id = 1;
+        """).fetchone()
+    except sqlite3.OperationalError:
+        return None  # the gateway did not create the table yet
+    if row is None or row[0] < int(time.time_ns() / 1_000_000) - max_age_ms:
+        return None  # the gateway is not running
+    return dict(zip(["updated_at_ms", "connected", "state", "queue_depth", "queue_latency_ms",
+                     "fill_rate", "drain_rate", "recommended_interval_ms"], row))
+
 def setup_and_connect_db(db_path):
     con = sqlite3.connect(db_path,
                                isolation_level=None,
@@ -2,7 +2,7 @@ import os
 import time
 
 import env_vars
-from db import setup_and_connect_db, write_health_check_message, enqueue_message
+from db import setup_and_connect_db, write_health_check_message, enqueue_message, read_uplink_state
 from sensor.basic_sensor import BasicSensor
 
 TEG_DATA_PATH = env_vars.TEG_DATA_PATH
@@ -14,11 +14,20 @@ print(f"Connecting to communication db at '{comm_db_path}'...")
 db_connection = setup_and_connect_db(comm_db_path)
 
 sensor = BasicSensor(simulate=True)
+SAMPLE_INTERVAL_S = 1
+MAX_SAMPLE_INTERVAL_S = 60  # keep writing health checks
 
 print("Entering main loop...")
 # main loop
 while True:
-    time.sleep(1)
+    # slow down while the gateway cannot upload the messages fast enough
+    uplink_state = read_uplink_state(db_connection)
+    sample_interval_s = SAMPLE_INTERVAL_S
+    if uplink_state is not None and uplink_state["recommended_interval_ms"] > 0:
+        sample_interval_s = min(max(SAMPLE_INTERVAL_S, uplink_state["recommended_interval_ms"] / 1000),
+                                MAX_SAMPLE_INTERVAL_S)
+        print(f"Gateway uplink is {uplink_state['state']}, sending data every {sample_interval_s} s")
+    time.sleep(sample_interval_s)
 
     print("Sending heartbeat and sensor data to ThingsBoard")
 
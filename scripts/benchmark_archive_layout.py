@@ -0,0 +1,114 @@
+"""Compare the archive layouts.
+
+Fills a temporary archive in each layout with synthetic controller messages and
+measures the write throughput, the disk usage, a full scan and a single-key range
+query (see ``modules.archive`` and ``modules.archive_query``). In the compressed
+layout, the time to pack the messages into blocks is measured separately.
+
+Usage:
+  python scripts/benchmark_archive_layout.py [--messages 200000] [--keys 20] [--batch-size 100]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+os.environ["TEG_DATA_PATH"] = tempfile.mkdtemp(prefix="teg_archive_benchmark_")
+os.environ.setdefault("TEG_CONTROLLER_GIT_PATH", os.environ["TEG_DATA_PATH"])
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import modules.archive  # noqa: E402
+from modules.archive_query import query_archive  # noqa: E402
+from modules.retention import RetentionEngine  # noqa: E402
+
+START_TIMESTAMP_MS = 1_767_225_600_000  # 2026-01-01, one shard per day
+MESSAGE_INTERVAL_MS = 1_000
+
+
+def generate_messages(message_count: int, key_count: int) -> list[tuple[int, str]]:
+    """Return ``(timestamp_ms, values_json)`` rows resembling controller telemetry.
+
+    The sensor values are slowly changing random walks with a resolution of 0.01.
+    """
+    random.seed(42)
+    messages = []
+    sensor_values = [round(random.gauss(20, 5), 2) for _ in range(key_count)]
+    for index in range(message_count):
+        for key in range(key_count):
+            if random.random() < 0.2:
+                sensor_values[key] = round(sensor_values[key] + random.choice([-0.01, 0.01]), 2)
+        values: dict[str, object] = {f"sensor_{key}": sensor_values[key] for key in range(key_count)}
+        values["status"] = random.choice(["ok", "ok", "ok", "degraded"])
+        values["counter"] = index
+        messages.append((START_TIMESTAMP_MS + index * MESSAGE_INTERVAL_MS, json.dumps(values)))
+    return messages
+
+
+def benchmark_layout(layout: str, messages: list[tuple[int, str]], batch_size: int) -> dict[str, float]:
+    """Write ``messages`` to a fresh archive in ``layout`` and time the reads."""
+    modules.archive.singleton_instance = None
+    archive = modules.archive.GatewayArchive()
+    archive.layout = layout
+    archive.shards_path = tempfile.mkdtemp(prefix=f"{layout}_", dir=os.environ["TEG_DATA_PATH"])
+    archive.scan_shards()
+    end_timestamp_ms = messages[-1][0] + 1
+
+    started = perf_counter()
+    for index in range(0, len(messages), batch_size):
+        archive.insert_many(messages[index:index + batch_size])
+    insert_s = perf_counter() - started
+
+    started = perf_counter()
+    if layout == "compressed":
+        RetentionEngine(archive, []).seal_archive_blocks(end_timestamp_ms + modules.archive.ARCHIVE_BLOCK_PERIOD_MS)
+    pack_s = perf_counter() - started
+    for shard in archive.get_shards():
+        archive.compact(shard)
+
+    started = perf_counter()
+    scanned_count = sum(1 for _ in archive.iter_messages(START_TIMESTAMP_MS - 1, end_timestamp_ms, page_size=1000))
+    scan_s = perf_counter() - started
+    assert scanned_count == len(messages)
+
+    started = perf_counter()
+    query_archive(archive, START_TIMESTAMP_MS - 1, end_timestamp_ms, 3_600_000, ["sensor_0"])
+    key_query_s = perf_counter() - started
+
+    started = perf_counter()
+    query_archive(archive, START_TIMESTAMP_MS - 1, end_timestamp_ms, 3_600_000)
+    full_query_s = perf_counter() - started
+
+    size_bytes = archive.size_bytes()
+    archive.close()
+    return {
+        "messages/s written": len(messages) / insert_s,
+        "packing (s)": pack_s,
+        "size (MiB)": size_bytes / 1024 / 1024,
+        "full scan (s)": scan_s,
+        "single-key query (s)": key_query_s,
+        "all-keys query (s)": full_query_s,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="number of archived messages")
+    parser.add_argument("--keys", type=int, default=20, help="number of numeric keys per message")
+    parser.add_argument("--batch-size", type=int, default=100, help="messages written per transaction")
+    args = parser.parse_args()
+
+    messages = generate_messages(args.messages, args.keys)
+    results = {layout: benchmark_layout(layout, messages, args.batch_size) for layout in modules.archive.ARCHIVE_LAYOUTS}
+
+    print(f"{args.messages} messages, {args.keys + 2} keys per message, data in {os.environ['TEG_DATA_PATH']}")
+    print(f"{'':<24}" + "".join(f"{layout:>14}" for layout in results))
+    for metric in results["blob"]:
+        print(f"{metric:<24}" + "".join(f"{result[metric]:>14.2f}" for result in results.values()))
+
+
+if __name__ == "__main__":
+    main()
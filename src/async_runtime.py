@@ -0,0 +1,219 @@
+"""Opt-in asyncio runtime of the gateway main loop.
+
+The default main loop runs its steps one after the other: while it builds a
+controller image, restarts the controller container or waits for a publish, it
+neither forwards telemetry nor answers RPC requests.
+
+With ``TEG_GATEWAY_RUNTIME=asyncio``, :func:`run_async_main_loop` runs the same
+steps as concurrent tasks on one event loop instead:
+
+- ``inbound``: Takes inbound MQTT messages. RPC requests are dispatched on the
+  default executor; attribute updates (OTA updates, remote file management) are
+  handled one after the other on the controller executor, while RPC requests
+  keep being dispatched.
+- ``forwarding``: Transfers controller messages and serves the uplink lanes (see
+  :mod:`modules.uplink_scheduler`) on the database executor.
+- ``supervision``: Runs the controller restart watchdog on the controller
+  executor, checks the MQTT connection and reports the uplink state.
+- ``file_check``: Checks the remote-managed files for changes every 30 seconds.
+
+Blocking calls (SQLite, MQTT publishes waiting for their acknowledgement, Docker
+and git) run on executors, each of which has a single thread, so the calls of one
+kind stay serialized as in the default main loop:
+
+- The database executor runs all queue and archive operations of the main loop.
+- The controller executor runs all Docker and git operations.
+
+The tasks run in an :class:`asyncio.TaskGroup`: if one of them fails, the others
+are cancelled and the error is fatal, like an error in the default main loop.
+
+Configuration
+-------------
+- ``TEG_GATEWAY_RUNTIME``: ``threads`` (default) for the default main loop, or
+  ``asyncio``.
+
+Notes
+-----
+- The MQTT network I/O still runs on the thread of the Paho client; inbound
+  messages and acknowledgements wake up the tasks (see :mod:`utils.wakeup`).
+- Calls running on an executor are not interrupted when their task is cancelled.
+  On shutdown, :func:`stop_async_main_loop` cancels the tasks and waits for the
+  database operation still running, so the databases can be flushed and closed
+  afterwards.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Callable, Optional, TypeVar
+
+from modules.inbound_queue import ATTRIBUTES_TOPIC
+from modules.logging import info
+from utils.wakeup import register_async_wakeup, wait_for_async_wakeup
+
+GATEWAY_RUNTIME_ASYNCIO: bool = (os.environ.get("TEG_GATEWAY_RUNTIME") or "threads") == "asyncio"
+# Interval between two checks of the MQTT connection
+CONNECTION_CHECK_INTERVAL_S: float = 1.0
+# Interval between two checks for file changes on disk
+FILE_CHECK_INTERVAL_S: float = 30.0
+# Time the gateway keeps running after the MQTT connection was lost
+DISCONNECTED_EXIT_DELAY_S: float = 30.0
+
+T = TypeVar("T")
+
+# event loop, tasks and database executor of the running main loop, used by the shutdown handler
+running_loop: Optional[asyncio.AbstractEventLoop] = None
+running_tasks: list[asyncio.Task] = []
+running_db_executor: Optional[ThreadPoolExecutor] = None
+db_executor_threads: list[threading.Thread] = []
+
+
+@dataclass
+class MainLoopSteps:
+    """Steps of the gateway main loop, shared by both runtimes (see ``main.py``).
+
+    Attributes
+    ----------
+    get_message:
+      Takes the next inbound MQTT message, ``None`` if there is none.
+    process_message:
+      Handles an inbound MQTT message.
+    restart_controller_if_needed:
+      Controller restart watchdog, returns whether it acted.
+    ms_until_restart_check:
+      Time until the watchdog checks the controller again.
+    is_connected:
+      Whether the MQTT client is connected and its thread alive.
+    report_disconnected:
+      Reports the lost connection (uplink state and log).
+    update_uplink_state:
+      Writes the uplink state for the controller if it is due.
+    ms_until_uplink_state_update:
+      Time until the uplink state is due.
+    forward_batch:
+      Transfers and publishes the next batch, returns the number of processed messages.
+    run_maintenance:
+      Writes buffered archive rows and truncates consumed controller messages.
+    ms_until_next_deadline:
+      Time until the next timer deadline of the forwarding.
+    check_file_changes:
+      Requests the file hashes if a remote-managed file changed on disk.
+    stop_requested:
+      Whether the gateway is shutting down.
+    """
+    get_message: Callable[[], Optional[dict[str, Any]]]
+    process_message: Callable[[dict[str, Any]], None]
+    restart_controller_if_needed: Callable[[], bool]
+    ms_until_restart_check: Callable[[], float]
+    is_connected: Callable[[], bool]
+    report_disconnected: Callable[[], None]
+    update_uplink_state: Callable[[], None]
+    ms_until_uplink_state_update: Callable[[], float]
+    forward_batch: Callable[[], int]
+    run_maintenance: Callable[[], None]
+    ms_until_next_deadline: Callable[[], float]
+    check_file_changes: Callable[[], None]
+    stop_requested: Callable[[], bool]
+
+
+async def run_in_executor(executor: Optional[ThreadPoolExecutor], function: Callable[..., T], *args: Any) -> T:
+    """Run a blocking function on an executor (``None``: the default executor)."""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def run_async_main_loop(steps: MainLoopSteps, max_idle_wait_ms: float) -> None:
+    """Run the main loop steps as concurrent tasks until the gateway shuts down or a task fails.
+
+    Args:
+      steps: Steps of the main loop.
+      max_idle_wait_ms: Maximum time a task waits for a wakeup.
+    """
+    global running_loop, running_db_executor
+    info("[RUNTIME] Running the main loop on asyncio")
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="teg-db",
+                                     initializer=lambda: db_executor_threads.append(threading.current_thread()))
+    running_loop = asyncio.get_running_loop()
+    running_db_executor = db_executor
+    controller_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="teg-controller")
+
+    async def run_inbound(task_group: asyncio.TaskGroup) -> None:
+        wakeup = register_async_wakeup()
+        attribute_update: Optional[asyncio.Task] = None
+        while not steps.stop_requested():
+            msg = steps.get_message()
+            if msg is None:
+                await wait_for_async_wakeup(wakeup, max_idle_wait_ms / 1000)
+                continue
+            if str(msg.get("topic") or "").startswith(ATTRIBUTES_TOPIC):
+                # one attribute update at a time, later ones stay queued and can be coalesced
+                if attribute_update is not None:
+                    await attribute_update
+                attribute_update = task_group.create_task(
+                    run_in_executor(controller_executor, steps.process_message, msg))
+            else:
+                # RPC handlers dispatch long-running work to their own workers
+                await run_in_executor(None, steps.process_message, msg)
+
+    async def run_forwarding() -> None:
+        wakeup = register_async_wakeup()
+        while not steps.stop_requested():
+            if await run_in_executor(db_executor, steps.forward_batch) > 0:
+                continue
+            await run_in_executor(db_executor, steps.run_maintenance)
+            await wait_for_async_wakeup(wakeup, min(steps.ms_until_next_deadline(), max_idle_wait_ms) / 1000)
+
+    async def run_supervision() -> None:
+        while not steps.stop_requested():
+            await run_in_executor(controller_executor, steps.restart_controller_if_needed)
+            if not steps.is_connected():
+                await run_in_executor(db_executor, steps.report_disconnected)
+                await asyncio.sleep(DISCONNECTED_EXIT_DELAY_S)
+                raise ConnectionError("MQTT client disconnected")
+            await run_in_executor(db_executor, steps.update_uplink_state)
+            await asyncio.sleep(min(CONNECTION_CHECK_INTERVAL_S * 1000, steps.ms_until_restart_check() + 1,
+                                    steps.ms_until_uplink_state_update()) / 1000)
+
+    async def run_file_check() -> None:
+        while not steps.stop_requested():
+            await asyncio.sleep(FILE_CHECK_INTERVAL_S)
+            await run_in_executor(None, steps.check_file_changes)
+
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            running_tasks.extend([
+                task_group.create_task(run_inbound(task_group), name="inbound"),
+                task_group.create_task(run_forwarding(), name="forwarding"),
+                task_group.create_task(run_supervision(), name="supervision"),
+                task_group.create_task(run_file_check(), name="file_check"),
+            ])
+    finally:
+        db_executor.shutdown(wait=False)
+        controller_executor.shutdown(wait=False)
+
+
+def stop_async_main_loop(timeout_s: float) -> bool:
+    """Stop the main loop tasks and wait until the database executor has finished its running operation.
+
+    Called by the shutdown handler. The handler runs on the thread of the event
+    loop, so no further operations are submitted while it waits; queued ones are
+    cancelled.
+
+    Args:
+      timeout_s: Maximum time to wait for the running database operation.
+
+    Returns:
+      ``False`` if a database operation was still running after the timeout,
+      otherwise ``True`` (also if the asyncio runtime is not in use).
+    """
+    if running_loop is None or running_db_executor is None:
+        return True
+    for task in running_tasks:
+        running_loop.call_soon_threadsafe(task.cancel)
+    running_db_executor.shutdown(wait=False, cancel_futures=True)
+    deadline = monotonic() + timeout_s
+    for thread in db_executor_threads:
+        thread.join(max(0.0, deadline - monotonic()))
+    return not any(thread.is_alive() for thread in db_executor_threads)
@@ -20,8 +20,39 @@ Index
 -----
 An index on ``timestamp_ms`` is created to accelerate time-range queries.
 
+Normalized layout
+-----------------
+With ``TEG_ARCHIVE_LAYOUT=normalized`` (see :mod:`modules.archive`), the values
+of a message are not stored in ``message`` (which is ``NULL`` then) but one row
+per key in ``controller_archive_values``:
+
+  - ``message_id`` (INTEGER): ``id`` of the message in ``controller_archive``.
+  - ``key_id`` (INTEGER): ``id`` of the key in ``archive_keys``.
+  - ``timestamp_ms`` (INTEGER): Copy of the message timestamp.
+  - ``int_value`` (INTEGER) / ``real_value`` (REAL): Numeric values.
+  - ``json_value`` (TEXT): All other values, serialized as JSON.
+
+``archive_keys`` maps each key name to a small integer id. The index on
+``(key_id, timestamp_ms)`` lets a single-key range scan read only the rows of
+that key. A partial index covers the messages still stored as JSON, and a
+trigger deletes the values of a message together with the message.
+
+Compressed layout
+-----------------
+With ``TEG_ARCHIVE_LAYOUT=compressed``, the messages of closed time windows are
+moved from ``controller_archive`` into compressed blocks (see
+:mod:`modules.archive_blocks`):
+
+  - ``archive_blocks``: One row per window with its ``start_timestamp_ms``,
+    ``end_timestamp_ms`` (exclusive), ``message_count`` and the encoded message
+    ``timestamps`` (BLOB).
+  - ``archive_block_series``: One row per window and key (see ``archive_keys``)
+    with the series ``encoding``, an optional ``presence`` bitmap and the
+    encoded values (``data``, BLOB).
+
 Notes
 -----
+- The table exists once per archive shard file (see :mod:`modules.archive`).
 - The SQL strings are provided as constants to be executed by the gateway's
   SQLite initialization/migration logic.
 - The statements are idempotent via ``IF NOT EXISTS``.
@@ -39,4 +70,66 @@ CREATE TABLE IF NOT EXISTS controller_archive (
  # SQL statement to create an index for efficient time-range lookups.
 CREATE_CONTROLLER_ARCHIVE_INDEX_QUERY: str = """
 CREATE INDEX IF NOT EXISTS controller_archive_ts_index on controller_archive (timestamp_ms);
-"""
\ No newline at end of file
+"""
+
+# SQL statement to create the key dictionary of the normalized layout.
+CREATE_ARCHIVE_KEYS_TABLE_QUERY: str = """
+CREATE TABLE IF NOT EXISTS archive_keys (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE
+);
+"""
+
+# SQL statement to create the value table of the normalized layout.
+CREATE_CONTROLLER_ARCHIVE_VALUES_TABLE_QUERY: str = """
+CREATE TABLE IF NOT EXISTS controller_archive_values (
+    message_id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    timestamp_ms INTEGER NOT NULL,
+    int_value INTEGER,
+    real_value REAL,
+    json_value TEXT,
+    PRIMARY KEY (message_id, key_id)
+) WITHOUT ROWID;
+"""
+
+# SQL statement to create an index for single-key time-range lookups.
+CREATE_CONTROLLER_ARCHIVE_VALUES_INDEX_QUERY: str = """
+CREATE INDEX IF NOT EXISTS controller_archive_values_key_ts_index ON controller_archive_values (key_id, timestamp_ms);
+"""
+
+# SQL statement to create an index over the messages still stored as JSON.
+CREATE_CONTROLLER_ARCHIVE_JSON_INDEX_QUERY: str = """
+CREATE INDEX IF NOT EXISTS controller_archive_json_ts_index ON controller_archive (timestamp_ms) WHERE message IS NOT NULL;
+"""
+
+# SQL statement to delete the values of deleted messages.
+CREATE_CONTROLLER_ARCHIVE_VALUES_DELETE_TRIGGER_QUERY: str = """
+CREATE TRIGGER IF NOT EXISTS controller_archive_values_delete AFTER DELETE ON controller_archive
+WHEN OLD.message IS NULL
+BEGIN
+    DELETE FROM controller_archive_values WHERE message_id = OLD.id;
+END;
+"""
+
+# SQL statement to create the block table of the compressed layout.
+CREATE_ARCHIVE_BLOCKS_TABLE_QUERY: str = """
+CREATE TABLE IF NOT EXISTS archive_blocks (
+    start_timestamp_ms INTEGER PRIMARY KEY,
+    end_timestamp_ms INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    timestamps BLOB NOT NULL
+);
+"""
+
+# SQL statement to create the series table of the compressed layout.
+CREATE_ARCHIVE_BLOCK_SERIES_TABLE_QUERY: str = """
+CREATE TABLE IF NOT EXISTS archive_block_series (
+    block_start_timestamp_ms INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    encoding INTEGER NOT NULL,
+    presence BLOB,
+    data BLOB NOT NULL,
+    PRIMARY KEY (block_start_timestamp_ms, key_id)
+) WITHOUT ROWID;
+"""
@@ -26,10 +26,13 @@ Notes
 from modules import sqlite
 
 # SQL statement to create the controller messages table.
-CREATE_CONTROLLER_MESSAGES_TABLE_QUERY: str = """
+CREATE_CONTROLLER_MESSAGES_TABLE_QUERY: str = f"""
     CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         type text,
         message text
     );
-"""
\ No newline at end of file
+"""
+
+# Payload columns of the table, as used by :class:`modules.sqlite.DurableQueue`.
+CONTROLLER_MESSAGES_COLUMNS: list[str] = ["type", "message"]
@@ -0,0 +1,38 @@
+"""Database schema: gateway log buffer table.
+
+This module defines the SQL statement used to create the SQLite table that
+buffers gateway log messages which could not be published to ThingsBoard, for
+example due to connectivity issues. Buffered messages are published by the main
+loop once the connection is restored.
+
+Schema
+------
+Table name:
+  Value of ``sqlite.SqliteTables.LOG_BUFFER``
+
+Columns:
+  - ``id`` (INTEGER PRIMARY KEY AUTOINCREMENT): Surrogate key.
+  - ``log_level`` (TEXT): Log severity.
+  - ``message`` (TEXT): Log message text.
+  - ``timestamp_ms`` (INTEGER): Unix timestamp in milliseconds.
+
+Notes
+-----
+- The table lives in ``GATEWAY_LOGS_BUFFER_DB_PATH``.
+- Table creation is idempotent via ``IF NOT EXISTS``.
+"""
+
+from modules import sqlite
+
+# SQL statement to create the log buffer table.
+CREATE_LOG_BUFFER_TABLE_QUERY: str = f"""
+    CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.LOG_BUFFER.value} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        log_level text,
+        message text,
+        timestamp_ms INTEGER
+    );
+"""
+
+# Payload columns of the table, as used by :class:`modules.sqlite.DurableQueue`.
+LOG_BUFFER_COLUMNS: list[str] = ["log_level", "message", "timestamp_ms"]
@@ -0,0 +1,33 @@
+"""Database schema: payload compression dictionaries table.
+
+This module defines the SQL statement used to create the SQLite table that stores
+the dictionaries used to compress queued MQTT payloads (see
+:mod:`modules.compression`).
+
+Schema
+------
+Table name:
+  Value of ``sqlite.SqliteTables.PAYLOAD_DICTIONARIES``
+
+Columns:
+  - ``id`` (INTEGER PRIMARY KEY AUTOINCREMENT): Dictionary id, referenced by
+    ``pending_mqtt_messages.dictionary_id``.
+  - ``created_at_ms`` (INTEGER): Unix timestamp in milliseconds.
+  - ``dictionary`` (BLOB): Preset dictionary passed to zlib.
+
+Notes
+-----
+- The table lives in the communication queue database, next to the pending queue.
+- Table creation is idempotent via ``IF NOT EXISTS``.
+"""
+
+from modules import sqlite
+
+# SQL statement to create the payload dictionaries table.
+CREATE_PAYLOAD_DICTIONARIES_TABLE_QUERY: str = f"""
+    CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.PAYLOAD_DICTIONARIES.value} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at_ms INTEGER NOT NULL,
+        dictionary BLOB NOT NULL
+    );
+"""
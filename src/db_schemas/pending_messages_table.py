@@ -15,12 +15,18 @@ Table name:
 Columns:
   - ``id`` (INTEGER PRIMARY KEY AUTOINCREMENT): Surrogate key.
   - ``type`` (TEXT): Message type or category.
-  - ``message`` (TEXT): Serialized MQTT message payload.
+  - ``message`` (TEXT or BLOB): Serialized MQTT message payload, compressed
+    depending on ``payload_format``.
+  - ``payload_format`` (INTEGER): Storage format of ``message``, see
+    :mod:`modules.compression` (``0``: plain text).
+  - ``dictionary_id`` (INTEGER): Compression dictionary used for ``message``, if any.
 
 Notes
 -----
 - The SQL statement is executed during gateway database initialization.
 - Table creation is idempotent via ``IF NOT EXISTS``.
+- Tables created by older versions are migrated by adding the columns in
+  :data:`PENDING_MESSAGES_ADDED_COLUMNS`; their rows keep the plain text format.
 - This table is distinct from the controller archive and intended for short-lived buffering only.
 """
 
@@ -31,6 +37,17 @@ CREATE_PENDING_MESSAGES_TABLE_QUERY: str = f"""
     CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         type text,
-        message text
+        message text,
+        payload_format INTEGER NOT NULL DEFAULT 0,
+        dictionary_id INTEGER
     );
-"""
\ No newline at end of file
+"""
+
+# Columns added after the first release, with their definitions.
+PENDING_MESSAGES_ADDED_COLUMNS: dict[str, str] = {
+    "payload_format": "INTEGER NOT NULL DEFAULT 0",
+    "dictionary_id": "INTEGER",
+}
+
+# Payload columns of the table, as used by :class:`modules.sqlite.DurableQueue`.
+PENDING_MESSAGES_COLUMNS: list[str] = ["type", "message", "payload_format", "dictionary_id"]
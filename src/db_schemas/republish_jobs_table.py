@@ -0,0 +1,53 @@
+"""Database schema: archive republish jobs table.
+
+This module defines the SQL statement used to create the SQLite table that
+persists archive republish jobs (see :mod:`modules.republish_jobs`), so that
+running jobs resume where they stopped after a gateway restart.
+
+Schema
+------
+Table name:
+  Value of ``sqlite.SqliteTables.REPUBLISH_JOBS``
+
+Columns:
+  - ``id`` (INTEGER PRIMARY KEY AUTOINCREMENT): Job id.
+  - ``start_timestamp_ms`` / ``end_timestamp_ms`` (INTEGER): Exclusive bounds of
+    the republished time range.
+  - ``status`` (TEXT): ``running``, ``paused``, ``done`` or ``cancelled``.
+  - ``position_shard_key`` / ``position_timestamp_ms`` / ``position_message_id``
+    (INTEGER): Archive position of the last republished message, ``NULL`` before
+    the first batch.
+  - ``published_count`` (INTEGER): Number of messages republished so far.
+  - ``total_count`` (INTEGER): Number of messages in the range when the job was created.
+  - ``created_at_ms`` / ``updated_at_ms`` (INTEGER): Unix timestamps in milliseconds.
+
+Notes
+-----
+- The table lives in ``GATEWAY_JOBS_DB_PATH``.
+- Table creation is idempotent via ``IF NOT EXISTS``.
+"""
+
+from modules import sqlite
+
+# SQL statement to create the republish jobs table.
+CREATE_REPUBLISH_JOBS_TABLE_QUERY: str = f"""
+    CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.REPUBLISH_JOBS.value} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_timestamp_ms INTEGER NOT NULL,
+        end_timestamp_ms INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        position_shard_key INTEGER,
+        position_timestamp_ms INTEGER,
+        position_message_id INTEGER,
+        published_count INTEGER NOT NULL DEFAULT 0,
+        total_count INTEGER NOT NULL,
+        created_at_ms INTEGER NOT NULL,
+        updated_at_ms INTEGER NOT NULL
+    );
+"""
+
+# Columns of the table, in the order used by :class:`modules.republish_jobs.RepublishJob`.
+REPUBLISH_JOBS_COLUMNS: list[str] = [
+    "id", "start_timestamp_ms", "end_timestamp_ms", "status", "position_shard_key", "position_timestamp_ms",
+    "position_message_id", "published_count", "total_count", "created_at_ms", "updated_at_ms",
+]
@@ -0,0 +1,54 @@
+"""Database schema: uplink state table.
+
+This module defines the SQL statement used to create the SQLite table in which
+the gateway reports the state of its uplink to the controller (see
+:mod:`modules.uplink_state`). Controllers read it to throttle or aggregate their
+messages while the gateway is falling behind or offline.
+
+Schema
+------
+Table name:
+  Value of ``sqlite.SqliteTables.UPLINK_STATE``
+
+Columns:
+  - ``id`` (INTEGER PRIMARY KEY): Always ``1``, the table has a single row.
+  - ``updated_at_ms`` (INTEGER): Unix timestamp in milliseconds of the last update.
+  - ``connected`` (INTEGER): ``1`` if the gateway is connected to ThingsBoard, otherwise ``0``.
+  - ``state`` (TEXT): ``ok``, ``behind`` or ``offline``.
+  - ``queue_depth`` (INTEGER): Number of controller messages waiting for upload.
+  - ``queue_latency_ms`` (INTEGER): Age of the oldest message waiting for upload.
+  - ``fill_rate`` (REAL): Controller messages written per second.
+  - ``drain_rate`` (REAL): Controller messages uploaded per second.
+  - ``recommended_interval_ms`` (INTEGER): Recommended minimum interval between two
+    controller messages, ``0`` if the gateway keeps up with any rate.
+
+Notes
+-----
+- The table lives in ``COMMUNICATION_QUEUE_DB_PATH``.
+- Table creation is idempotent via ``IF NOT EXISTS``.
+- The row is not updated while the gateway is not running, so readers should
+  check ``updated_at_ms``.
+"""
+
+from modules import sqlite
+
+# SQL statement to create the uplink state table.
+CREATE_UPLINK_STATE_TABLE_QUERY: str = f"""
+    CREATE TABLE IF NOT EXISTS {sqlite.SqliteTables.UPLINK_STATE.value} (
+        id INTEGER PRIMARY KEY,
+        updated_at_ms INTEGER NOT NULL,
+        connected INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        queue_depth INTEGER NOT NULL,
+        queue_latency_ms INTEGER NOT NULL,
+        fill_rate REAL NOT NULL,
+        drain_rate REAL NOT NULL,
+        recommended_interval_ms INTEGER NOT NULL
+    );
+"""
+
+# Columns of the table, excluding ``id``.
+UPLINK_STATE_COLUMNS: list[str] = [
+    "updated_at_ms", "connected", "state", "queue_depth", "queue_latency_ms", "fill_rate", "drain_rate",
+    "recommended_interval_ms",
+]
@@ -11,18 +11,27 @@ Responsibilities
 - Initialize local SQLite databases used for buffering and archiving.
 - Start and supervise the MQTT client connection to ThingsBoard.
 - Dispatch incoming MQTT messages to RPC, OTA, and remote file management handlers.
-- Persist and forward controller telemetry and log messages.
+- Persist and forward controller telemetry and log messages, scheduling the
+  uplink traffic by priority (see :mod:`modules.uplink_scheduler`).
+- Report the uplink state to the controller (see :mod:`modules.uplink_state`).
 - Supervise the controller container and trigger restarts if required.
 - Publish auxiliary health and timing telemetry.
 
 Notes
 -----
 - The main loop is intentionally single-threaded for deterministic behavior.
-- Background daemon threads are used only for MQTT I/O and file change detection.
+  With ``TEG_GATEWAY_RUNTIME=asyncio``, its steps run as concurrent tasks on an
+  event loop instead (see :mod:`async_runtime`).
+- Background daemon threads are used only for MQTT I/O, log shipping, file change
+  detection and communication database change detection.
+- The main loop does not poll: when there is no work, it sleeps until an MQTT
+  message arrives, the controller writes to the communication database, or the
+  next timer deadline is due (see :mod:`utils.wakeup`).
 - Fatal errors result in a graceful shutdown followed by forced termination if
   necessary.
 """
 
+import asyncio
 import json
 import os
 import signal
@@ -30,35 +39,53 @@ import sys
 import threading
 from logging import error
 from time import sleep, time_ns
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
-from db_schemas.controller_archive_table import *
 from db_schemas.controller_messages_table import *
+from db_schemas.log_buffer_table import *
+from db_schemas.payload_dictionaries_table import *
 from db_schemas.pending_messages_table import *
 from modules.file_writer import GatewayFileWriter
-from modules.logging import info, warn, debug
+from modules.logging import info, warn, debug, flush_log_records, get_telemetry_values as get_log_telemetry_values
 import utils.paths
 import utils.misc
 from args import parse_args
+from async_runtime import GATEWAY_RUNTIME_ASYNCIO, MainLoopSteps, run_async_main_loop, stop_async_main_loop
 from modules import sqlite
+from modules.archive import GatewayArchive
+from modules.compression import PayloadCodec
 from modules.docker_client import GatewayDockerClient
 from modules.git_client import GatewayGitClient
-from modules.mqtt import GatewayMqttClient
+from modules.message_transfer import ControllerMessageTransfer, CONTROLLER_QUEUE_CURSOR_MODE, CURSOR_TRUNCATE_MIN_ROWS
+from modules.mqtt import GatewayMqttClient, build_log_telemetry_payload
+from modules.pending_publisher import NewestFirstDrain, PendingMessagePublisher, UPLINK_NEWEST_FIRST
+from modules.republish_jobs import RepublishJobRunner
+from modules.rate_controller import UplinkRateController
+from modules.retention import RetentionEngine
+from modules.rpc_executor import RpcExecutor
+from modules.uplink_state import UplinkStateReporter
+from modules.uplink_scheduler import UplinkLane, UplinkScheduler, UPLINK_BACKFILL_WEIGHT, UPLINK_LIVE_WEIGHT, \
+    UPLINK_LOGS_WEIGHT
 from on_mqtt_msg.check_for_file_content_update import on_msg_check_for_file_content_update
 from on_mqtt_msg.check_for_file_hashes_update import on_msg_check_for_file_hashes_update, FILE_HASHES_TB_KEY
 from on_mqtt_msg.check_for_files_definition_update import on_msg_check_for_files_definition_update
 from on_mqtt_msg.check_for_ota_updates import on_msg_check_for_ota_update
 from on_mqtt_msg.on_rpc_request import on_rpc_request
 from self_provisioning import self_provisioning_get_access_token
-from utils.controller_restart import restart_controller_if_needed
+from utils.controller_restart import restart_controller_if_needed, ms_until_next_restart_check
 from utils.misc import get_maybe
+from utils.wakeup import wait_for_wakeup, start_db_change_watcher
 
 global_mqtt_client: Optional[GatewayMqttClient] = None
-archive_sqlite_db: Optional[sqlite.SqliteConnection] = None
+archive: Optional[GatewayArchive] = None
 communication_sqlite_db: Optional[sqlite.SqliteConnection] = None
 gateway_logs_buffer_db: Optional[sqlite.SqliteConnection] = None
+message_transfer: Optional[ControllerMessageTransfer] = None
 STOP_MAINLOOP = False
 AUX_DATA_PUBLISH_INTERVAL_MS = 20_000 # every 20 seconds
+LOG_BUFFER_BATCH_SIZE = 50 # buffered log messages per publish
+MAINLOOP_MAX_IDLE_WAIT_MS = 60_000 # wake up at least once a minute
+SHUTDOWN_DB_IDLE_TIMEOUT_S = 5 # wait for running database writes before flushing on shutdown
 aux_data_publish_ts = None
 
 
@@ -68,7 +95,15 @@ def shutdown_handler(sig: Any, _frame: Any) -> None:
 
     This handler is invoked on SIGINT and SIGTERM. It attempts to shut down all
     subsystems cleanly, including MQTT connections and SQLite databases, before
-    terminating the process.
+    terminating the process. Buffered archive rows and queued log records are
+    written to disk before the databases are closed.
+
+    The handler runs on the main thread, which may have been interrupted while
+    writing to a database. With the asyncio runtime, the database executor may
+    be running an operation as well, so the runtime is stopped first. Write locks
+    are not re-entrant, so the archive buffer is only written and the databases
+    only closed if no write is running; otherwise the buffered archive rows are
+    dropped.
 
     Args:
       sig: Received signal number.
@@ -82,10 +117,23 @@ def shutdown_handler(sig: Any, _frame: Any) -> None:
     STOP_MAINLOOP = True
     if global_mqtt_client is not None:
         global_mqtt_client.graceful_exit()
-    if archive_sqlite_db is not None:
-        archive_sqlite_db.close()
-    if communication_sqlite_db is not None:
-        communication_sqlite_db.close()
+    databases_idle = (stop_async_main_loop(SHUTDOWN_DB_IDLE_TIMEOUT_S)
+                      and (archive is None or archive.wait_until_idle(SHUTDOWN_DB_IDLE_TIMEOUT_S))
+                      and (communication_sqlite_db is None
+                           or communication_sqlite_db.wait_until_idle(SHUTDOWN_DB_IDLE_TIMEOUT_S)))
+    if message_transfer is not None:
+        if databases_idle:
+            message_transfer.flush_archive()
+        elif len(message_transfer.archive_buffer) > 0:
+            warn(f"Database busy during shutdown, dropped {len(message_transfer.archive_buffer)} buffered archive rows")
+    if archive is not None and databases_idle:
+        archive.close()
+    if communication_sqlite_db is not None and databases_idle:
+        # later calls of other threads find the database unavailable
+        with communication_sqlite_db.write_lock:
+            communication_sqlite_db.db_unavailable = True
+            communication_sqlite_db.close()
+    flush_log_records()
     if gateway_logs_buffer_db is not None:
         gateway_logs_buffer_db.close()
 
@@ -98,11 +146,18 @@ def forced_shutdown_handler(_sig: Any, _frame: Any) -> None:
     """Handle forced shutdown if graceful shutdown fails.
 
     This handler is triggered by a SIGALRM when the graceful shutdown timeout is
-    exceeded and terminates the process immediately.
+    exceeded and terminates the process immediately. It writes to stdout directly
+    instead of logging, so it cannot block on a lock held by the interrupted code.
     """
-    warn("FORCEFUL SHUTDOWN")
-    sys.stdout.flush()
-    os._exit(1)
+    try:
+        sys.stdout.flush()
+    except (OSError, RuntimeError, ValueError):
+        # the interrupted code may be writing to stdout
+        pass
+    try:
+        os.write(sys.stdout.fileno(), b"[WARN] FORCEFUL SHUTDOWN\n")
+    finally:
+        os._exit(1)
 
 
 def get_last_controller_health_check_ts() -> int:
@@ -139,13 +194,59 @@ try:
         provisioned, access_token = self_provisioning_get_access_token(args)
 
         # initialize sqlite database connections
-        archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
+        archive = GatewayArchive()
         communication_sqlite_db = sqlite.SqliteConnection(utils.paths.COMMUNICATION_QUEUE_DB_PATH)
         gateway_logs_buffer_db = sqlite.SqliteConnection(utils.paths.GATEWAY_LOGS_BUFFER_DB_PATH)
-        archive_sqlite_db.execute(CREATE_CONTROLLER_ARCHIVE_TABLE_QUERY)
-        archive_sqlite_db.execute(CREATE_CONTROLLER_ARCHIVE_INDEX_QUERY)
         communication_sqlite_db.execute(CREATE_CONTROLLER_MESSAGES_TABLE_QUERY)
         communication_sqlite_db.execute(CREATE_PENDING_MESSAGES_TABLE_QUERY)
+        communication_sqlite_db.add_missing_columns(
+            sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value, PENDING_MESSAGES_ADDED_COLUMNS)
+        communication_sqlite_db.execute(CREATE_PAYLOAD_DICTIONARIES_TABLE_QUERY)
+        gateway_logs_buffer_db.execute(CREATE_LOG_BUFFER_TABLE_QUERY)
+
+        # queues on top of the sqlite tables
+        controller_messages_queue = sqlite.DurableQueue(
+            communication_sqlite_db, sqlite.SqliteTables.CONTROLLER_MESSAGES.value, CONTROLLER_MESSAGES_COLUMNS)
+        pending_messages_queue = sqlite.DurableQueue(
+            communication_sqlite_db, sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value, PENDING_MESSAGES_COLUMNS)
+        log_buffer_queue = sqlite.DurableQueue(
+            gateway_logs_buffer_db, sqlite.SqliteTables.LOG_BUFFER.value, LOG_BUFFER_COLUMNS)
+        # publishers draining the pending queue and, in cursor mode, the controller queue directly
+        payload_codec = PayloadCodec(communication_sqlite_db)
+        uplink_queues: list[Union[sqlite.DurableQueue, sqlite.QueueCursor]] = [pending_messages_queue]
+        controller_queue_cursors: list[sqlite.QueueCursor] = []
+        if CONTROLLER_QUEUE_CURSOR_MODE:
+            archive_cursor = sqlite.QueueCursor(controller_messages_queue, "archive")
+            uplink_cursor = sqlite.QueueCursor(controller_messages_queue, "uplink")
+            controller_queue_cursors = [archive_cursor, uplink_cursor]
+            message_transfer = ControllerMessageTransfer(
+                controller_messages_queue, pending_messages_queue, archive, payload_codec, archive_cursor)
+            uplink_queues.append(uplink_cursor)
+        else:
+            controller_messages_queue.drop_cursors()
+            message_transfer = ControllerMessageTransfer(
+                controller_messages_queue, pending_messages_queue, archive, payload_codec)
+        # in newest-first mode, each queue is drained by a live and a backfill publisher
+        newest_first_drains: list[NewestFirstDrain] = []
+        if UPLINK_NEWEST_FIRST:
+            newest_first_drains = [NewestFirstDrain(queue, payload_codec) for queue in uplink_queues]
+            pending_publishers = [drain.live for drain in newest_first_drains]
+        else:
+            pending_publishers = [PendingMessagePublisher(queue, payload_codec) for queue in uplink_queues]
+        all_publishers = pending_publishers + [drain.backfill for drain in newest_first_drains]
+        # report the uplink state to the controller, counting messages not transferred yet in copy mode
+        uplink_state_reporter = UplinkStateReporter(
+            communication_sqlite_db, controller_messages_queue,
+            uplink_queues if CONTROLLER_QUEUE_CURSOR_MODE else [controller_messages_queue, *uplink_queues],
+            all_publishers)
+        # wake up the main loop when the controller writes to the communication db
+        start_db_change_watcher(utils.paths.COMMUNICATION_QUEUE_DB_PATH)
+        # keep the archive and the queue databases within their budgets
+        retention_engine = RetentionEngine(archive, [pending_messages_queue, log_buffer_queue])
+        retention_engine.start()
+        # republish archived messages in the background, resuming jobs from before a restart
+        republish_job_runner = RepublishJobRunner()
+        republish_job_runner.start()
 
         # --- MQTT client startup ---
         # create and run the mqtt client in a separate thread
@@ -167,149 +268,258 @@ try:
             info("Gateway is provisioned for first time, initializing attributes...")
             GatewayMqttClient().publish_message_raw("v1/devices/me/attributes", json.dumps({ FILE_HASHES_TB_KEY: {}}))
 
-        # --- Background file change detection thread ---
-        # daemon thread for updating file content client attributes every 30 seconds
-        def file_update_check_daemon():
-            """Daemon thread to check for file updates every 30 seconds."""
-            while True:
-                sleep(30)
-                try:
-                    debug("Checking for file changes...")
-                    file_definitions = GatewayFileWriter().get_files()
-                    for file_id in file_definitions:
-                        if GatewayFileWriter().did_file_change(get_maybe(file_definitions, file_id, "path")):
-                            info(f"File {file_definitions[file_id]} changed on disk - requesting update")
-                            GatewayMqttClient().request_attributes({"clientKeys": FILE_HASHES_TB_KEY})
-                except Exception as ex:
-                    warn(f"Error checking for file changes: {ex}")
-        file_update_thread = threading.Thread(target=file_update_check_daemon, daemon=True)
-        file_update_thread.start()
-
-        # --- Main event loop ---
-        info("Entering main loop...")
-        # *** main loop ***
-        while not STOP_MAINLOOP:
-            # check if there are any new incoming mqtt messages in the queue, process them
-            if not mqtt_client.message_queue.empty():
-                msg = mqtt_client.message_queue.get()
-                topic = get_maybe(msg, "topic") or "unknown"
-                msg_payload = utils.misc.get_maybe(msg, "payload")
-
-                # check for incoming RPC requests
-                if "v1/devices/me/rpc/request" in topic:
-                    rpc_method = get_maybe(msg_payload, "method")
-                    rpc_params = get_maybe(msg_payload, "params")
-                    rpc_msg_id = topic.split("/")[-1]
-                    on_rpc_request(rpc_msg_id, rpc_method, rpc_params)
-
-                # check for attribute updates
-                elif "v1/devices/me/attributes" in topic:
-                    if not any([
-                            on_msg_check_for_ota_update(msg_payload),
-                            on_msg_check_for_files_definition_update(msg_payload),
-                            on_msg_check_for_file_hashes_update(msg_payload),
-                            on_msg_check_for_file_content_update(msg_payload),
-                    ]):
-                        warn("[MAIN] Got invalid message: " + str(msg))
-                        warn("[MAIN] Skipping invalid message...")
-
-                continue  # process the next message
-
-            # automatically restart the controller's docker container if it is not running
-            if restart_controller_if_needed():
-                continue
-
-            if not mqtt_client_thread.is_alive() or not mqtt_client.is_connected():
-                if not mqtt_client.is_connected():
-                    warn("MQTT client not connected, exiting in 30 seconds...")
-                else:
-                    warn("MQTT client thread died, exiting in 30 seconds...")
-                sleep(30)
-                utils.misc.fatal_error("MQTT client thread died")
-
-            # check if there is any buffered outgoing log message in the buffer sqlite db
-            if gateway_logs_buffer_db.do_table_values_exist("log_buffer"):
-                # fetch the next message (lowest `id`) from the queue and send it
-                message = gateway_logs_buffer_db.execute(
-                    f"SELECT id, log_level, message, timestamp_ms FROM {"log_buffer"} ORDER BY id LIMIT 1")
-                if len(message) > 0:
-                    debug('Sending buffered log message: ' + str(message[0]))
-                    if not mqtt_client.publish_log(message[0][1], message[0][2], message[0][3]):
-                        continue
-                    gateway_logs_buffer_db.execute(f"DELETE FROM {"log_buffer"} WHERE id = {message[0][0]}")
-                continue
-
-
-            if communication_sqlite_db.do_table_values_exist(sqlite.SqliteTables.CONTROLLER_MESSAGES.value):
-                # fetch the next message (lowest `id`) from the queue and process it
-                message = communication_sqlite_db.execute(
-                    f"SELECT id, type, message FROM {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} ORDER BY id LIMIT 1"
-                )
-                if len(message) > 0:
-                    message_type = message[0][1]
-                    message_obj = json.loads(message[0][2])
-                    message_timestamp_ms = message_obj["ts"]
-                    message_values = message_obj["values"]
-
-                    # archive controller messages in the archive sqlite db, except for log messages
-                    if not "log" in message_type:
-                        archive_sqlite_db.execute(
-                            "INSERT INTO controller_archive (timestamp_ms, message) VALUES (?, ?)",
-                            (message_timestamp_ms, json.dumps(message_values)))
-
-                    # add message to sqlite table containing pending outgoing mqtt messages
-                    communication_sqlite_db.execute(
-                        "INSERT INTO " + sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value + " (type, message) VALUES (?, ?)",
-                        (message[0][1], message[0][2]))
-
-                    # remove the published message from the queue
-                    communication_sqlite_db.execute(
-                        f"DELETE FROM {sqlite.SqliteTables.CONTROLLER_MESSAGES.value} WHERE id = {message[0][0]}")
-                continue
-
-            # check if there are any new outgoing mqtt messages in the sqlite db
-            if communication_sqlite_db.do_table_values_exist(sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value):
-                # fetch the next message (lowest `id`) from the queue and send it
-                message = communication_sqlite_db.execute(
-                    f"SELECT id, type, message FROM {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} ORDER BY id LIMIT 1"
-                )
-                if len(message) > 0:
-                    message_type = message[0][1]
-                    message_obj = json.loads(message[0][2])
-                    debug('Sending controller message: ' + str(message[0]))
-                    if not mqtt_client.publish_telemetry(message[0][2]):
-                        continue
-
-                    # remove the published message from the queue
-                    communication_sqlite_db.execute(
-                        f"DELETE FROM {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value} WHERE id = {message[0][0]}")
-                continue
-
-            # --- Controller supervision ---
+        # --- File change detection ---
+        def check_file_changes() -> None:
+            """Request the file hashes if a remote-managed file changed on disk."""
+            try:
+                debug("Checking for file changes...")
+                file_definitions = GatewayFileWriter().get_files()
+                for file_id in file_definitions:
+                    if GatewayFileWriter().did_file_change(get_maybe(file_definitions, file_id, "path")):
+                        info(f"File {file_definitions[file_id]} changed on disk - requesting update")
+                        GatewayMqttClient().request_attributes({"clientKeys": FILE_HASHES_TB_KEY})
+            except Exception as ex:
+                warn(f"Error checking for file changes: {ex}")
+
+        if not GATEWAY_RUNTIME_ASYNCIO:
+            # daemon thread for updating file content client attributes every 30 seconds
+            def file_update_check_daemon():
+                """Daemon thread to check for file updates every 30 seconds."""
+                while True:
+                    sleep(30)
+                    check_file_changes()
+            file_update_thread = threading.Thread(target=file_update_check_daemon, daemon=True)
+            file_update_thread.start()
+
+        # --- Uplink lanes ---
+        def ms_until_aux_data_due() -> int:
+            """Return the time until the auxiliary health telemetry is due, ``0`` if it is due."""
+            if aux_data_publish_ts is None:
+                return 0
+            return max(0, aux_data_publish_ts + AUX_DATA_PUBLISH_INTERVAL_MS + 1 - int(time_ns() / 1_000_000))
+
+        def is_aux_data_due() -> bool:
+            """Return whether the auxiliary health telemetry is due."""
+            return ms_until_aux_data_due() == 0
+
+        def publish_aux_data() -> int:
+            """Publish the auxiliary health telemetry if it is due.
+
+            Also stops the controller if it did not send a health check in the last 6 hours.
+
+            Returns:
+              ``1`` if the telemetry was due, otherwise ``0``.
+            """
+            global aux_data_publish_ts
+            if not is_aux_data_due():
+                return 0
+            aux_data_publish_ts = int(time_ns() / 1_000_000)
             controller_running_since_ts = docker_client.get_edge_startup_timestamp_ms() or 0
             last_controller_health_check_ts = get_last_controller_health_check_ts()
 
-            # --- Auxiliary health telemetry ---
             # publish controller startup time and health check time to mqtt
-            if aux_data_publish_ts is None or int(time_ns() / 1_000_000) - aux_data_publish_ts > AUX_DATA_PUBLISH_INTERVAL_MS:
-                aux_data_publish_ts = int(time_ns() / 1_000_000)
-                mqtt_client.publish_telemetry(json.dumps({
-                    "ts": aux_data_publish_ts,
-                    "values": {
-                        "ms_since_controller_startup": aux_data_publish_ts - controller_running_since_ts,
-                        "ms_since_last_controller_health_check": aux_data_publish_ts - last_controller_health_check_ts
-                    }
-                }))
+            mqtt_client.publish_telemetry(json.dumps({
+                "ts": aux_data_publish_ts,
+                "values": {
+                    "ms_since_controller_startup": aux_data_publish_ts - controller_running_since_ts,
+                    "ms_since_last_controller_health_check": aux_data_publish_ts - last_controller_health_check_ts,
+                    **retention_engine.get_telemetry_values(),
+                    **republish_job_runner.get_telemetry_values(),
+                    **uplink_scheduler.get_telemetry_values(),
+                    "uplink_expired_messages": sum(publisher.expired_count for publisher in all_publishers),
+                    **uplink_state_reporter.get_telemetry_values(),
+                    **rate_controller.get_telemetry_values(),
+                    **mqtt_client.message_queue.get_telemetry_values(),
+                    **RpcExecutor().get_telemetry_values(),
+                    **get_log_telemetry_values(),
+                }
+            }))
 
             if (max(last_controller_health_check_ts, controller_running_since_ts)
                     < int(time_ns() / 1_000_000) - (6 * 3600_000)
                     and docker_client.is_controller_running()):
                 warn("Controller did not send health check in the last 6 hours, stopping container...")
                 docker_client.stop_controller()
-                continue
-
-            # if nothing happened this iteration, sleep for a while
-            sleep(5)
+            return 1
+
+        def publish_buffered_logs() -> int:
+            """Publish the next batch of buffered log messages (lowest ``id`` first).
+
+            Returns:
+              Number of published log messages.
+            """
+            if not rate_controller.is_allowed():
+                return 0
+            log_rows = log_buffer_queue.peek_batch(rate_controller.get_batch_size(LOG_BUFFER_BATCH_SIZE))
+            if len(log_rows) == 0:
+                return 0
+            debug(f'Sending {len(log_rows)} buffered log messages')
+            if not mqtt_client.publish_telemetry_batch([
+                    build_log_telemetry_payload(log_level, log_message, timestamp_ms)
+                    for _id, log_level, log_message, timestamp_ms in log_rows]):
+                return 0
+            rate_controller.consume(len(log_rows))
+            log_buffer_queue.ack_through(log_rows[-1][0])
+            return len(log_rows)
+
+        def get_oldest_log_timestamp_ms() -> Optional[int]:
+            """Return the timestamp of the oldest buffered log message."""
+            log_rows = log_buffer_queue.peek_batch(1)
+            return log_rows[0][3] if len(log_rows) > 0 else None
+
+        def get_oldest_pending_timestamp_ms() -> Optional[int]:
+            """Return the timestamp of the oldest controller message waiting for upload."""
+            return min((timestamp_ms for timestamp_ms in (publisher.oldest_timestamp_ms() for publisher in pending_publishers)
+                        if timestamp_ms is not None), default=None)
+
+        # health telemetry first, then logs and live data by weight, and the republish backlog last,
+        # at the rate the link sustains
+        rate_controller = UplinkRateController()
+        uplink_scheduler = UplinkScheduler()
+        uplink_scheduler.add_lane(UplinkLane(
+            "health", publish_aux_data, lambda: int(is_aux_data_due()),
+            lambda: aux_data_publish_ts + AUX_DATA_PUBLISH_INTERVAL_MS
+            if aux_data_publish_ts is not None and is_aux_data_due() else None))
+        uplink_scheduler.add_lane(UplinkLane(
+            "logs", publish_buffered_logs, log_buffer_queue.depth, get_oldest_log_timestamp_ms, UPLINK_LOGS_WEIGHT))
+        if UPLINK_NEWEST_FIRST:
+            uplink_scheduler.add_lane(UplinkLane(
+                "live", lambda: sum(drain.publish_live() for drain in newest_first_drains),
+                lambda: sum(drain.live_depth() for drain in newest_first_drains),
+                get_oldest_pending_timestamp_ms, UPLINK_LIVE_WEIGHT))
+            uplink_scheduler.add_lane(UplinkLane(
+                "backfill", lambda: sum(drain.publish_backfill() for drain in newest_first_drains),
+                lambda: sum(drain.backfill_depth() for drain in newest_first_drains),
+                lambda: min((timestamp_ms for timestamp_ms in (drain.backfill.oldest_timestamp_ms()
+                                                               for drain in newest_first_drains)
+                             if timestamp_ms is not None), default=None),
+                UPLINK_BACKFILL_WEIGHT))
+        else:
+            uplink_scheduler.add_lane(UplinkLane(
+                "live", lambda: sum(publisher.publish_batch() for publisher in pending_publishers),
+                lambda: sum(publisher.pending_queue.depth() for publisher in pending_publishers),
+                get_oldest_pending_timestamp_ms, UPLINK_LIVE_WEIGHT))
+        uplink_scheduler.add_lane(UplinkLane(
+            "backlog", None, republish_job_runner.get_backlog_depth, republish_job_runner.get_backlog_timestamp_ms))
+
+        # --- Main loop steps ---
+        def process_mqtt_message(msg: dict[str, Any]) -> None:
+            """Dispatch an inbound MQTT message to the RPC or attribute update handlers."""
+            topic = get_maybe(msg, "topic") or "unknown"
+            msg_payload = utils.misc.get_maybe(msg, "payload")
+
+            # check for incoming RPC requests
+            if "v1/devices/me/rpc/request" in topic:
+                rpc_method = get_maybe(msg_payload, "method")
+                rpc_params = get_maybe(msg_payload, "params")
+                rpc_msg_id = topic.split("/")[-1]
+                on_rpc_request(rpc_msg_id, rpc_method, rpc_params)
+
+            # check for attribute updates
+            elif "v1/devices/me/attributes" in topic:
+                if not any([
+                        on_msg_check_for_ota_update(msg_payload),
+                        on_msg_check_for_files_definition_update(msg_payload),
+                        on_msg_check_for_file_hashes_update(msg_payload),
+                        on_msg_check_for_file_content_update(msg_payload),
+                ]):
+                    warn("[MAIN] Got invalid message: " + str(msg))
+                    warn("[MAIN] Skipping invalid message...")
+
+        def is_mqtt_client_connected() -> bool:
+            """Return whether the MQTT client thread is alive and connected."""
+            return mqtt_client_thread.is_alive() and mqtt_client.is_connected()
+
+        def report_disconnected() -> None:
+            """Report the lost MQTT connection to the controller and the log."""
+            uplink_state_reporter.update(connected=False)
+            if not mqtt_client.is_connected():
+                warn("MQTT client not connected, exiting in 30 seconds...")
+            else:
+                warn("MQTT client thread died, exiting in 30 seconds...")
+
+        def forward_batch() -> int:
+            """Move controller messages into the pending queue and the archive in batches, and
+            publish the next batch of the uplink lane that is due (see modules.uplink_scheduler).
+
+            Returns:
+              Number of transferred and published messages.
+            """
+            assert message_transfer is not None
+            transferred_count = message_transfer.transfer_batch()
+            return uplink_scheduler.send_next() + transferred_count
+
+        def run_maintenance() -> None:
+            """Write buffered archive rows to disk if they are due, and remove controller
+            messages consumed by all cursors in bulk."""
+            assert message_transfer is not None
+            message_transfer.flush_archive_if_due()
+            controller_messages_queue.truncate_consumed(controller_queue_cursors, CURSOR_TRUNCATE_MIN_ROWS)
+
+        def ms_until_next_deadline() -> float:
+            """Return the time until the next timer deadline of the main loop."""
+            assert message_transfer is not None
+            wakeup_deadlines_ms = [
+                MAINLOOP_MAX_IDLE_WAIT_MS,
+                ms_until_aux_data_due(),
+                ms_until_next_restart_check() + 1,
+                message_transfer.ms_until_archive_flush(),
+                *(publisher.ms_until_ack_timeout() for publisher in all_publishers),
+                *(drain.ms_until_backfill() for drain in newest_first_drains),
+                uplink_state_reporter.ms_until_update(),
+                rate_controller.ms_until_allowed(),
+            ]
+            return min(deadline for deadline in wakeup_deadlines_ms if deadline is not None)
+
+        if GATEWAY_RUNTIME_ASYNCIO:
+            asyncio.run(run_async_main_loop(MainLoopSteps(
+                get_message=mqtt_client.get_message,
+                process_message=process_mqtt_message,
+                restart_controller_if_needed=restart_controller_if_needed,
+                ms_until_restart_check=ms_until_next_restart_check,
+                is_connected=is_mqtt_client_connected,
+                report_disconnected=report_disconnected,
+                update_uplink_state=lambda: uplink_state_reporter.update_if_due(connected=True),
+                ms_until_uplink_state_update=uplink_state_reporter.ms_until_update,
+                forward_batch=forward_batch,
+                run_maintenance=run_maintenance,
+                ms_until_next_deadline=ms_until_next_deadline,
+                check_file_changes=check_file_changes,
+                stop_requested=lambda: STOP_MAINLOOP,
+            ), MAINLOOP_MAX_IDLE_WAIT_MS))
+        else:
+            # --- Main event loop ---
+            info("Entering main loop...")
+            # *** main loop ***
+            while not STOP_MAINLOOP:
+                # check if there are any new incoming mqtt messages in the queue, process them
+                msg = mqtt_client.get_message()
+                if msg is not None:
+                    process_mqtt_message(msg)
+                    continue  # process the next message
+
+                # automatically restart the controller's docker container if it is not running
+                if restart_controller_if_needed():
+                    continue
+
+                if not is_mqtt_client_connected():
+                    report_disconnected()
+                    sleep(30)
+                    utils.misc.fatal_error("MQTT client thread died")
+
+                # tell the controller whether the uplink keeps up with its messages
+                uplink_state_reporter.update_if_due(connected=True)
+
+                # transfer and publish the next batch
+                if forward_batch() > 0:
+                    continue
+
+                run_maintenance()
+
+                # --- Wait for the next event ---
+                # sleep until an mqtt message or ack arrives, the controller writes to the
+                # communication db, or the next timer deadline is due
+                wait_for_wakeup(ms_until_next_deadline() / 1000)
 
 except Exception as e:
     utils.misc.fatal_error(f"An error occurred in gateway main loop: {e}")
@@ -0,0 +1,1010 @@
+"""Time-partitioned controller message archive for the Edge Gateway.
+
+Archived controller messages are stored in one SQLite file per period (a day by
+default, or a week) instead of a single ever-growing table. The
+:class:`GatewayArchive` singleton routes writes to the shard of each message's
+timestamp and resolves a time range to the shards overlapping it for reads and
+deletes.
+
+Discarding a whole period is a file unlink, which is instant and leaves no
+fragmented free pages behind; only shards partially covered by a range are
+cleaned up with indexed deletes.
+
+Shards
+------
+- Shards are stored in ``GATEWAY_ARCHIVE_SHARDS_PATH`` and named
+  ``controller_archive_<period>_<YYYYMMDD>.db`` after the UTC start of their
+  period. Weekly shards start on Mondays.
+- Every shard contains a ``controller_archive`` table (see
+  :mod:`db_schemas.controller_archive_table`).
+- The single-file archive of older versions (``gateway_archive.db``) is kept as
+  a legacy shard covering all timestamps. It is read and discarded from, but no
+  longer written to.
+
+Layouts
+-------
+- ``blob``: Each message's values are stored as one JSON text. Any question
+  about a single key has to parse every message in the time range.
+- ``normalized``: Each value is stored in its own row with typed value columns,
+  indexed by key and timestamp (see :mod:`db_schemas.controller_archive_table`).
+  A single-key range scan (:meth:`GatewayArchive.iter_key_values`) only reads
+  the rows of that key. Messages stored as JSON are migrated in the background
+  by :class:`modules.retention.RetentionEngine`.
+- ``compressed``: New messages are stored as JSON. Once their hour is over, the
+  messages are packed into a compressed block per hour (see
+  :mod:`modules.archive_blocks`) in the background by
+  :class:`modules.retention.RetentionEngine`.
+
+All layouts can coexist within a shard, all reads and deletes handle all of
+them. Messages read from blocks have negative message ids in their
+:class:`ArchivePosition`, ordering them before JSON messages sharing their
+timestamp.
+
+Configuration
+-------------
+- ``TEG_ARCHIVE_SHARD_PERIOD``: ``day`` (default) or ``week``. Changing the
+  period only affects new shards; existing shards keep their period.
+- ``TEG_ARCHIVE_LAYOUT``: ``blob`` (default), ``normalized`` or ``compressed``.
+  Switching back to ``blob`` only affects new messages; normalized messages and
+  blocks stay readable.
+
+Notes
+-----
+- Time ranges use exclusive bounds, like the archive RPC methods.
+- Shard connections are shared by the main loop, the retention thread, the
+  republish jobs and the RPC workers. Every use of a connection is counted (see
+  :meth:`GatewayArchive.use_connection`); connections are only closed and shard
+  files only deleted while they are not in use.
+- Messages are returned in ``(timestamp_ms, id)`` order per shard; shards are
+  visited in order of their period, starting with the legacy shard.
+"""
+
+import heapq
+import json
+import math
+import os
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from threading import Condition, RLock
+from typing import Any, Generator, Iterable, Iterator, Optional, Sequence
+
+import utils.paths
+from db_schemas.controller_archive_table import CREATE_CONTROLLER_ARCHIVE_TABLE_QUERY, CREATE_CONTROLLER_ARCHIVE_INDEX_QUERY, \
+    CREATE_ARCHIVE_KEYS_TABLE_QUERY, CREATE_CONTROLLER_ARCHIVE_VALUES_TABLE_QUERY, \
+    CREATE_CONTROLLER_ARCHIVE_VALUES_INDEX_QUERY, CREATE_CONTROLLER_ARCHIVE_JSON_INDEX_QUERY, \
+    CREATE_CONTROLLER_ARCHIVE_VALUES_DELETE_TRIGGER_QUERY, CREATE_ARCHIVE_BLOCKS_TABLE_QUERY, \
+    CREATE_ARCHIVE_BLOCK_SERIES_TABLE_QUERY
+from modules import archive_blocks, sqlite
+from modules.logging import debug, info, warn
+
+ARCHIVE_SHARD_PERIOD: str = os.environ.get("TEG_ARCHIVE_SHARD_PERIOD") or "day"
+ARCHIVE_LAYOUT: str = os.environ.get("TEG_ARCHIVE_LAYOUT") or "blob"
+
+ARCHIVE_LAYOUTS: tuple[str, ...] = ("blob", "normalized", "compressed")
+# Time window packed into one block in the compressed layout, shard periods are multiples of it
+ARCHIVE_BLOCK_PERIOD_MS: int = 3_600_000
+
+DAY_MS: int = 86_400_000
+SHARD_PERIODS_MS: dict[str, int] = {"day": DAY_MS, "week": 7 * DAY_MS}
+# The Unix epoch was a Thursday, weekly shards start on Mondays
+SHARD_PERIOD_OFFSETS_MS: dict[str, int] = {"day": 0, "week": 4 * DAY_MS}
+SHARD_FILE_PATTERN = re.compile(r"^controller_archive_(day|week)_(\d{8})\.db$")
+# Timestamps covered by the legacy shard
+LEGACY_SHARD_START_MS: int = 0
+LEGACY_SHARD_END_MS: int = 2**63 - 1
+
+singleton_instance: Optional["GatewayArchive"] = None
+
+
+@dataclass
+class ArchiveShard:
+    """One archive database file covering the timestamps ``[start_ms, end_ms)``."""
+    path: str
+    start_ms: int
+    end_ms: int
+    legacy: bool = False
+
+    def is_covered_by(self, start_timestamp_ms: int, end_timestamp_ms: int) -> bool:
+        """Check whether all timestamps of the shard lie strictly within a range."""
+        return not self.legacy and start_timestamp_ms < self.start_ms and self.end_ms - 1 < end_timestamp_ms
+
+    def overlaps(self, start_timestamp_ms: int, end_timestamp_ms: int) -> bool:
+        """Check whether the shard may contain timestamps strictly within a range."""
+        return self.start_ms < end_timestamp_ms and start_timestamp_ms + 1 < self.end_ms
+
+    def position_key(self) -> int:
+        """Return the key ordering the shards during iteration, the legacy shard comes first."""
+        return LEGACY_SHARD_START_MS - 1 if self.legacy else self.start_ms
+
+
+@dataclass(frozen=True)
+class ArchivePosition:
+    """Position of a message within an iteration over the archive.
+
+    Attributes
+    ----------
+    shard_key:
+      :meth:`ArchiveShard.position_key` of the message's shard.
+    timestamp_ms / message_id:
+      Keyset of the message within its shard.
+    """
+    shard_key: int
+    timestamp_ms: int
+    message_id: int
+
+
+def shard_start_ms(timestamp_ms: int, period: str) -> int:
+    """Return the start of the shard period containing a timestamp."""
+    period_ms = SHARD_PERIODS_MS[period]
+    offset_ms = SHARD_PERIOD_OFFSETS_MS[period]
+    return (timestamp_ms - offset_ms) // period_ms * period_ms + offset_ms
+
+
+def encode_value(value: Any) -> tuple[Optional[int], Optional[float], Optional[str]]:
+    """Return the ``(int_value, real_value, json_value)`` columns of a value in the normalized layout."""
+    if type(value) is int and -2**63 <= value < 2**63:
+        return value, None, None
+    if type(value) is float and math.isfinite(value):
+        return None, value, None
+    return None, None, json.dumps(value)
+
+
+def decode_value(int_value: Optional[int], real_value: Optional[float], json_value: Optional[str]) -> Any:
+    """Return the value stored in the typed value columns of the normalized layout."""
+    if int_value is not None:
+        return int_value
+    if real_value is not None:
+        return real_value
+    return json.loads(json_value) if json_value is not None else None
+
+
+def shard_file_name(start_ms: int, period: str) -> str:
+    """Return the file name of the shard starting at ``start_ms``."""
+    start_date = datetime.fromtimestamp(start_ms / 1000, tz=timezone.utc)
+    return f"controller_archive_{period}_{start_date.strftime('%Y%m%d')}.db"
+
+
+class GatewayArchive:
+    """Router over the archive shard files.
+
+    Implemented as a singleton, so the main loop and the RPC handlers share the
+    shard map and the open connections.
+
+    Attributes
+    ----------
+    shards_path:
+      Directory containing the shard files.
+    period:
+      Period of newly created shards.
+    shards:
+      Known shards by path, including the legacy shard if it exists.
+    layout:
+      Layout new messages are written in.
+    normalized_shards:
+      Paths of the open shards containing the tables of the normalized layout.
+    block_shards:
+      Paths of the open shards containing the tables of the compressed layout.
+    write_counts:
+      Number of writes per shard path since the gateway started, telling
+      background maintenance which shards changed.
+    connection_users:
+      Number of operations using the connection per shard path, the connection
+      is not closed while it is in use.
+    """
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            debug("[ARCHIVE] Initializing GatewayArchive")
+            super().__init__()
+            singleton_instance = self
+            if ARCHIVE_SHARD_PERIOD not in SHARD_PERIODS_MS:
+                warn(f"[ARCHIVE] Unknown shard period '{ARCHIVE_SHARD_PERIOD}', using 'day'")
+            self.period = ARCHIVE_SHARD_PERIOD if ARCHIVE_SHARD_PERIOD in SHARD_PERIODS_MS else "day"
+            if ARCHIVE_LAYOUT not in ARCHIVE_LAYOUTS:
+                warn(f"[ARCHIVE] Unknown archive layout '{ARCHIVE_LAYOUT}', using 'blob'")
+            self.layout = ARCHIVE_LAYOUT if ARCHIVE_LAYOUT in ARCHIVE_LAYOUTS else "blob"
+            self.normalized_shards: set[str] = set()
+            self.block_shards: set[str] = set()
+            self.write_counts: dict[str, int] = {}
+            self.key_ids: dict[str, dict[str, int]] = {}
+            self.connection_users: dict[str, int] = {}
+            self.shards_path = utils.paths.GATEWAY_ARCHIVE_SHARDS_PATH
+            self.lock = RLock()
+            # notified when a connection is no longer in use
+            self.connection_released = Condition(self.lock)
+            self.shards: dict[str, ArchiveShard] = {}
+            self.connections: dict[str, sqlite.SqliteConnection] = {}
+            self.last_write_shard: Optional[ArchiveShard] = None
+            os.makedirs(self.shards_path, exist_ok=True)
+            self.scan_shards()
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(GatewayArchive, cls).__new__(cls)
+
+    def scan_shards(self) -> None:
+        """Discover the shard files on disk."""
+        with self.lock:
+            self.shards = {}
+            if os.path.isfile(utils.paths.GATEWAY_ARCHIVE_DB_PATH):
+                self.shards[utils.paths.GATEWAY_ARCHIVE_DB_PATH] = ArchiveShard(
+                    utils.paths.GATEWAY_ARCHIVE_DB_PATH, LEGACY_SHARD_START_MS, LEGACY_SHARD_END_MS, legacy=True)
+            for file_name in os.listdir(self.shards_path):
+                match = SHARD_FILE_PATTERN.match(file_name)
+                if match is None:
+                    continue
+                period, start_date = match.groups()
+                start_ms = int(datetime.strptime(start_date, "%Y%m%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+                path = os.path.join(self.shards_path, file_name)
+                self.shards[path] = ArchiveShard(path, start_ms, start_ms + SHARD_PERIODS_MS[period])
+            debug(f"[ARCHIVE] Found {len(self.shards)} archive shards")
+
+    def get_shards(self, start_timestamp_ms: int = LEGACY_SHARD_START_MS - 1,
+                   end_timestamp_ms: int = LEGACY_SHARD_END_MS) -> list[ArchiveShard]:
+        """Return the shards overlapping a time range, legacy shard first, then by period.
+
+        Args:
+          start_timestamp_ms: Exclusive start of the range.
+          end_timestamp_ms: Exclusive end of the range.
+        """
+        with self.lock:
+            return sorted((shard for shard in self.shards.values() if shard.overlaps(start_timestamp_ms, end_timestamp_ms)),
+                          key=lambda shard: shard.position_key())
+
+    def get_connection(self, shard: ArchiveShard) -> sqlite.SqliteConnection:
+        """Return an open connection to a shard, creating its table if necessary."""
+        with self.lock:
+            if shard.path not in self.connections:
+                connection = sqlite.SqliteConnection(shard.path)
+                connection.execute(CREATE_CONTROLLER_ARCHIVE_TABLE_QUERY)
+                connection.execute(CREATE_CONTROLLER_ARCHIVE_INDEX_QUERY)
+                if self.layout == "normalized":
+                    for query in (CREATE_ARCHIVE_KEYS_TABLE_QUERY, CREATE_CONTROLLER_ARCHIVE_VALUES_TABLE_QUERY,
+                                  CREATE_CONTROLLER_ARCHIVE_VALUES_INDEX_QUERY, CREATE_CONTROLLER_ARCHIVE_JSON_INDEX_QUERY,
+                                  CREATE_CONTROLLER_ARCHIVE_VALUES_DELETE_TRIGGER_QUERY):
+                        connection.execute(query)
+                if self.layout == "compressed":
+                    for query in (CREATE_ARCHIVE_KEYS_TABLE_QUERY, CREATE_ARCHIVE_BLOCKS_TABLE_QUERY,
+                                  CREATE_ARCHIVE_BLOCK_SERIES_TABLE_QUERY):
+                        connection.execute(query)
+                if connection.does_table_exist("controller_archive_values"):
+                    self.normalized_shards.add(shard.path)
+                if connection.does_table_exist("archive_blocks"):
+                    self.block_shards.add(shard.path)
+                self.connections[shard.path] = connection
+            return self.connections[shard.path]
+
+    @contextmanager
+    def use_connection(self, shard: ArchiveShard) -> Iterator[sqlite.SqliteConnection]:
+        """Return a connection to a shard which is not closed until the block is left.
+
+        Methods which use a connection without holding :attr:`lock` for the whole
+        operation must use it within this block.
+        """
+        with self.lock:
+            self.connection_users[shard.path] = self.connection_users.get(shard.path, 0) + 1
+            connection = self.get_connection(shard)
+        try:
+            yield connection
+        finally:
+            with self.lock:
+                self.connection_users[shard.path] -= 1
+                if self.connection_users[shard.path] == 0:
+                    del self.connection_users[shard.path]
+                    self.connection_released.notify_all()
+
+    def close_connection(self, path: str) -> None:
+        """Close the connection to a shard which is not in use. Must hold :attr:`lock`."""
+        connection = self.connections.pop(path, None)
+        if connection is not None:
+            # wait for a write still holding the connection, later calls find it unavailable
+            with connection.write_lock:
+                connection.db_unavailable = True
+                connection.close()
+        self.normalized_shards.discard(path)
+        self.block_shards.discard(path)
+        self.key_ids.pop(path, None)
+
+    def get_key_ids(self, shard: ArchiveShard, keys: set[str]) -> dict[str, int]:
+        """Return the ids of keys in a normalized shard's key dictionary, adding missing keys."""
+        with self.lock:
+            key_ids = self.key_ids.setdefault(shard.path, {})
+            missing_keys = [key for key in keys if key not in key_ids]
+            if len(missing_keys) > 0:
+                connection = self.get_connection(shard)
+                connection.execute_batch([
+                    ("INSERT OR IGNORE INTO archive_keys (key) VALUES (?)", [(key,) for key in missing_keys])])
+                rows = connection.execute("SELECT id, key FROM archive_keys WHERE key IN (SELECT value FROM json_each(?))",
+                                          (json.dumps(missing_keys),))
+                key_ids.update({key: key_id for key_id, key in (row for row in rows or [] if len(row) == 2)})
+            return key_ids
+
+    def get_value_rows(self, shard: ArchiveShard, messages: Sequence[tuple[int, int, str]]) -> Optional[list[tuple]]:
+        """Split messages into rows of ``controller_archive_values``.
+
+        Args:
+          messages: ``(message_id, timestamp_ms, message)`` tuples.
+
+        Returns:
+          The value rows, or ``None`` if a message is no JSON object (it has to
+          be kept as JSON then).
+        """
+        parsed_messages: list[tuple[int, int, dict]] = []
+        for message_id, timestamp_ms, message in messages:
+            try:
+                values = json.loads(message)
+            except ValueError:
+                return None
+            if type(values) is not dict:
+                return None
+            parsed_messages.append((message_id, timestamp_ms, values))
+        key_ids = self.get_key_ids(shard, {key for _, _, values in parsed_messages for key in values})
+        return [
+            (message_id, key_ids[key], timestamp_ms, *encode_value(value))
+            for message_id, timestamp_ms, values in parsed_messages for key, value in values.items()
+        ]
+
+    def load_normalized_messages(self, connection: sqlite.SqliteConnection,
+                                 messages: list[tuple[int, int, Optional[str]]]) -> list[tuple[int, int, str]]:
+        """Fill in the JSON of messages stored in the normalized layout.
+
+        Args:
+          connection: Connection to the messages' shard.
+          messages: ``(message_id, timestamp_ms, message)`` tuples, ``message``
+            being ``None`` for normalized messages.
+
+        Returns:
+          The messages with the JSON of all values.
+        """
+        normalized_ids = [message_id for message_id, _, message in messages if message is None]
+        if len(normalized_ids) == 0:
+            return messages  # type: ignore[return-value]
+        values_by_id: dict[int, dict[str, Any]] = {message_id: {} for message_id in normalized_ids}
+        rows = connection.execute(
+            """SELECT v.message_id, k.key, v.int_value, v.real_value, v.json_value
+            FROM controller_archive_values v JOIN archive_keys k ON k.id = v.key_id
+            WHERE v.message_id IN (SELECT value FROM json_each(?)) ORDER BY v.message_id, v.key_id""",
+            (json.dumps(normalized_ids),))
+        for message_id, key, int_value, real_value, json_value in (row for row in rows or [] if len(row) == 5):
+            values_by_id[message_id][key] = decode_value(int_value, real_value, json_value)
+        return [(message_id, timestamp_ms, message if message is not None else json.dumps(values_by_id[message_id]))
+                for message_id, timestamp_ms, message in messages]
+
+    def get_write_shard(self, timestamp_ms: int) -> ArchiveShard:
+        """Return the shard new messages with the given timestamp are written to."""
+        shard = self.last_write_shard
+        if shard is not None and shard.start_ms <= timestamp_ms < shard.end_ms and shard.path in self.shards:
+            return shard
+        start_ms = shard_start_ms(timestamp_ms, self.period)
+        with self.lock:
+            for shard in self.shards.values():
+                if not shard.legacy and shard.start_ms <= timestamp_ms < shard.end_ms:
+                    self.last_write_shard = shard
+                    return shard
+            path = os.path.join(self.shards_path, shard_file_name(start_ms, self.period))
+            shard = ArchiveShard(path, start_ms, start_ms + SHARD_PERIODS_MS[self.period])
+            self.shards[path] = shard
+            self.last_write_shard = shard
+            info(f"[ARCHIVE] Creating archive shard '{path}'")
+            return shard
+
+    def insert_many(self, rows: Sequence[tuple[int, str]]) -> bool:
+        """Write messages to their shards, with one transaction per shard.
+
+        Args:
+          rows: ``(timestamp_ms, message)`` tuples.
+
+        Returns:
+          ``True`` if all messages were written, otherwise ``False``.
+        """
+        rows_by_shard: dict[str, list[tuple[int, str]]] = {}
+        shards_by_path: dict[str, ArchiveShard] = {}
+        for timestamp_ms, message in rows:
+            shard = self.get_write_shard(timestamp_ms)
+            shards_by_path[shard.path] = shard
+            rows_by_shard.setdefault(shard.path, []).append((timestamp_ms, message))
+
+        success = True
+        for path, shard_rows in rows_by_shard.items():
+            self.write_counts[path] = self.write_counts.get(path, 0) + 1
+            if self.layout == "normalized":
+                success = self.insert_normalized(shards_by_path[path], shard_rows) and success
+            else:
+                with self.use_connection(shards_by_path[path]) as connection:
+                    success = connection.execute_batch([
+                        ("INSERT INTO controller_archive (timestamp_ms, message) VALUES (?, ?)", shard_rows),
+                    ]) and success
+            self.release_connection(shards_by_path[path])
+        return success
+
+    def insert_normalized(self, shard: ArchiveShard, rows: Sequence[tuple[int, str]]) -> bool:
+        """Write messages to a shard in the normalized layout, within one transaction."""
+        with self.lock:
+            connection = self.get_connection(shard)
+            # the message ids are assigned here, so the value rows can reference them
+            result = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'controller_archive'")
+            last_id = result[0][0] if result and len(result[0]) > 0 else 0
+            messages = [(last_id + index + 1, timestamp_ms, message) for index, (timestamp_ms, message) in enumerate(rows)]
+            value_rows = self.get_value_rows(shard, messages)
+            if value_rows is None:
+                return connection.execute_batch([
+                    ("INSERT INTO controller_archive (timestamp_ms, message) VALUES (?, ?)", rows),
+                ])
+            return connection.execute_batch([
+                ("INSERT INTO controller_archive (id, timestamp_ms, message) VALUES (?, ?, NULL)",
+                 [(message_id, timestamp_ms) for message_id, timestamp_ms, _ in messages]),
+                ("""INSERT INTO controller_archive_values
+                    (message_id, key_id, timestamp_ms, int_value, real_value, json_value) VALUES (?, ?, ?, ?, ?, ?)""",
+                 value_rows),
+            ])
+
+    def iter_messages(self, start_timestamp_ms: int, end_timestamp_ms: int, page_size: int = 200,
+                      after: Optional["ArchivePosition"] = None) -> Generator[tuple["ArchivePosition", str], None, None]:
+        """Iterate over the archived messages within a time range.
+
+        Pages are fetched with keyset pagination on ``(timestamp_ms, id)``, so
+        messages sharing a timestamp are neither skipped nor repeated.
+
+        Args:
+          start_timestamp_ms: Exclusive start of the range.
+          end_timestamp_ms: Exclusive end of the range.
+          page_size: Number of messages fetched per query.
+          after: Resume after this position, as yielded by a previous iteration.
+
+        Yields:
+          ``(position, message)`` tuples, ``message`` being the archived values JSON.
+        """
+        for shard in self.get_shards(start_timestamp_ms, end_timestamp_ms):
+            shard_key = shard.position_key()
+            if after is not None and shard_key < after.shard_key:
+                continue
+            try:
+                with self.use_connection(shard) as connection:
+                    yield from self.iter_shard_messages(shard, connection, start_timestamp_ms, end_timestamp_ms,
+                                                        page_size, after)
+            finally:
+                self.release_connection(shard)
+
+    def iter_shard_messages(self, shard: ArchiveShard, connection: sqlite.SqliteConnection, start_timestamp_ms: int,
+                            end_timestamp_ms: int, page_size: int,
+                            after: Optional["ArchivePosition"]) -> Generator[tuple["ArchivePosition", str], None, None]:
+        """Iterate over the archived messages of one shard, see :meth:`iter_messages`."""
+        shard_key = shard.position_key()
+        last_key = (start_timestamp_ms, 2**63 - 1)
+        if after is not None and shard_key == after.shard_key:
+            last_key = max(last_key, (after.timestamp_ms, after.message_id))
+        rows: Iterable[tuple[int, int, str]] = self.iter_shard_rows(shard, connection, last_key, end_timestamp_ms, page_size)
+        if shard.path in self.block_shards:
+            rows = heapq.merge(rows, self.iter_shard_block_rows(shard, connection, last_key, end_timestamp_ms),
+                               key=lambda row: row[:2])
+        for timestamp_ms, message_id, message in rows:
+            yield ArchivePosition(shard_key, timestamp_ms, message_id), message
+
+    def iter_shard_rows(self, shard: ArchiveShard, connection: sqlite.SqliteConnection, last_key: tuple[int, int],
+                        end_timestamp_ms: int, page_size: int) -> Generator[tuple[int, int, str], None, None]:
+        """Iterate over the ``(timestamp_ms, id, message)`` rows of ``controller_archive`` after ``last_key``."""
+        # stop if the shard was removed in the meantime
+        while self.connections.get(shard.path) is connection:
+            messages = connection.execute(
+                """SELECT id, timestamp_ms, message FROM controller_archive
+                WHERE (timestamp_ms, id) > (?, ?) AND timestamp_ms < ?
+                ORDER BY timestamp_ms, id LIMIT ?""",
+                (last_key[0], last_key[1], end_timestamp_ms, page_size))
+            messages = [message for message in messages or [] if len(message) == 3]
+            if shard.path in self.normalized_shards:
+                messages = self.load_normalized_messages(connection, messages)
+            for message_id, timestamp_ms, message in messages:
+                yield timestamp_ms, message_id, message
+            if len(messages) < page_size:
+                break
+            last_key = (messages[-1][1], messages[-1][0])
+
+    def iter_shard_block_rows(self, shard: ArchiveShard, connection: sqlite.SqliteConnection, last_key: tuple[int, int],
+                              end_timestamp_ms: int) -> Generator[tuple[int, int, str], None, None]:
+        """Iterate over the ``(timestamp_ms, id, message)`` rows of the blocks after ``last_key``.
+
+        The messages of a block are numbered with negative ids, counting up to ``-1``.
+        """
+        for block_start_ms, _, _ in self.get_blocks(connection, last_key[0] - 1, end_timestamp_ms):
+            if self.connections.get(shard.path) is not connection:
+                return
+            messages = self.load_block(connection, block_start_ms)
+            for index, (timestamp_ms, values) in enumerate(messages):
+                message_id = index - len(messages)
+                if (timestamp_ms, message_id) > last_key and timestamp_ms < end_timestamp_ms:
+                    yield timestamp_ms, message_id, json.dumps(values)
+
+    def iter_key_values(self, key: str, start_timestamp_ms: int, end_timestamp_ms: int,
+                        page_size: int = 1000) -> Generator[tuple[int, Any], None, None]:
+        """Iterate over the archived values of a single key within a time range.
+
+        In normalized shards, only the rows of the key and the messages still
+        stored as JSON are read. The values are ordered by timestamp within
+        each layout of a shard, but not across layouts.
+
+        Args:
+          key: Value key.
+          start_timestamp_ms: Exclusive start of the range.
+          end_timestamp_ms: Exclusive end of the range.
+          page_size: Number of rows fetched per query.
+
+        Yields:
+          ``(timestamp_ms, value)`` tuples.
+        """
+        for shard in self.get_shards(start_timestamp_ms, end_timestamp_ms):
+            try:
+                with self.use_connection(shard) as connection:
+                    yield from self.iter_shard_key_values(shard, connection, key, start_timestamp_ms,
+                                                          end_timestamp_ms, page_size)
+            finally:
+                self.release_connection(shard)
+
+    def iter_shard_key_values(self, shard: ArchiveShard, connection: sqlite.SqliteConnection, key: str,
+                              start_timestamp_ms: int, end_timestamp_ms: int,
+                              page_size: int) -> Generator[tuple[int, Any], None, None]:
+        """Iterate over the archived values of a single key in one shard, see :meth:`iter_key_values`."""
+        if shard.path in self.normalized_shards:
+            last_key = (start_timestamp_ms, 2**63 - 1)
+            while self.connections.get(shard.path) is connection:
+                rows = connection.execute(
+                    """SELECT v.message_id, v.timestamp_ms, v.int_value, v.real_value, v.json_value
+                    FROM controller_archive_values v
+                    WHERE v.key_id = (SELECT id FROM archive_keys WHERE key = ?)
+                    AND (v.timestamp_ms, v.message_id) > (?, ?) AND v.timestamp_ms < ?
+                    ORDER BY v.timestamp_ms, v.message_id LIMIT ?""",
+                    (key, last_key[0], last_key[1], end_timestamp_ms, page_size))
+                rows = [row for row in rows or [] if len(row) == 5]
+                for _, timestamp_ms, int_value, real_value, json_value in rows:
+                    yield timestamp_ms, decode_value(int_value, real_value, json_value)
+                if len(rows) < page_size:
+                    break
+                last_key = (rows[-1][1], rows[-1][0])
+
+        if shard.path in self.block_shards:
+            blocks = connection.execute(
+                """SELECT b.message_count, b.timestamps, s.encoding, s.presence, s.data
+                FROM archive_blocks b JOIN archive_block_series s ON s.block_start_timestamp_ms = b.start_timestamp_ms
+                WHERE s.key_id = (SELECT id FROM archive_keys WHERE key = ?)
+                AND b.start_timestamp_ms < ? AND b.end_timestamp_ms > ? ORDER BY b.start_timestamp_ms""",
+                (key, end_timestamp_ms, start_timestamp_ms + 1))
+            for message_count, timestamps, encoding, presence, data in (block for block in blocks or [] if len(block) == 5):
+                try:
+                    key_values = archive_blocks.decode_key_values(timestamps, message_count, encoding, presence, data)
+                except ValueError as e:
+                    warn(f"[ARCHIVE] Failed to decode archive block series of '{key}': {e}")
+                    continue
+                for timestamp_ms, value in key_values:
+                    if start_timestamp_ms < timestamp_ms < end_timestamp_ms:
+                        yield timestamp_ms, value
+
+        # messages stored as JSON, found via the partial index in normalized shards
+        last_key = (start_timestamp_ms, 2**63 - 1)
+        while self.connections.get(shard.path) is connection:
+            messages = connection.execute(
+                """SELECT id, timestamp_ms, message FROM controller_archive
+                WHERE message IS NOT NULL AND (timestamp_ms, id) > (?, ?) AND timestamp_ms < ?
+                ORDER BY timestamp_ms, id LIMIT ?""",
+                (last_key[0], last_key[1], end_timestamp_ms, page_size))
+            messages = [message for message in messages or [] if len(message) == 3]
+            for _, timestamp_ms, message in messages:
+                try:
+                    values = json.loads(message)
+                except ValueError:
+                    continue
+                if type(values) is dict and key in values:
+                    yield timestamp_ms, values[key]
+            if len(messages) < page_size:
+                break
+            last_key = (messages[-1][1], messages[-1][0])
+
+    def migrate_to_normalized(self, shard: ArchiveShard, after_key: tuple[int, int],
+                              max_count: int) -> tuple[int, Optional[tuple[int, int]]]:
+        """Move messages of a shard stored as JSON to the normalized layout.
+
+        Args:
+          shard: Shard to migrate.
+          after_key: ``(timestamp_ms, id)`` of the last message visited by the previous call.
+          max_count: Maximum number of messages visited in this call.
+
+        Returns:
+          The number of migrated messages and the key to continue after, or
+          ``None`` as key when all messages were visited.
+        """
+        with self.use_connection(shard) as connection:
+            return self.migrate_shard_to_normalized(shard, connection, after_key, max_count)
+
+    def migrate_shard_to_normalized(self, shard: ArchiveShard, connection: sqlite.SqliteConnection,
+                                    after_key: tuple[int, int],
+                                    max_count: int) -> tuple[int, Optional[tuple[int, int]]]:
+        """Move messages of a shard stored as JSON to the normalized layout, see :meth:`migrate_to_normalized`."""
+        messages = connection.execute(
+            """SELECT id, timestamp_ms, message FROM controller_archive
+            WHERE message IS NOT NULL AND (timestamp_ms, id) > (?, ?)
+            ORDER BY timestamp_ms, id LIMIT ?""", (after_key[0], after_key[1], max_count))
+        messages = [message for message in messages or [] if len(message) == 3]
+        if len(messages) == 0:
+            return 0, None
+        next_key = (messages[-1][1], messages[-1][0])
+
+        migrated_messages = [(message[0],) for message in messages]
+        value_rows = self.get_value_rows(shard, messages)
+        if value_rows is None:
+            # messages which are no JSON object stay as they are
+            migrated_messages, value_rows = [], []
+            for message in messages:
+                message_value_rows = self.get_value_rows(shard, [message])
+                if message_value_rows is not None:
+                    migrated_messages.append((message[0],))
+                    value_rows.extend(message_value_rows)
+        if len(migrated_messages) > 0 and not connection.execute_batch([
+                ("""INSERT OR REPLACE INTO controller_archive_values
+                    (message_id, key_id, timestamp_ms, int_value, real_value, json_value) VALUES (?, ?, ?, ?, ?, ?)""",
+                 value_rows),
+                ("UPDATE controller_archive SET message = NULL WHERE id = ?", migrated_messages),
+        ]):
+            return 0, None
+        return len(migrated_messages), next_key
+
+    def get_blocks(self, connection: sqlite.SqliteConnection, start_timestamp_ms: int,
+                   end_timestamp_ms: int) -> list[tuple[int, int, int]]:
+        """Return the ``(start_ms, end_ms, message_count)`` of the blocks overlapping a range (exclusive bounds)."""
+        blocks = connection.execute(
+            """SELECT start_timestamp_ms, end_timestamp_ms, message_count FROM archive_blocks
+            WHERE start_timestamp_ms < ? AND end_timestamp_ms > ? ORDER BY start_timestamp_ms""",
+            (end_timestamp_ms, start_timestamp_ms + 1))
+        return [block for block in blocks or [] if len(block) == 3]
+
+    def load_block(self, connection: sqlite.SqliteConnection, block_start_ms: int) -> list[tuple[int, dict[str, Any]]]:
+        """Decode the ``(timestamp_ms, values)`` messages of a block, an empty list if it does not exist."""
+        block = connection.execute(
+            "SELECT message_count, timestamps FROM archive_blocks WHERE start_timestamp_ms = ?", (block_start_ms,))
+        if not block or len(block[0]) != 2:
+            return []
+        series = connection.execute(
+            """SELECT k.key, s.encoding, s.presence, s.data
+            FROM archive_block_series s JOIN archive_keys k ON k.id = s.key_id
+            WHERE s.block_start_timestamp_ms = ? ORDER BY s.key_id""", (block_start_ms,))
+        try:
+            return archive_blocks.decode_block(block[0][1], block[0][0], [row for row in series or [] if len(row) == 4])
+        except ValueError as e:
+            warn(f"[ARCHIVE] Failed to decode archive block {block_start_ms} of '{connection.path}': {e}")
+            return []
+
+    def get_block_operations(self, shard: ArchiveShard, block_start_ms: int,
+                             messages: Sequence[tuple[int, dict[str, Any]]]) -> list[tuple[str, Sequence[Any]]]:
+        """Return the SQL operations replacing a block by ``messages`` (deleting it if there are none)."""
+        operations: list[tuple[str, Sequence[Any]]] = [
+            ("DELETE FROM archive_blocks WHERE start_timestamp_ms = ?", [(block_start_ms,)]),
+            ("DELETE FROM archive_block_series WHERE block_start_timestamp_ms = ?", [(block_start_ms,)]),
+        ]
+        if len(messages) == 0:
+            return operations
+        timestamps, series = archive_blocks.encode_block(messages)
+        key_ids = self.get_key_ids(shard, set(series))
+        operations.append((
+            "INSERT INTO archive_blocks (start_timestamp_ms, end_timestamp_ms, message_count, timestamps) VALUES (?, ?, ?, ?)",
+            [(block_start_ms, block_start_ms + ARCHIVE_BLOCK_PERIOD_MS, len(messages), timestamps)]))
+        if len(series) > 0:
+            operations.append((
+                """INSERT INTO archive_block_series (block_start_timestamp_ms, key_id, encoding, presence, data)
+                VALUES (?, ?, ?, ?, ?)""",
+                [(block_start_ms, key_ids[key], encoding, presence, data)
+                 for key, (encoding, presence, data) in series.items()]))
+        return operations
+
+    def get_next_block_start(self, shard: ArchiveShard, start_timestamp_ms: int) -> Optional[int]:
+        """Return the start of the first block period with messages in ``controller_archive`` from ``start_timestamp_ms`` on."""
+        with self.use_connection(shard) as connection:
+            result = connection.execute(
+                "SELECT MIN(timestamp_ms) FROM controller_archive WHERE timestamp_ms >= ?", (start_timestamp_ms,))
+        if not result or len(result[0]) == 0 or result[0][0] is None:
+            return None
+        return int(result[0][0]) // ARCHIVE_BLOCK_PERIOD_MS * ARCHIVE_BLOCK_PERIOD_MS
+
+    def seal_block(self, shard: ArchiveShard, block_start_ms: int) -> int:
+        """Move the messages of a block period from ``controller_archive`` into its compressed block.
+
+        Messages already in the block are kept, so messages arriving late are
+        merged into it. Messages which are no JSON object stay in
+        ``controller_archive``.
+
+        Returns:
+          Number of moved messages.
+        """
+        with self.lock:
+            connection = self.get_connection(shard)
+            rows = connection.execute(
+                """SELECT id, timestamp_ms, message FROM controller_archive
+                WHERE timestamp_ms >= ? AND timestamp_ms < ? ORDER BY timestamp_ms, id""",
+                (block_start_ms, block_start_ms + ARCHIVE_BLOCK_PERIOD_MS))
+            rows = [row for row in rows or [] if len(row) == 3]
+            if shard.path in self.normalized_shards:
+                rows = self.load_normalized_messages(connection, rows)
+            sealed_ids: list[tuple[int]] = []
+            sealed_messages: list[tuple[int, dict[str, Any]]] = []
+            for message_id, timestamp_ms, message in rows:
+                try:
+                    values = json.loads(message)
+                except ValueError:
+                    continue
+                if type(values) is dict:
+                    sealed_ids.append((message_id,))
+                    sealed_messages.append((timestamp_ms, values))
+            if len(sealed_ids) == 0:
+                return 0
+            messages = sorted(self.load_block(connection, block_start_ms) + sealed_messages, key=lambda message: message[0])
+            if not connection.execute_batch([
+                *self.get_block_operations(shard, block_start_ms, messages),
+                ("DELETE FROM controller_archive WHERE id = ?", sealed_ids),
+            ]):
+                return 0
+            return len(sealed_ids)
+
+    def count_block_messages(self, connection: sqlite.SqliteConnection, start_timestamp_ms: int,
+                             end_timestamp_ms: int) -> int:
+        """Return the number of messages in blocks within a time range (exclusive bounds)."""
+        message_count = 0
+        for block_start_ms, block_end_ms, block_message_count in self.get_blocks(connection, start_timestamp_ms,
+                                                                                 end_timestamp_ms):
+            if start_timestamp_ms < block_start_ms and block_end_ms - 1 < end_timestamp_ms:
+                message_count += block_message_count
+                continue
+            messages = self.load_block(connection, block_start_ms)
+            message_count += sum(1 for timestamp_ms, _ in messages if start_timestamp_ms < timestamp_ms < end_timestamp_ms)
+        return message_count
+
+    def count_messages(self, start_timestamp_ms: int, end_timestamp_ms: int) -> int:
+        """Return the number of archived messages within a time range (exclusive bounds)."""
+        message_count = 0
+        for shard in self.get_shards(start_timestamp_ms, end_timestamp_ms):
+            with self.use_connection(shard) as connection:
+                result = connection.execute(
+                    "SELECT COUNT(*) FROM controller_archive WHERE timestamp_ms > ? AND timestamp_ms < ?",
+                    (start_timestamp_ms, end_timestamp_ms))
+                message_count += result[0][0] if result and len(result[0]) > 0 else 0
+                if shard.path in self.block_shards:
+                    message_count += self.count_block_messages(connection, start_timestamp_ms, end_timestamp_ms)
+            self.release_connection(shard)
+        return message_count
+
+    def discard(self, start_timestamp_ms: int, end_timestamp_ms: int) -> int:
+        """Delete the archived messages within a time range.
+
+        Shards whose period lies entirely within the range are unlinked, the
+        others are cleaned up with an indexed delete.
+
+        Args:
+          start_timestamp_ms: Exclusive start of the range.
+          end_timestamp_ms: Exclusive end of the range.
+
+        Returns:
+          Number of discarded messages.
+        """
+        discarded_count = 0
+        for shard in self.get_shards(start_timestamp_ms, end_timestamp_ms):
+            if shard.is_covered_by(start_timestamp_ms, end_timestamp_ms):
+                discarded_count += self.message_count(shard)
+                self.remove_shard(shard)
+                continue
+            with self.use_connection(shard) as connection:
+                range_query = "FROM controller_archive WHERE timestamp_ms > ? AND timestamp_ms < ?"
+                result = connection.execute(f"SELECT COUNT(*) {range_query}", (start_timestamp_ms, end_timestamp_ms))
+                shard_count = result[0][0] if result and len(result[0]) > 0 else 0
+                if shard_count > 0:
+                    connection.execute_batch([(f"DELETE {range_query}", [(start_timestamp_ms, end_timestamp_ms)])])
+                    discarded_count += shard_count
+                if shard.path in self.block_shards:
+                    discarded_count += self.discard_block_messages(shard, start_timestamp_ms, end_timestamp_ms)
+            self.release_connection(shard)
+        return discarded_count
+
+    def discard_block_messages(self, shard: ArchiveShard, start_timestamp_ms: int, end_timestamp_ms: int) -> int:
+        """Delete the messages in blocks within a time range (exclusive bounds), see :meth:`discard`."""
+        discarded_count = 0
+        with self.lock:
+            connection = self.get_connection(shard)
+            for block_start_ms, _, block_message_count in self.get_blocks(connection, start_timestamp_ms, end_timestamp_ms):
+                messages = self.load_block(connection, block_start_ms)
+                kept_messages = [message for message in messages
+                                 if not start_timestamp_ms < message[0] < end_timestamp_ms]
+                if len(kept_messages) < len(messages) or len(messages) == 0:
+                    if connection.execute_batch(self.get_block_operations(shard, block_start_ms, kept_messages)):
+                        discarded_count += len(messages) - len(kept_messages) if len(messages) > 0 else block_message_count
+        return discarded_count
+
+    def message_count(self, shard: ArchiveShard) -> int:
+        """Return the number of messages in a shard."""
+        with self.use_connection(shard) as connection:
+            result = connection.execute("SELECT COUNT(*) FROM controller_archive")
+            message_count = result[0][0] if result and len(result[0]) > 0 else 0
+            if shard.path in self.block_shards:
+                result = connection.execute("SELECT COALESCE(SUM(message_count), 0) FROM archive_blocks")
+                message_count += result[0][0] if result and len(result[0]) > 0 else 0
+        return message_count
+
+    def shard_size_bytes(self, shard: ArchiveShard) -> int:
+        """Return the disk usage of a shard, including its write-ahead log."""
+        with self.lock:
+            connection = self.connections.get(shard.path)
+            if connection is not None:
+                # the file size lags behind deletes until the next checkpoint
+                return connection.used_bytes()
+        size_bytes = 0
+        for path in (shard.path, shard.path + "-wal"):
+            try:
+                size_bytes += os.path.getsize(path)
+            except OSError:
+                pass
+        return size_bytes
+
+    def size_bytes(self) -> int:
+        """Return the disk usage of all shards."""
+        return sum(self.shard_size_bytes(shard) for shard in self.get_shards())
+
+    def delete_oldest(self, shard: ArchiveShard, before_timestamp_ms: int, max_count: int) -> int:
+        """Delete the oldest messages of a shard, up to a timestamp.
+
+        Args:
+          shard: Shard to delete from.
+          before_timestamp_ms: Only delete messages older than this.
+          max_count: Maximum number of messages deleted in this call.
+
+        Returns:
+          Number of deleted messages.
+        """
+        deleted_count = 0
+        if shard.path in self.block_shards:
+            deleted_count = self.delete_oldest_block_messages(shard, before_timestamp_ms, max_count)
+        if deleted_count >= max_count:
+            return deleted_count
+        with self.use_connection(shard) as connection:
+            result = connection.execute(
+                """DELETE FROM controller_archive WHERE id IN (
+                    SELECT id FROM controller_archive WHERE timestamp_ms < ? ORDER BY timestamp_ms, id LIMIT ?
+                ) RETURNING id""", (before_timestamp_ms, max_count - deleted_count))
+        return deleted_count + len([row for row in result or [] if len(row) == 1])
+
+    def delete_oldest_block_messages(self, shard: ArchiveShard, before_timestamp_ms: int, max_count: int) -> int:
+        """Delete the oldest messages in blocks, see :meth:`delete_oldest`."""
+        deleted_count = 0
+        with self.lock:
+            connection = self.get_connection(shard)
+            for block_start_ms, _, _ in self.get_blocks(connection, LEGACY_SHARD_START_MS - 1, before_timestamp_ms):
+                if deleted_count >= max_count:
+                    break
+                messages = self.load_block(connection, block_start_ms)
+                deleted_messages = [message for message in messages if message[0] < before_timestamp_ms]
+                deleted_messages = deleted_messages[:max_count - deleted_count]
+                if len(deleted_messages) == 0 and len(messages) > 0:
+                    break
+                if connection.execute_batch(
+                        self.get_block_operations(shard, block_start_ms, messages[len(deleted_messages):])):
+                    deleted_count += len(deleted_messages)
+        return deleted_count
+
+    def compact(self, shard: ArchiveShard) -> None:
+        """Write the write-ahead log of a shard back and truncate it, releasing freed disk space."""
+        with self.use_connection(shard) as connection:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def downsample(self, shard: ArchiveShard, start_timestamp_ms: int, end_timestamp_ms: int, interval_ms: int) -> int:
+        """Thin out the messages of a shard within ``[start_timestamp_ms, end_timestamp_ms)``.
+
+        Only the first message per interval is kept for each set of value keys,
+        so messages of different kinds are thinned out independently.
+
+        Returns:
+          Number of deleted messages.
+        """
+        with self.use_connection(shard) as connection:
+            messages = connection.execute(
+                """SELECT id, timestamp_ms, message FROM controller_archive
+                WHERE timestamp_ms >= ? AND timestamp_ms < ? ORDER BY timestamp_ms, id""",
+                (start_timestamp_ms, end_timestamp_ms))
+            messages = [message for message in messages or [] if len(message) == 3]
+            if shard.path in self.normalized_shards:
+                messages = self.load_normalized_messages(connection, messages)
+            # (timestamp_ms, id, value keys) of all messages, blocks are rewritten with their kept messages
+            entries: list[tuple[int, int, frozenset[str]]] = []
+            for message_id, timestamp_ms, message in messages:
+                try:
+                    value_keys = frozenset(json.loads(message).keys())
+                except (ValueError, TypeError, AttributeError):
+                    value_keys = frozenset()
+                entries.append((timestamp_ms, message_id, value_keys))
+            with self.lock:
+                blocks: dict[int, list[tuple[int, dict[str, Any]]]] = {}
+                if shard.path in self.block_shards:
+                    for block_start_ms, _, _ in self.get_blocks(connection, start_timestamp_ms - 1, end_timestamp_ms):
+                        blocks[block_start_ms] = self.load_block(connection, block_start_ms)
+                        block_length = len(blocks[block_start_ms])
+                        for index, (timestamp_ms, values) in enumerate(blocks[block_start_ms]):
+                            if start_timestamp_ms <= timestamp_ms < end_timestamp_ms:
+                                # block messages are identified by their index, counting up to -1
+                                entries.append((timestamp_ms, index - block_length, frozenset(values.keys())))
+
+                kept_keys: set[tuple[int, frozenset[str]]] = set()
+                deleted_ids: list[tuple[int]] = []
+                deleted_block_messages: set[tuple[int, int]] = set()
+                for timestamp_ms, message_id, value_keys in sorted(entries, key=lambda entry: entry[:2]):
+                    bucket_key = (timestamp_ms // interval_ms, value_keys)
+                    if bucket_key not in kept_keys:
+                        kept_keys.add(bucket_key)
+                    elif message_id > 0:
+                        deleted_ids.append((message_id,))
+                    else:
+                        deleted_block_messages.add((timestamp_ms // ARCHIVE_BLOCK_PERIOD_MS * ARCHIVE_BLOCK_PERIOD_MS,
+                                                    message_id))
+
+                operations: list[tuple[str, Sequence[Any]]] = []
+                if len(deleted_ids) > 0:
+                    operations.append(("DELETE FROM controller_archive WHERE id = ?", deleted_ids))
+                for block_start_ms, block_messages in blocks.items():
+                    kept_messages = [message for index, message in enumerate(block_messages)
+                                     if (block_start_ms, index - len(block_messages)) not in deleted_block_messages]
+                    if len(kept_messages) < len(block_messages):
+                        operations.extend(self.get_block_operations(shard, block_start_ms, kept_messages))
+                if len(operations) > 0 and not connection.execute_batch(operations):
+                    return 0
+        return len(deleted_ids) + len(deleted_block_messages)
+
+    def get_downsampled_interval_ms(self, shard: ArchiveShard) -> Optional[int]:
+        """Return the interval a shard was downsampled to, if any."""
+        with self.use_connection(shard) as connection:
+            result = connection.execute("SELECT value FROM archive_metadata WHERE key = 'downsampled_interval_ms'")
+        if not result or len(result[0]) == 0:
+            return None
+        return result[0][0]
+
+    def set_downsampled_interval_ms(self, shard: ArchiveShard, interval_ms: int) -> None:
+        """Record that a shard was downsampled to the given interval."""
+        with self.use_connection(shard) as connection:
+            connection.execute_batch([
+                ("CREATE TABLE IF NOT EXISTS archive_metadata (key TEXT PRIMARY KEY, value INTEGER)", [()]),
+                ("INSERT OR REPLACE INTO archive_metadata (key, value) VALUES ('downsampled_interval_ms', ?)",
+                 [(interval_ms,)]),
+            ])
+
+    def remove_shard(self, shard: ArchiveShard) -> None:
+        """Close a shard and delete its files, once its connection is no longer in use.
+
+        The caller must not use the shard's connection itself.
+        """
+        with self.lock:
+            self.shards.pop(shard.path, None)
+            if self.last_write_shard is shard:
+                self.last_write_shard = None
+            self.connection_released.wait_for(lambda: shard.path not in self.connection_users)
+            self.close_connection(shard.path)
+            for path in (shard.path, shard.path + "-wal", shard.path + "-shm"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            info(f"[ARCHIVE] Removed archive shard '{shard.path}'")
+
+    def release_connection(self, shard: ArchiveShard) -> None:
+        """Close the connection to a shard unless it covers the current time."""
+        with self.lock:
+            now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+            if not shard.legacy and shard.start_ms <= now_ms < shard.end_ms:
+                return
+            if shard.path in self.connection_users:
+                return
+            self.close_connection(shard.path)
+
+    def wait_until_idle(self, timeout_s: float) -> bool:
+        """Wait until no statement is running on any open shard connection, see :meth:`sqlite.SqliteConnection.wait_until_idle`."""
+        return all(connection.wait_until_idle(timeout_s) for connection in list(self.connections.values()))
+
+    def close(self) -> None:
+        """Close all open shard connections."""
+        with self.lock:
+            for path in list(self.connections):
+                self.close_connection(path)
@@ -0,0 +1,312 @@
+"""Compressed block encoding of archived controller messages.
+
+Most archived values are slowly changing numbers sampled at a fixed rate, which
+cost 20-40 bytes each as JSON text. With ``TEG_ARCHIVE_LAYOUT=compressed`` (see
+:mod:`modules.archive`), the messages of a closed time window are packed into one
+block per window:
+
+- The message timestamps are stored once per block, as delta-of-deltas. A
+  constant sampling interval costs a single bit per message.
+- Every key is stored as a separate series aligned to the timestamps. Floats
+  are XOR-encoded against their previous value, integers as delta-of-deltas
+  (both as described for Facebook's Gorilla time series database), so an
+  unchanged value costs a single bit. Other values are stored as compressed
+  JSON.
+- If a key is missing in some messages of the block, a presence bitmap marks
+  the messages containing it.
+
+Decoding a block restores the messages exactly, including value types and
+messages sharing a timestamp.
+
+Notes
+-----
+- The bit packing is sequential by nature, so the codec is plain Python and has
+  no dependencies besides the standard library.
+"""
+
+import json
+import struct
+import zlib
+from typing import Any, Optional, Sequence
+
+# Encodings of a series
+SERIES_ENCODING_FLOAT: int = 0
+SERIES_ENCODING_INT: int = 1
+SERIES_ENCODING_JSON: int = 2
+
+# Delta-of-delta buckets: (prefix, prefix bit count, value bit count)
+DELTA_OF_DELTA_BUCKETS: list[tuple[int, int, int]] = [
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+]
+DELTA_OF_DELTA_FALLBACK: tuple[int, int, int] = (0b1111, 4, 64)
+
+
+class BitWriter:
+    """Append bit fields to a byte string."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.accumulator = 0
+        self.bit_count = 0
+
+    def write(self, value: int, bit_count: int) -> None:
+        """Append the lowest ``bit_count`` bits of ``value``."""
+        self.accumulator = (self.accumulator << bit_count) | (value & ((1 << bit_count) - 1))
+        self.bit_count += bit_count
+        while self.bit_count >= 8:
+            self.bit_count -= 8
+            self.data.append((self.accumulator >> self.bit_count) & 0xFF)
+        self.accumulator &= (1 << self.bit_count) - 1
+
+    def to_bytes(self) -> bytes:
+        """Return the written bits, padded with zeros to full bytes."""
+        if self.bit_count == 0:
+            return bytes(self.data)
+        return bytes(self.data) + bytes([(self.accumulator << (8 - self.bit_count)) & 0xFF])
+
+
+class BitReader:
+    """Read bit fields written by :class:`BitWriter`."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.position = 0
+
+    def read(self, bit_count: int) -> int:
+        """Read the next ``bit_count`` bits as unsigned integer.
+
+        Raises:
+          ValueError: If the data ends before.
+        """
+        if bit_count == 0:
+            return 0
+        if self.position + bit_count > len(self.data) * 8:
+            raise ValueError("block data is truncated")
+        start_byte = self.position >> 3
+        offset = self.position & 7
+        byte_count = (offset + bit_count + 7) >> 3
+        chunk = int.from_bytes(self.data[start_byte:start_byte + byte_count], "big")
+        self.position += bit_count
+        return (chunk >> (byte_count * 8 - offset - bit_count)) & ((1 << bit_count) - 1)
+
+
+def to_signed(value: int, bit_count: int) -> int:
+    """Interpret an unsigned bit field as two's complement number."""
+    return value - (1 << bit_count) if value >= 1 << (bit_count - 1) else value
+
+
+def encode_delta_of_deltas(values: Sequence[int]) -> bytes:
+    """Encode 64-bit integers as delta-of-deltas."""
+    writer = BitWriter()
+    previous_value = 0
+    previous_delta = 0
+    for index, value in enumerate(values):
+        if index == 0:
+            writer.write(value, 64)
+            previous_value = value
+            continue
+        delta = value - previous_value
+        delta_of_delta = delta - previous_delta
+        previous_value, previous_delta = value, delta
+        if delta_of_delta == 0:
+            writer.write(0, 1)
+            continue
+        for prefix, prefix_bit_count, value_bit_count in DELTA_OF_DELTA_BUCKETS:
+            if -(1 << (value_bit_count - 1)) <= delta_of_delta < 1 << (value_bit_count - 1):
+                break
+        else:
+            prefix, prefix_bit_count, value_bit_count = DELTA_OF_DELTA_FALLBACK
+        writer.write(prefix, prefix_bit_count)
+        writer.write(delta_of_delta, value_bit_count)
+    return writer.to_bytes()
+
+
+def decode_delta_of_deltas(data: bytes, count: int) -> list[int]:
+    """Decode ``count`` integers encoded by :func:`encode_delta_of_deltas`."""
+    reader = BitReader(data)
+    values: list[int] = []
+    previous_delta = 0
+    for index in range(count):
+        if index == 0:
+            values.append(to_signed(reader.read(64), 64))
+            continue
+        if reader.read(1) == 0:
+            delta_of_delta = 0
+        else:
+            # each further 1 bit of the prefix selects the next bucket
+            value_bit_count = DELTA_OF_DELTA_FALLBACK[2]
+            for _, _, bucket_bit_count in DELTA_OF_DELTA_BUCKETS:
+                if reader.read(1) == 0:
+                    value_bit_count = bucket_bit_count
+                    break
+            delta_of_delta = to_signed(reader.read(value_bit_count), value_bit_count)
+        previous_delta += delta_of_delta
+        values.append(values[-1] + previous_delta)
+    return values
+
+
+def encode_floats(values: Sequence[float]) -> bytes:
+    """XOR-encode floats against their predecessors."""
+    writer = BitWriter()
+    previous_bits = 0
+    previous_leading = -1
+    previous_trailing = 0
+    for index, value in enumerate(values):
+        bits = int.from_bytes(struct.pack(">d", value), "big")
+        if index == 0:
+            writer.write(bits, 64)
+            previous_bits = bits
+            continue
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if previous_leading >= 0 and leading >= previous_leading and trailing >= previous_trailing:
+            # the meaningful bits fit into the window of the previous value
+            writer.write(0b10, 2)
+            writer.write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+            continue
+        meaningful_bit_count = 64 - leading - trailing
+        writer.write(0b11, 2)
+        writer.write(leading, 5)
+        writer.write(meaningful_bit_count, 6)  # 64 is written as 0
+        writer.write(xor >> trailing, meaningful_bit_count)
+        previous_leading, previous_trailing = leading, trailing
+    return writer.to_bytes()
+
+
+def decode_floats(data: bytes, count: int) -> list[float]:
+    """Decode ``count`` floats encoded by :func:`encode_floats`."""
+    reader = BitReader(data)
+    values: list[float] = []
+    bits = 0
+    leading = 0
+    trailing = 0
+    for index in range(count):
+        if index == 0:
+            bits = reader.read(64)
+        elif reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                meaningful_bit_count = reader.read(6) or 64
+                trailing = 64 - leading - meaningful_bit_count
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        values.append(struct.unpack(">d", bits.to_bytes(8, "big"))[0])
+    return values
+
+
+def encode_presence(present: Sequence[bool]) -> Optional[bytes]:
+    """Return the presence bitmap of a series, or ``None`` if it is present in every message."""
+    if all(present):
+        return None
+    writer = BitWriter()
+    for is_present in present:
+        writer.write(1 if is_present else 0, 1)
+    return writer.to_bytes()
+
+
+def decode_presence(presence: Optional[bytes], count: int) -> list[bool]:
+    """Decode a presence bitmap written by :func:`encode_presence`."""
+    if presence is None:
+        return [True] * count
+    reader = BitReader(presence)
+    return [reader.read(1) == 1 for _ in range(count)]
+
+
+def encode_series(values: Sequence[Any]) -> tuple[int, bytes]:
+    """Encode the values of one key with the most compact lossless encoding.
+
+    Returns:
+      The encoding (``SERIES_ENCODING_*``) and the encoded data.
+    """
+    # larger integers could overflow the 64-bit delta-of-deltas
+    if all(type(value) is int and -2**60 <= value < 2**60 for value in values):
+        return SERIES_ENCODING_INT, encode_delta_of_deltas(values)
+    if all(type(value) is float for value in values):
+        return SERIES_ENCODING_FLOAT, encode_floats(values)
+    return SERIES_ENCODING_JSON, zlib.compress(json.dumps(values).encode(), 9)
+
+
+def decode_series(encoding: int, data: bytes, count: int) -> list[Any]:
+    """Decode ``count`` values encoded by :func:`encode_series`.
+
+    Raises:
+      ValueError: If the data is invalid.
+    """
+    if encoding == SERIES_ENCODING_INT:
+        return decode_delta_of_deltas(data, count)
+    if encoding == SERIES_ENCODING_FLOAT:
+        return decode_floats(data, count)
+    if encoding == SERIES_ENCODING_JSON:
+        try:
+            values = json.loads(zlib.decompress(data))
+        except zlib.error as e:
+            raise ValueError(f"invalid JSON series: {e}") from e
+        if type(values) is not list or len(values) != count:
+            raise ValueError("invalid JSON series")
+        return values
+    raise ValueError(f"unknown series encoding {encoding}")
+
+
+def encode_block(messages: Sequence[tuple[int, dict[str, Any]]]) -> tuple[bytes, dict[str, tuple[int, Optional[bytes], bytes]]]:
+    """Encode the messages of a block.
+
+    Args:
+      messages: ``(timestamp_ms, values)`` tuples, sorted by timestamp.
+
+    Returns:
+      The encoded timestamps and, by key, the ``(encoding, presence, data)`` of its series.
+    """
+    timestamps = encode_delta_of_deltas([timestamp_ms for timestamp_ms, _ in messages])
+    keys: dict[str, None] = {}
+    for _, values in messages:
+        keys.update(dict.fromkeys(values))
+    series: dict[str, tuple[int, Optional[bytes], bytes]] = {}
+    for key in keys:
+        presence = encode_presence([key in values for _, values in messages])
+        encoding, data = encode_series([values[key] for _, values in messages if key in values])
+        series[key] = (encoding, presence, data)
+    return timestamps, series
+
+
+def decode_block(timestamps: bytes, message_count: int,
+                 series: Sequence[tuple[str, int, Optional[bytes], bytes]]) -> list[tuple[int, dict[str, Any]]]:
+    """Decode the messages of a block.
+
+    Args:
+      timestamps: Encoded timestamps, as returned by :func:`encode_block`.
+      message_count: Number of messages in the block.
+      series: ``(key, encoding, presence, data)`` tuples, in the order the keys
+        should appear in the messages.
+
+    Returns:
+      ``(timestamp_ms, values)`` tuples, sorted by timestamp.
+
+    Raises:
+      ValueError: If the data is invalid.
+    """
+    messages: list[tuple[int, dict[str, Any]]] = [
+        (timestamp_ms, {}) for timestamp_ms in decode_delta_of_deltas(timestamps, message_count)]
+    for key, encoding, presence, data in series:
+        present = decode_presence(presence, message_count)
+        values = iter(decode_series(encoding, data, sum(present)))
+        for (_, message_values), is_present in zip(messages, present):
+            if is_present:
+                message_values[key] = next(values)
+    return messages
+
+
+def decode_key_values(timestamps: bytes, message_count: int, encoding: int, presence: Optional[bytes],
+                      data: bytes) -> list[tuple[int, Any]]:
+    """Decode the ``(timestamp_ms, value)`` pairs of a single series of a block."""
+    present = decode_presence(presence, message_count)
+    values = decode_series(encoding, data, sum(present))
+    present_timestamps = [timestamp_ms for timestamp_ms, is_present in
+                          zip(decode_delta_of_deltas(timestamps, message_count), present) if is_present]
+    return list(zip(present_timestamps, values))
+
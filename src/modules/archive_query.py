@@ -0,0 +1,161 @@
+"""Aggregated queries over the local controller archive.
+
+Republishing the raw archive to find out what happened during an outage moves
+every single message over the uplink. :func:`query_archive` instead computes
+compact per-key statistics in time buckets on the gateway, so only the result
+has to be sent.
+
+Aggregation
+-----------
+The archived messages are streamed page by page with
+:meth:`modules.archive.GatewayArchive.iter_messages`, which uses keyset
+pagination on the ``controller_archive_ts_index``. Every message is folded into
+its bucket right away, so memory usage only depends on the number of buckets and
+keys, not on the number of archived messages.
+
+If the query selects keys, each key is read with
+:meth:`modules.archive.GatewayArchive.iter_key_values` instead. With the
+normalized archive layout, this only reads the rows of the selected keys.
+
+For every bucket and key the result contains:
+
+- ``count``: Number of values.
+- ``min`` / ``max`` / ``mean``: Statistics over the numeric values, ``None`` if
+  the key had no numeric values in the bucket.
+- ``last``: Most recent value of any type.
+
+Buckets are aligned to multiples of the bucket size since the Unix epoch.
+
+Limits
+------
+- ``ARCHIVE_QUERY_MAX_BUCKETS``: Maximum number of buckets a query may span.
+- ``ARCHIVE_QUERY_MAX_POINTS``: Maximum number of ``(bucket, key)`` rows in a
+  result. Queries exceeding it are aborted early, so a careless request cannot
+  exhaust memory or the uplink.
+"""
+
+import json
+import math
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+from modules.archive import GatewayArchive
+
+ARCHIVE_QUERY_MAX_BUCKETS: int = 10_000
+ARCHIVE_QUERY_MAX_POINTS: int = 20_000
+# Number of archived messages fetched per query
+ARCHIVE_QUERY_PAGE_SIZE: int = 1_000
+
+# Order of the statistics in each result row
+ARCHIVE_QUERY_COLUMNS: list[str] = ["bucket_start_ms", "count", "min", "max", "mean", "last"]
+
+
+class ArchiveQueryError(Exception):
+    """Raised when an archive query is invalid or exceeds the result limits."""
+
+
+@dataclass
+class BucketStats:
+    """Running statistics of one key within one bucket."""
+    count: int = 0
+    numeric_count: int = 0
+    min: float = math.inf
+    max: float = -math.inf
+    sum: float = 0.0
+    last: Any = None
+    last_timestamp_ms: int = -1
+
+    def add(self, timestamp_ms: int, value: Any) -> None:
+        """Fold a value into the statistics."""
+        self.count += 1
+        # the legacy shard is visited first, but may overlap newer shards
+        if timestamp_ms >= self.last_timestamp_ms:
+            self.last = value
+            self.last_timestamp_ms = timestamp_ms
+        if type(value) in (int, float) and math.isfinite(value):
+            self.numeric_count += 1
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+            self.sum += value
+
+    def to_row(self, bucket_start_ms: int) -> list[Any]:
+        """Return the statistics in the order of :data:`ARCHIVE_QUERY_COLUMNS`."""
+        if self.numeric_count == 0:
+            return [bucket_start_ms, self.count, None, None, None, self.last]
+        return [bucket_start_ms, self.count, self.min, self.max, self.sum / self.numeric_count, self.last]
+
+
+def query_archive(archive: GatewayArchive, start_timestamp_ms: int, end_timestamp_ms: int, bucket_ms: int,
+                  keys: Optional[Sequence[str]] = None) -> dict[str, Any]:
+    """Aggregate the archived values within a time range into time buckets.
+
+    Args:
+      archive: Archive to query.
+      start_timestamp_ms: Exclusive start of the range.
+      end_timestamp_ms: Exclusive end of the range.
+      bucket_ms: Size of the time buckets in milliseconds.
+      keys: Only aggregate these value keys, all keys if ``None``.
+
+    Returns:
+      A dictionary with the query parameters, the number of aggregated values,
+      the ``columns`` of the result rows and ``values`` mapping each key to its
+      rows, ordered by bucket.
+
+    Raises:
+      ArchiveQueryError: If the query spans too many buckets or its result
+        exceeds ``ARCHIVE_QUERY_MAX_POINTS`` rows.
+    """
+    if bucket_ms <= 0:
+        raise ArchiveQueryError("bucket size must be positive")
+    bucket_count = end_timestamp_ms // bucket_ms - start_timestamp_ms // bucket_ms + 1
+    if bucket_count > ARCHIVE_QUERY_MAX_BUCKETS:
+        raise ArchiveQueryError(f"time range spans {bucket_count} buckets, "
+                                f"at most {ARCHIVE_QUERY_MAX_BUCKETS} are allowed")
+
+    selected_keys = set(keys) if keys is not None else None
+    stats: dict[str, dict[int, BucketStats]] = {}
+    point_count = 0
+    value_count = 0
+
+    def add_value(key: str, timestamp_ms: int, value: Any) -> None:
+        nonlocal point_count, value_count
+        bucket_start_ms = timestamp_ms // bucket_ms * bucket_ms
+        key_stats = stats.setdefault(key, {})
+        bucket_stats = key_stats.get(bucket_start_ms)
+        if bucket_stats is None:
+            point_count += 1
+            if point_count > ARCHIVE_QUERY_MAX_POINTS:
+                raise ArchiveQueryError(f"result exceeds {ARCHIVE_QUERY_MAX_POINTS} rows, "
+                                        "use larger buckets, a shorter time range or fewer keys")
+            bucket_stats = key_stats[bucket_start_ms] = BucketStats()
+        bucket_stats.add(timestamp_ms, value)
+        value_count += 1
+
+    if selected_keys is not None:
+        for key in sorted(selected_keys):
+            for timestamp_ms, value in archive.iter_key_values(key, start_timestamp_ms, end_timestamp_ms,
+                                                               page_size=ARCHIVE_QUERY_PAGE_SIZE):
+                add_value(key, timestamp_ms, value)
+    else:
+        for position, message in archive.iter_messages(start_timestamp_ms, end_timestamp_ms,
+                                                       page_size=ARCHIVE_QUERY_PAGE_SIZE):
+            try:
+                values = json.loads(message)
+            except ValueError:
+                continue
+            if type(values) is not dict:
+                continue
+            for key, value in values.items():
+                add_value(key, position.timestamp_ms, value)
+
+    return {
+        "start_timestamp_ms": start_timestamp_ms,
+        "end_timestamp_ms": end_timestamp_ms,
+        "bucket_ms": bucket_ms,
+        "value_count": value_count,
+        "columns": ARCHIVE_QUERY_COLUMNS,
+        "values": {
+            key: [bucket_stats.to_row(bucket_start_ms) for bucket_start_ms, bucket_stats in sorted(key_stats.items())]
+            for key, key_stats in sorted(stats.items())
+        },
+    }
@@ -0,0 +1,222 @@
+"""Compressed storage of queued MQTT payloads.
+
+Controller messages repeat the same JSON key names on every row, so the pending
+MQTT message queue mostly stores redundant text. With
+``TEG_PENDING_PAYLOAD_COMPRESSION=zlib``, payloads are stored deflate-compressed
+with a preset dictionary trained from recent messages, which shrinks the queue
+database and its write volume several-fold on devices that are offline for long
+periods.
+
+Each queued row carries a format marker (``payload_format``) and the id of the
+dictionary it was compressed with (``dictionary_id``), so rows written in any
+format, including plain text rows from older versions, are decoded correctly.
+Payloads are only decompressed right before they are published.
+
+Dictionaries
+------------
+- The first :data:`DICTIONARY_TRAINING_SAMPLES` payloads are compressed without
+  a dictionary. Afterwards, a dictionary is built from the JSON keys and string
+  values that recur across the recent payloads, followed by the most recent
+  payload itself.
+- The dictionary is retrained every :data:`DICTIONARY_RETRAIN_INTERVAL_ROWS`
+  payloads, so it follows changes of the controller's message layout.
+- Training only happens in :meth:`PayloadCodec.end_batch`, once the payloads
+  encoded for a transaction are committed or discarded, so all payloads of a
+  transaction use the same dictionary.
+- Dictionaries are stored in the ``payload_dictionaries`` table and are removed
+  once neither a queued row nor an uncommitted payload references them anymore.
+
+Configuration
+-------------
+- ``TEG_PENDING_PAYLOAD_COMPRESSION``: ``none`` (default) or ``zlib``.
+"""
+
+import os
+import re
+import zlib
+from collections import Counter, deque
+from time import time_ns
+from typing import Optional, Union
+
+from modules import sqlite
+from modules.logging import info, warn
+
+PENDING_PAYLOAD_COMPRESSION: bool = (os.environ.get("TEG_PENDING_PAYLOAD_COMPRESSION") or "none") == "zlib"
+
+# Storage formats of queued payloads
+PAYLOAD_FORMAT_TEXT: int = 0
+PAYLOAD_FORMAT_ZLIB: int = 1
+
+COMPRESSION_LEVEL: int = 6
+# zlib only uses the last 32 KiB of a preset dictionary
+DICTIONARY_MAX_BYTES: int = 32_768
+# Number of recent payloads a dictionary is trained from
+DICTIONARY_TRAINING_SAMPLES: int = 200
+# Number of compressed payloads after which the dictionary is trained again
+DICTIONARY_RETRAIN_INTERVAL_ROWS: int = 50_000
+# JSON object keys and short string values
+DICTIONARY_TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.){1,64}"\s*:?')
+
+
+def train_dictionary(samples: list[str]) -> bytes:
+    """Build a preset dictionary from sample payloads.
+
+    Tokens occurring in more than one sample are added in ascending order of
+    frequency, since zlib encodes references to the end of the dictionary most
+    cheaply. The most recent sample is appended last, covering the common
+    structure of the payloads.
+
+    Args:
+      samples: Recent payloads, oldest first.
+
+    Returns:
+      Dictionary of at most :data:`DICTIONARY_MAX_BYTES` bytes.
+    """
+    token_counts: Counter[str] = Counter()
+    for sample in samples:
+        token_counts.update(set(DICTIONARY_TOKEN_PATTERN.findall(sample)))
+    recurring_tokens = [token for token, count in token_counts.most_common() if count > 1]
+    dictionary = "".join(reversed(recurring_tokens)).encode("utf-8")
+    if len(samples) > 0:
+        dictionary += samples[-1].encode("utf-8")
+    return dictionary[-DICTIONARY_MAX_BYTES:]
+
+
+class PayloadCodec:
+    """Encode payloads for storage in the pending queue and decode them for publishing.
+
+    Attributes
+    ----------
+    db:
+      Connection to the communication queue database.
+    compress:
+      Whether new payloads are compressed.
+    dictionary_id:
+      Id of the dictionary used for new payloads, ``None`` while none is trained.
+    uncommitted_dictionary_ids:
+      Dictionaries referenced by payloads encoded since the last :meth:`end_batch`.
+    """
+
+    def __init__(self, db: sqlite.SqliteConnection, compress: bool = PENDING_PAYLOAD_COMPRESSION) -> None:
+        self.db = db
+        self.compress = compress
+        self.table = sqlite.SqliteTables.PAYLOAD_DICTIONARIES.value
+        self.dictionaries: dict[int, bytes] = {}
+        self.dictionary_id: Optional[int] = None
+        self.training_samples: deque[str] = deque(maxlen=DICTIONARY_TRAINING_SAMPLES)
+        self.rows_since_training = 0
+        self.uncommitted_dictionary_ids: set[int] = set()
+
+        result = self.db.execute(f"SELECT id, dictionary FROM {self.table} ORDER BY id DESC LIMIT 1")
+        if result and len(result[0]) == 2:
+            self.dictionary_id = result[0][0]
+            self.dictionaries[result[0][0]] = result[0][1]
+
+    def encode(self, message: str) -> tuple[Union[str, bytes], int, Optional[int]]:
+        """Encode a payload for storage.
+
+        The payload must be committed or discarded, followed by a call to
+        :meth:`end_batch`, before the dictionary it references can be removed.
+
+        Args:
+          message: JSON payload.
+
+        Returns:
+          ``(message, payload_format, dictionary_id)`` values for the pending queue.
+        """
+        if not self.compress:
+            return message, PAYLOAD_FORMAT_TEXT, None
+
+        self.training_samples.append(message)
+        self.rows_since_training += 1
+
+        if self.dictionary_id is None:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            self.uncommitted_dictionary_ids.add(self.dictionary_id)
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                          zdict=self.dictionaries[self.dictionary_id])
+        return compressor.compress(message.encode("utf-8")) + compressor.flush(), PAYLOAD_FORMAT_ZLIB, self.dictionary_id
+
+    def end_batch(self) -> None:
+        """Mark the payloads encoded so far as committed or discarded and retrain the dictionary if due.
+
+        Must be called after the transaction storing the encoded payloads has
+        finished, whether it was committed or not.
+        """
+        self.uncommitted_dictionary_ids.clear()
+        if not self.compress:
+            return
+        if (self.dictionary_id is None and self.rows_since_training >= DICTIONARY_TRAINING_SAMPLES) \
+                or self.rows_since_training >= DICTIONARY_RETRAIN_INTERVAL_ROWS:
+            self.store_dictionary(train_dictionary(list(self.training_samples)))
+
+    def decode(self, message: Union[str, bytes], payload_format: int = PAYLOAD_FORMAT_TEXT,
+               dictionary_id: Optional[int] = None) -> str:
+        """Decode a stored payload.
+
+        Args:
+          message: Stored payload.
+          payload_format: Storage format of the payload.
+          dictionary_id: Dictionary the payload was compressed with, if any.
+
+        Returns:
+          JSON payload.
+
+        Raises:
+          ValueError: If the payload cannot be decoded.
+        """
+        if payload_format == PAYLOAD_FORMAT_TEXT:
+            return message.decode("utf-8") if isinstance(message, bytes) else message
+        if payload_format != PAYLOAD_FORMAT_ZLIB or not isinstance(message, bytes):
+            raise ValueError(f"Unsupported payload format {payload_format}")
+
+        if dictionary_id is None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.get_dictionary(dictionary_id))
+        try:
+            return (decompressor.decompress(message) + decompressor.flush()).decode("utf-8")
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed payload: {e}")
+
+    def get_dictionary(self, dictionary_id: int) -> bytes:
+        """Return a stored dictionary by id.
+
+        Raises:
+          ValueError: If the dictionary does not exist.
+        """
+        if dictionary_id not in self.dictionaries:
+            result = self.db.execute(f"SELECT dictionary FROM {self.table} WHERE id = ?", (dictionary_id,))
+            if not result or len(result[0]) == 0:
+                raise ValueError(f"Unknown compression dictionary {dictionary_id}")
+            self.dictionaries[dictionary_id] = result[0][0]
+        return self.dictionaries[dictionary_id]
+
+    def store_dictionary(self, dictionary: bytes) -> None:
+        """Persist a new dictionary, use it for new payloads and remove unused ones.
+
+        Previous dictionaries stay available for decoding as long as a queued
+        row or an uncommitted payload references them.
+        """
+        self.rows_since_training = 0
+        result = self.db.execute(
+            f"INSERT INTO {self.table} (created_at_ms, dictionary) VALUES (?, ?) RETURNING id",
+            (int(time_ns() / 1_000_000), dictionary))
+        if not result or len(result[0]) == 0:
+            warn("[COMPRESSION] Failed to store compression dictionary")
+            return
+        dictionary_id: int = result[0][0]
+        self.dictionary_id = dictionary_id
+        self.dictionaries[dictionary_id] = dictionary
+        info(f"[COMPRESSION] Trained dictionary {self.dictionary_id} ({len(dictionary)} bytes) "
+             f"from {len(self.training_samples)} payloads")
+
+        in_use = [dictionary_id, *self.uncommitted_dictionary_ids]
+        removed = self.db.execute(
+            f"""DELETE FROM {self.table} WHERE id NOT IN ({", ".join("?" * len(in_use))}) AND id NOT IN (
+                SELECT dictionary_id FROM {sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value}
+                WHERE dictionary_id IS NOT NULL) RETURNING id""", in_use)
+        for row in removed or []:
+            if len(row) > 0:
+                self.dictionaries.pop(row[0], None)
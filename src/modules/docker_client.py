@@ -15,6 +15,29 @@ The controller is deployed as a Docker container (``teg_controller``) with image
 tagged as ``teg-controller-<version>:latest``. Versions may be Git tags (e.g. ``v1.2.3``)
 or full commit hashes.
 
+State cache
+-----------
+The state of the controller container (running, image, start time) is cached in
+memory, so :meth:`GatewayDockerClient.is_controller_running` and the related
+getters do not query the Docker API on every main loop iteration. A background
+thread subscribes to the ``docker events`` of the controller container and
+refreshes the cache whenever the container is created, started, stopped or
+removed. When the controller exits, the time is recorded, so the controller
+restart watchdog (see :mod:`utils.controller_restart`) checks the container soon
+instead of waiting for its next periodic check.
+
+While the events subscription is down (e.g. while the Docker daemon restarts),
+the cache is not used and every call queries the Docker API.
+
+Lifecycle operations
+--------------------
+Starting, stopping and pruning the controller container run on the main loop,
+on RPC workers and on the controller executor of the asyncio runtime. They are
+serialized by :attr:`GatewayDockerClient.lifecycle_lock`, which callers also hold
+across a state check and the operation depending on it. Exits caused by
+:meth:`GatewayDockerClient.stop_controller` are not recorded as exits of the
+controller.
+
 Notes
 -----
 - This client is implemented as a process-level singleton to avoid repeated Docker
@@ -26,11 +49,14 @@ Notes
 
 import datetime
 import os
-from time import sleep
+import threading
+from dataclasses import dataclass
+from time import sleep, time_ns
 from typing import Any, Optional
 
 import docker
 from docker import DockerClient
+from docker.errors import NotFound
 from docker.types import LogConfig
 
 from modules.git_client import GatewayGitClient
@@ -38,12 +64,38 @@ from modules.logging import debug, info, warn, error
 from modules.mqtt import GatewayMqttClient
 from utils.paths import CONTROLLER_GIT_PATH, GATEWAY_DATA_PATH, CONTROLLER_LOGS_PATH, CONTROLLER_DATA_PATH, \
     CONTROLLER_DOCKERCONTEXT_PATH, CONTROLLER_DOCKERFILE_PATH
+from utils.wakeup import notify_main_loop
 
 CONTROLLER_CONTAINER_NAME: str = "teg_controller"
 CONTROLLER_IMAGE_PREFIX: str = "teg-controller-"
+# Docker events that change the cached state of the controller container
+CONTROLLER_STATE_EVENTS: set[str] = {"create", "start", "restart", "die", "stop", "kill", "destroy", "rename",
+                                     "pause", "unpause", "oom"}
+# Time before the events subscription is retried after it failed or ended
+DOCKER_EVENTS_RETRY_S: float = 10.0
 
 singleton_instance: Optional["GatewayDockerClient"] = None
 
+
+@dataclass
+class ControllerContainerState:
+    """Cached state of the controller container.
+
+    Attributes
+    ----------
+    running:
+      Whether the container exists and is running.
+    image:
+      Image name of the container (e.g. ``teg-controller-v1.0.0:latest``), ``None``
+      if the container does not exist.
+    started_at:
+      Start time of the container as reported by Docker, ``None`` if the container
+      does not exist.
+    """
+    running: bool
+    image: Optional[str] = None
+    started_at: Optional[str] = None
+
 class GatewayDockerClient:
     """Manage the controller Docker container for an Edge Gateway device.
 
@@ -61,10 +113,25 @@ class GatewayDockerClient:
     docker_client:
       Docker SDK client instance created via :func:`docker.from_env`, or ``None`` if
       Docker is unavailable.
+    controller_state:
+      Cached state of the controller container, ``None`` if not known yet.
+    events_subscribed:
+      Whether the events subscription keeps :attr:`controller_state` up to date.
+    controller_exited_at_ms:
+      Unix timestamp in milliseconds of the last exit of the controller container,
+      ``None`` if it did not exit since the gateway started.
+    lifecycle_lock:
+      Serializes the lifecycle operations of the controller container.
+    stopped_container_ids:
+      Ids of containers stopped by :meth:`stop_controller` whose exit was not
+      reported yet.
 
     """
     last_launched_version: Optional[str] = None
     docker_client: Optional[DockerClient] = None
+    controller_state: Optional[ControllerContainerState] = None
+    events_subscribed: bool = False
+    controller_exited_at_ms: Optional[int] = None
 
     def __init__(self) -> None:
         global singleton_instance
@@ -72,11 +139,19 @@ class GatewayDockerClient:
             debug("[DOCKER-CLIENT] Initializing GatewayDockerClient")
             super().__init__()
             singleton_instance = self
+            self.state_lock = threading.Lock()
+            # serializes the queries of the controller state, so a newer state is never overwritten
+            self.refresh_lock = threading.Lock()
+            # re-entrant, since start_controller stops the controller and calls itself
+            self.lifecycle_lock = threading.RLock()
+            self.stopped_container_ids: set[str] = set()
             try:
                 self.docker_client = docker.from_env()
             except Exception as e:
                 error("[DOCKER-CLIENT] Failed to initialize GatewayDockerClient: {}".format(e))
                 self.docker_client = None
+            if self.docker_client is not None:
+                threading.Thread(target=self.run_events_watcher, name="docker-events", daemon=True).start()
 
     # Singleton pattern
     def __new__(cls: Any) -> Any:
@@ -124,6 +199,91 @@ class GatewayDockerClient:
         except Exception as e:
             error("[DOCKER-CLIENT] Failed to write last launched controller version: {}".format(e))
 
+    def refresh_controller_state(self) -> ControllerContainerState:
+        """Query the state of the controller container from Docker and cache it.
+
+        Returns:
+          The current state of the controller container.
+        """
+        assert self.docker_client is not None
+        with self.refresh_lock:
+            try:
+                container = self.docker_client.containers.get(CONTROLLER_CONTAINER_NAME)
+                state = ControllerContainerState(
+                    running=container.attrs["State"]["Running"],
+                    image=container.attrs["Config"]["Image"],
+                    started_at=container.attrs["State"]["StartedAt"],
+                )
+            except NotFound:
+                state = ControllerContainerState(running=False)
+            with self.state_lock:
+                self.controller_state = state
+            return state
+
+    def get_controller_state(self) -> ControllerContainerState:
+        """Return the cached state of the controller container, or query it while the cache is not kept up to date."""
+        with self.state_lock:
+            if self.events_subscribed and self.controller_state is not None:
+                return self.controller_state
+        return self.refresh_controller_state()
+
+    def run_events_watcher(self) -> None:
+        """Keep the cached controller state up to date with the Docker events of the controller container."""
+        assert self.docker_client is not None
+        while True:
+            try:
+                events = self.docker_client.events(
+                    decode=True, filters={"type": "container", "container": CONTROLLER_CONTAINER_NAME})
+                # refresh after subscribing, so no change between the query and the first event is missed
+                self.refresh_controller_state()
+                with self.state_lock:
+                    self.events_subscribed = True
+                debug("[DOCKER-CLIENT] Subscribed to Docker events of the controller container")
+                for event in events:
+                    self.on_docker_event(event)
+                warn("[DOCKER-CLIENT] Docker events subscription ended")
+            except Exception as e:
+                warn("[DOCKER-CLIENT] Docker events subscription failed: {}".format(e))
+            with self.state_lock:
+                self.events_subscribed = False
+            sleep(DOCKER_EVENTS_RETRY_S)
+
+    def on_docker_event(self, event: dict[str, Any]) -> None:
+        """Refresh the cached controller state on events that change it.
+
+        Args:
+          event: Decoded Docker event of the controller container.
+        """
+        # exec and health check events are reported as e.g. "exec_start: sh" or "health_status: healthy"
+        action = str(event.get("Action") or event.get("status") or "").split(":")[0]
+        if action not in CONTROLLER_STATE_EVENTS:
+            return
+        debug(f"[DOCKER-CLIENT] Controller container event: {action}")
+        controller_exited = False
+        if action == "die":
+            actor = event.get("Actor", {})
+            exit_code = actor.get("Attributes", {}).get("exitCode")
+            container_id: str = actor.get("ID") or event.get("id") or ""
+            with self.state_lock:
+                stopped_by_gateway = container_id in self.stopped_container_ids
+                self.stopped_container_ids.discard(container_id)
+                controller_exited = not stopped_by_gateway
+                if controller_exited:
+                    self.controller_exited_at_ms = int(time_ns() / 1_000_000)
+            if stopped_by_gateway:
+                debug(f"[DOCKER-CLIENT] Controller container stopped by the gateway exited with code {exit_code}")
+            else:
+                info(f"[DOCKER-CLIENT] Controller container exited with code {exit_code}")
+        self.refresh_controller_state()
+        if controller_exited:
+            # let the restart watchdog check the controller
+            notify_main_loop()
+
+    def get_controller_exited_at_ms(self) -> Optional[int]:
+        """Return the Unix timestamp in milliseconds of the last exit of the controller container."""
+        with self.state_lock:
+            return self.controller_exited_at_ms
+
     def is_controller_running(self) -> bool:
         """Check whether the controller container is running.
 
@@ -133,11 +293,7 @@ class GatewayDockerClient:
         if self.docker_client is None:
             error("[DOCKER-CLIENT] is_controller_running: Docker client not initialized")
             return False
-        containers = self.docker_client.containers.list()
-        for container in containers:
-            if container.name == CONTROLLER_CONTAINER_NAME:
-                return container.attrs["State"]["Running"]
-        return False
+        return self.get_controller_state().running
 
     def is_image_available(self, image_tag: str) -> bool:
         """Check whether a Docker image tag exists locally.
@@ -166,16 +322,14 @@ class GatewayDockerClient:
         if self.docker_client is None:
             error("[DOCKER-CLIENT] get_controller_version: Docker client not initialized")
             return None
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    version = container.attrs["Config"]["Image"].split("-")[-1]
-                    if version.__len__() > 0 and (version[0] == "v"
-                                                  or version.__len__() == 40):
-                        if version.endswith(":latest"):
-                            version = version[:-7]
-                        return version
+        state = self.get_controller_state()
+        if state.running and state.image is not None:
+            version = state.image.split("-")[-1]
+            if version.__len__() > 0 and (version[0] == "v"
+                                          or version.__len__() == 40):
+                if version.endswith(":latest"):
+                    version = version[:-7]
+                return version
         return None
 
     def get_edge_startup_timestamp_ms(self) -> Optional[int]:
@@ -187,15 +341,13 @@ class GatewayDockerClient:
         if self.docker_client is None:
             error("[DOCKER-CLIENT] get_edge_startup_timestamp_ms: Docker client not initialized")
             return None
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    return int(
-                        datetime.datetime.strptime(container.attrs["State"]["StartedAt"][:-4], "%Y-%m-%dT%H:%M:%S.%f" )
-                        .replace(tzinfo=datetime.timezone.utc)
-                        .timestamp() * 1000
-                    )
+        state = self.get_controller_state()
+        if state.running and state.started_at is not None:
+            return int(
+                datetime.datetime.strptime(state.started_at[:-4], "%Y-%m-%dT%H:%M:%S.%f" )
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp() * 1000
+            )
         return None
 
     def stop_controller(self) -> None:
@@ -210,25 +362,35 @@ class GatewayDockerClient:
         if self.docker_client is None:
             error("[DOCKER-CLIENT] stop_controller: Docker client not initialized")
             return None
-        if self.is_controller_running():
-            containers = self.docker_client.containers.list()
-            for container in containers:
-                if container.name == CONTROLLER_CONTAINER_NAME:
-                    running_controller_version = self.get_controller_version()
-                    if running_controller_version is not None:
-                        self.set_last_launched_controller_version(running_controller_version)
-                    info("[DOCKER-CLIENT] Stopping controller container...")
-                    container.stop(timeout=60)
-                    info("[DOCKER-CLIENT] Stopped controller container")
-        else:
-            info("[DOCKER-CLIENT] Controller container is not running")
+        with self.lifecycle_lock:
+            if self.is_controller_running():
+                containers = self.docker_client.containers.list()
+                for container in containers:
+                    if container.name == CONTROLLER_CONTAINER_NAME:
+                        running_controller_version = self.get_controller_version()
+                        if running_controller_version is not None:
+                            self.set_last_launched_controller_version(running_controller_version)
+                        info("[DOCKER-CLIENT] Stopping controller container...")
+                        with self.state_lock:
+                            self.stopped_container_ids.add(container.id)
+                        try:
+                            container.stop(timeout=60)
+                        except Exception:
+                            with self.state_lock:
+                                self.stopped_container_ids.discard(container.id)
+                            raise
+                        self.refresh_controller_state()
+                        info("[DOCKER-CLIENT] Stopped controller container")
+            else:
+                info("[DOCKER-CLIENT] Controller container is not running")
 
     def prune_containers(self) -> None:
         """Remove stopped containers to keep the Docker environment clean."""
         if self.docker_client is None:
             error("[DOCKER-CLIENT] prune_containers: Docker client not initialized")
             return None
-        self.docker_client.containers.prune()
+        with self.lifecycle_lock:
+            self.docker_client.containers.prune()
         info("[DOCKER-CLIENT] Pruned containers")
 
     def start_controller_safely(self, version_to_launch: str):
@@ -262,86 +424,88 @@ class GatewayDockerClient:
         if self.docker_client is None:
             error("[DOCKER-CLIENT] start_controller: Docker client not initialized")
             return None
-        if self.is_controller_running():
-            running_controller_version = self.get_controller_version()
-            if running_controller_version != version_to_launch:
-                self.stop_controller()
-                self.start_controller(version_to_launch)
-            else:
-                info("[DOCKER-CLIENT] Software already running with version " + version_to_launch)
-                self.set_last_launched_controller_version(running_controller_version)
-            return
-
-        image_tag : str = CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
-
-        # edge container is not running
-        # check if the image is available already, if not build it
-        if not self.is_image_available(image_tag):
-            error("[DOCKER-CLIENT] Image '" + image_tag + "' not available")
-            info("[DOCKER-CLIENT] Building image for version '" + version_to_launch + "'")
-            GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADING")
-            GatewayGitClient().execute_fetch()
-            commit_hash = GatewayGitClient().get_commit_from_hash_or_tag(version_to_launch)
-            if commit_hash is None:
-                error("[DOCKER-CLIENT] Unable to get commit hash for version '" + version_to_launch + "'")
+        with self.lifecycle_lock:
+            if self.is_controller_running():
+                running_controller_version = self.get_controller_version()
+                if running_controller_version != version_to_launch:
+                    self.stop_controller()
+                    self.start_controller(version_to_launch)
+                else:
+                    info("[DOCKER-CLIENT] Software already running with version " + version_to_launch)
+                    self.set_last_launched_controller_version(running_controller_version)
                 return
-            info("[DOCKER-CLIENT] Building image for commit " + commit_hash)
 
-            if GatewayGitClient().execute_reset_to_commit(commit_hash) \
-                and GatewayGitClient().get_current_commit() == commit_hash:
-                info("[DOCKER-CLIENT] Successfully reset to commit " + commit_hash)
-            else:
-                error("[DOCKER-CLIENT] Unable to reset to commit " + commit_hash)
-                return
-            GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADED")
-            self.docker_client.images.build(
-                path=CONTROLLER_DOCKERCONTEXT_PATH,
-                dockerfile=CONTROLLER_DOCKERFILE_PATH,
-                tag=CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
-            )
-            info("[DOCKER-CLIENT] Built image for commit " + commit_hash + " with tag " + CONTROLLER_IMAGE_PREFIX + version_to_launch)
-
-        GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATING")
-        # remove old containers and start the new one
-        self.prune_containers()
-        self.docker_client.containers.run(
-            image_tag,
-            detach=True,
-            name=CONTROLLER_CONTAINER_NAME,
-            restart_policy={
-                "MaximumRetryCount": 3,
-                "Name": "on-failure"
-            },
-            log_config=LogConfig(type=LogConfig.types.JSON, config={
-                "max-size": "10m",
-                "max-file": "5"
-            }),
-            privileged=True,
-            network_mode="host",
-            volumes={
-                "/bin/vcgencmd": {
-                    "bind": "/bin/vcgencmd",
-                    "mode": "ro"
-                },
-                "/bin/uptime": {
-                    "bind": "/bin/uptime",
-                    "mode": "ro"
+            image_tag : str = CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
+
+            # edge container is not running
+            # check if the image is available already, if not build it
+            if not self.is_image_available(image_tag):
+                error("[DOCKER-CLIENT] Image '" + image_tag + "' not available")
+                info("[DOCKER-CLIENT] Building image for version '" + version_to_launch + "'")
+                GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADING")
+                GatewayGitClient().execute_fetch()
+                commit_hash = GatewayGitClient().get_commit_from_hash_or_tag(version_to_launch)
+                if commit_hash is None:
+                    error("[DOCKER-CLIENT] Unable to get commit hash for version '" + version_to_launch + "'")
+                    return
+                info("[DOCKER-CLIENT] Building image for commit " + commit_hash)
+
+                if GatewayGitClient().execute_reset_to_commit(commit_hash) \
+                    and GatewayGitClient().get_current_commit() == commit_hash:
+                    info("[DOCKER-CLIENT] Successfully reset to commit " + commit_hash)
+                else:
+                    error("[DOCKER-CLIENT] Unable to reset to commit " + commit_hash)
+                    return
+                GatewayMqttClient().publish_sw_state(version_to_launch, "DOWNLOADED")
+                self.docker_client.images.build(
+                    path=CONTROLLER_DOCKERCONTEXT_PATH,
+                    dockerfile=CONTROLLER_DOCKERFILE_PATH,
+                    tag=CONTROLLER_IMAGE_PREFIX + version_to_launch + ":latest"
+                )
+                info("[DOCKER-CLIENT] Built image for commit " + commit_hash + " with tag " + CONTROLLER_IMAGE_PREFIX + version_to_launch)
+
+            GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATING")
+            # remove old containers and start the new one
+            self.prune_containers()
+            self.docker_client.containers.run(
+                image_tag,
+                detach=True,
+                name=CONTROLLER_CONTAINER_NAME,
+                restart_policy={
+                    "MaximumRetryCount": 3,
+                    "Name": "on-failure"
                 },
-                "/bin/pigs": {
-                    "bind": "/bin/pigs",
-                    "mode": "ro"
-                },
-                CONTROLLER_DATA_PATH: {
-                    "bind": "/root/data",
-                    "mode": "rw"
-                },
-                CONTROLLER_LOGS_PATH: {
-                    "bind": "/root/logs",
-                    "mode": "rw"
-                },
-            }
-        )
-        self.set_last_launched_controller_version(version_to_launch)
+                log_config=LogConfig(type=LogConfig.types.JSON, config={
+                    "max-size": "10m",
+                    "max-file": "5"
+                }),
+                privileged=True,
+                network_mode="host",
+                volumes={
+                    "/bin/vcgencmd": {
+                        "bind": "/bin/vcgencmd",
+                        "mode": "ro"
+                    },
+                    "/bin/uptime": {
+                        "bind": "/bin/uptime",
+                        "mode": "ro"
+                    },
+                    "/bin/pigs": {
+                        "bind": "/bin/pigs",
+                        "mode": "ro"
+                    },
+                    CONTROLLER_DATA_PATH: {
+                        "bind": "/root/data",
+                        "mode": "rw"
+                    },
+                    CONTROLLER_LOGS_PATH: {
+                        "bind": "/root/logs",
+                        "mode": "rw"
+                    },
+                }
+            )
+            self.refresh_controller_state()
+            self.set_last_launched_controller_version(version_to_launch)
 
-        GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATED")
-        info("[DOCKER-CLIENT] Started container with version '" + version_to_launch + "'")
\ No newline at end of file
+            GatewayMqttClient().publish_sw_state(version_to_launch, "UPDATED")
+            info("[DOCKER-CLIENT] Started container with version '" + version_to_launch + "'")
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""Bounded queue of inbound MQTT messages.
+
+The MQTT network thread used to parse every inbound message and put it into an
+unbounded queue. During a flood of attribute updates, the queue grew without
+limit, and the parsing delayed the keepalives of the connection.
+
+The :class:`InboundMessageQueue` only stores the raw topic and payload on the
+network thread. Payloads are parsed by the main loop when it takes a message.
+
+Bound
+-----
+At most ``TEG_MQTT_INBOUND_QUEUE_SIZE`` messages are queued; further messages are
+dropped. Attribute updates are state, not events: after an attribute update was
+dropped, the gateway requests the attributes again once the queue has drained
+(see :meth:`modules.mqtt.GatewayMqttClient.get_message`).
+
+Coalescing
+----------
+Attribute updates are superseded by later updates of the same attribute. When the
+main loop takes an attribute update, the queued attribute updates are coalesced:
+the ``FILES``, ``FILE_HASHES`` and software update (``sw_*``) attributes are
+removed from every update that is followed by another update of the same
+attribute, and updates left without attributes are removed from the queue.
+
+Configuration
+-------------
+- ``TEG_MQTT_INBOUND_QUEUE_SIZE``: Maximum number of queued inbound messages
+  (default: 1000).
+
+Notes
+-----
+- The number of dropped, coalesced and unparsable messages is reported with the
+  auxiliary telemetry (see :meth:`InboundMessageQueue.get_telemetry_values`).
+"""
+
+import json
+import os
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any, Optional
+
+from modules.logging import warn
+
+MQTT_INBOUND_QUEUE_SIZE: int = int(os.environ.get("TEG_MQTT_INBOUND_QUEUE_SIZE") or 1_000)
+
+# Topic prefix of attribute updates and attribute responses
+ATTRIBUTES_TOPIC: str = "v1/devices/me/attributes"
+# Attributes of which only the latest update is processed; the software update
+# attributes are superseded as a group
+COALESCED_ATTRIBUTE_GROUPS: dict[str, str] = {
+    "FILES": "FILES",
+    "FILE_HASHES": "FILE_HASHES",
+    **{key: "sw" for key in ["sw_title", "sw_version", "sw_url", "sw_checksum", "sw_checksum_algorithm",
+                             "sw_size", "sf_title", "sf_version"]},
+}
+
+
+@dataclass
+class InboundMessage:
+    """An inbound MQTT message with its payload parsed on first access."""
+    topic: str
+    raw_payload: bytes
+    payload: Any = None
+    parsed: bool = False
+    valid: bool = True
+    # attribute groups this message updates, filled by InboundMessageQueue.coalesce
+    attribute_groups: set[str] = field(default_factory=set)
+
+    def is_attribute_update(self) -> bool:
+        return self.topic.startswith(ATTRIBUTES_TOPIC)
+
+    def parse(self) -> Any:
+        """Parse the payload, once. Unparsable payloads are marked as not :attr:`valid`."""
+        if not self.parsed:
+            self.parsed = True
+            try:
+                self.payload = json.loads(self.raw_payload)
+            except ValueError:
+                self.valid = False
+            if self.valid and self.is_attribute_update():
+                self.attribute_groups = {COALESCED_ATTRIBUTE_GROUPS[key]
+                                         for attributes in get_attribute_dicts(self.payload)
+                                         for key in attributes if key in COALESCED_ATTRIBUTE_GROUPS}
+        return self.payload
+
+
+def get_attribute_dicts(payload: Any) -> list[dict]:
+    """Return the attribute dictionaries of an attribute update or attribute response.
+
+    Updates carry the shared attributes at the top level, responses carry them in
+    ``shared`` and ``client``.
+    """
+    if not isinstance(payload, dict):
+        return []
+    return [payload] + [payload[scope] for scope in ["shared", "client"] if isinstance(payload.get(scope), dict)]
+
+
+class InboundMessageQueue:
+    """Thread-safe bounded FIFO queue of inbound MQTT messages.
+
+    Attributes
+    ----------
+    max_size:
+      Maximum number of queued messages.
+    dropped_count:
+      Messages dropped because the queue was full.
+    dropped_attribute_updates:
+      Whether an attribute update was dropped since the attributes were last requested.
+    coalesced_count:
+      Attribute updates removed because later updates superseded them.
+    invalid_count:
+      Messages whose payload was not valid JSON.
+    """
+
+    def __init__(self, max_size: int = MQTT_INBOUND_QUEUE_SIZE) -> None:
+        self.max_size = max_size
+        self.messages: deque[InboundMessage] = deque()
+        self.lock = Lock()
+        self.dropped_count = 0
+        self.dropped_attribute_updates = False
+        self.coalesced_count = 0
+        self.invalid_count = 0
+
+    def put(self, topic: str, raw_payload: bytes) -> bool:
+        """Queue a raw message, called by the network thread.
+
+        Returns:
+          ``False`` if the queue was full and the message was dropped.
+        """
+        with self.lock:
+            if len(self.messages) >= self.max_size:
+                self.dropped_count += 1
+                if topic.startswith(ATTRIBUTES_TOPIC):
+                    self.dropped_attribute_updates = True
+                return False
+            self.messages.append(InboundMessage(topic, raw_payload))
+            return True
+
+    def empty(self) -> bool:
+        return len(self.messages) == 0
+
+    def depth(self) -> int:
+        return len(self.messages)
+
+    def get(self) -> Optional[dict[str, Any]]:
+        """Take the next message with a valid payload.
+
+        Returns:
+          A dictionary with the ``topic`` and the parsed ``payload``, ``None`` if the
+          queue is empty.
+        """
+        while True:
+            with self.lock:
+                if len(self.messages) == 0:
+                    return None
+                message = self.messages.popleft()
+            message.parse()
+            if not message.valid:
+                self.invalid_count += 1
+                warn(f"[MQTT] Skipping message with invalid JSON payload on topic {message.topic}")
+                continue
+            if message.is_attribute_update() and len(message.attribute_groups) > 0:
+                self.coalesce(message)
+                if not self.has_attributes(message):
+                    self.coalesced_count += 1
+                    continue
+            return {"topic": message.topic, "payload": message.payload}
+
+    def coalesce(self, message: InboundMessage) -> None:
+        """Remove superseded attributes from the given message and the queued attribute updates.
+
+        Args:
+          message: Attribute update taken from the queue, older than all queued messages.
+        """
+        with self.lock:
+            queued_updates = [queued for queued in self.messages if queued.is_attribute_update()]
+        # parse outside of the lock, the network thread keeps queueing
+        superseded_groups: set[str] = set()
+        removed_ids: set[int] = set()
+        for update in reversed([message] + queued_updates):
+            update.parse()
+            if not update.valid:
+                continue
+            groups = update.attribute_groups & superseded_groups
+            if len(groups) > 0:
+                for attributes in get_attribute_dicts(update.payload):
+                    for key in [key for key in attributes if COALESCED_ATTRIBUTE_GROUPS.get(key) in groups]:
+                        del attributes[key]
+                update.attribute_groups -= groups
+                if update is not message and not self.has_attributes(update):
+                    removed_ids.add(id(update))
+            superseded_groups |= update.attribute_groups
+        if len(removed_ids) > 0:
+            with self.lock:
+                self.messages = deque(queued for queued in self.messages if id(queued) not in removed_ids)
+            self.coalesced_count += len(removed_ids)
+
+    @staticmethod
+    def has_attributes(message: InboundMessage) -> bool:
+        """Return whether an attribute update still carries any attribute."""
+        return any(len(attributes) > 0 and not (attributes is message.payload and
+                                                set(attributes.keys()) <= {"shared", "client"})
+                   for attributes in get_attribute_dicts(message.payload))
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return the queue depth and the message counters for the auxiliary telemetry."""
+        return {
+            "mqtt_inbound_depth": self.depth(),
+            "mqtt_inbound_dropped": self.dropped_count,
+            "mqtt_inbound_coalesced": self.coalesced_count,
+            "mqtt_inbound_invalid": self.invalid_count,
+        }
@@ -1,12 +1,14 @@
 """Logging utilities for the Edge Gateway.
 
 This module provides lightweight logging helpers used throughout the Edge Gateway
-and controller runtime. Log messages are printed to stdout and, when possible,
-published to ThingsBoard via MQTT.
+and controller runtime. Log messages are printed to stdout and published to
+ThingsBoard via MQTT by a background shipper thread.
 
-If log publication fails (e.g. due to connectivity issues), messages are buffered
-locally in an SQLite database and can be forwarded later once connectivity is
-restored.
+Logging never blocks on the network: :func:`log` only appends the record to an
+in-memory ring buffer. The shipper publishes the buffered records in batches, as
+one telemetry array per batch. While the gateway is offline, the shipper moves
+the buffered records into the log buffer database in one transaction per batch;
+the gateway main loop publishes them from there once connectivity is restored.
 
 Design goals
 ------------
@@ -16,82 +18,437 @@ Design goals
 
 Notes
 -----
-- The log level is controlled via the ``LOG_LEVEL`` environment variable.
+- The default log level is controlled via the ``LOG_LEVEL`` environment variable.
 - Buffered log messages are stored in ``GATEWAY_LOGS_BUFFER_DB_PATH``.
+- Timestamps are unique: records logged within the same millisecond get
+  consecutive timestamps (see :func:`allocate_timestamp_ms`), so ThingsBoard
+  keeps all of them.
+- If more than ``TEG_LOG_RING_BUFFER_SIZE`` records wait for the shipper, the
+  oldest ones are dropped.
+- Records logged by the shipper itself are only printed, so publishing a batch
+  cannot produce further batches.
+
+Suppression
+-----------
+During incidents, the same message is often logged thousands of times. To keep
+the uplink bandwidth and the log buffer database bounded, records are filtered
+before they are queued (all records are still printed):
+
+- Repetitions of a message within ``TEG_LOG_DEDUP_WINDOW_S`` after its first
+  occurrence are counted instead of queued. When the window has passed, one
+  record with the repeat count is queued.
+- Each level has a token bucket of ``TEG_LOG_MAX_RECORDS_PER_MIN`` records per
+  minute. Records exceeding it are counted, and one record with the number of
+  dropped records is queued once the bucket has tokens again.
+
+Configuration
+-------------
+- ``TEG_LOG_RING_BUFFER_SIZE``: Maximum number of queued log records (default: 10000).
+- ``TEG_LOG_DEDUP_WINDOW_S``: Suppression window of repeated messages, ``0``
+  disables it (default: 60).
+- ``TEG_LOG_MAX_RECORDS_PER_MIN``: Maximum number of records per level and
+  minute, ``0`` disables the limit (default: 600).
+- ``TEG_LOG_CAPTURE_RING_SIZE``: Number of recent records kept in the capture
+  ring (default: 2000).
+
+Levels and capture
+------------------
+By default, DEBUG records are only published with ``LOG_LEVEL=DEBUG``, and
+records of all other levels are always published.
+
+Log levels can be set at runtime (:func:`set_log_level`, RPC ``log_level_set``),
+as the default level or for a module and its submodules. Once a level applies to
+a module, records below it are not published. The level of a module is the
+level set for it or for its closest parent package, and the default level set at
+runtime otherwise. Modules are identified by the name of the calling Python
+module, e.g. ``modules.mqtt`` or ``main``.
+
+The most recent records of all levels, including the unpublished DEBUG records,
+are kept in a bounded in-memory capture ring. It is never uploaded by itself;
+:func:`get_captured_records` (RPC ``log_dump``) returns a filtered slice of it
+on request.
 """
 import importlib
 import os
+import sys
+import threading
 import time
+from collections import deque
+from dataclasses import dataclass
+from types import FrameType
+from typing import Any, Optional
 
 # get log level from env var
 LOG_LEVEL: str = os.getenv('LOG_LEVEL') or 'INFO'
+# Rank of the log levels, records below the level of their module are not published
+LOG_LEVEL_RANKS: dict[str, int] = {'DEBUG': 0, 'INFO': 1, 'WARN': 2, 'ERROR': 3}
+# Maximum number of log records waiting for the shipper
+LOG_RING_BUFFER_SIZE: int = int(os.environ.get("TEG_LOG_RING_BUFFER_SIZE") or 10_000)
+# Maximum number of log records per published batch
+LOG_SHIP_BATCH_SIZE: int = 50
+# Interval in which the shipper publishes incomplete batches
+LOG_SHIP_INTERVAL_S: float = 1.0
+# Time before opening the log buffer database is retried after it failed
+LOG_BUFFER_DB_RETRY_S: float = 60.0
+LOG_DEDUP_WINDOW_S: float = float(os.environ.get("TEG_LOG_DEDUP_WINDOW_S") or 60)
+# Maximum number of distinct messages tracked for deduplication
+LOG_DEDUP_MAX_MESSAGES: int = 1_000
+LOG_MAX_RECORDS_PER_MIN: float = float(os.environ.get("TEG_LOG_MAX_RECORDS_PER_MIN") or 600)
+LOG_CAPTURE_RING_SIZE: int = int(os.environ.get("TEG_LOG_CAPTURE_RING_SIZE") or 2_000)
+# Maximum number of characters of a message kept in the capture ring
+LOG_CAPTURE_MAX_MESSAGE_CHARS: int = 1_000
 
 Sqlite = None
 GatewayMqttClient = None
 UtilsPaths = None
+LogBufferTable = None
+MqttModule = None
 gateway_logs_buffer_db = None
+gateway_logs_buffer_queue = None
+gateway_logs_buffer_db_failed_at: Optional[float] = None
+
+# (level, message, timestamp_ms) records waiting for the shipper
+log_records: deque[tuple[str, str, int]] = deque(maxlen=LOG_RING_BUFFER_SIZE)
+log_records_condition = threading.Condition()
+dropped_log_record_count = 0
+shipper_thread: Optional[threading.Thread] = None
+
+last_timestamp_ms = 0
+
+# log levels set at runtime, by module name, and the default level (None: LOG_LEVEL semantics)
+default_log_level: Optional[str] = None
+module_log_levels: dict[str, str] = {}
+# (timestamp_ms, level, module, message) of the most recent records
+captured_records: deque[tuple[int, str, str, str]] = deque(maxlen=LOG_CAPTURE_RING_SIZE)
+# re-entrant, since the signal handlers log on the main thread, which may hold it
+captured_records_lock = threading.RLock()
+
+
+@dataclass
+class LogSuppression:
+    """Suppression window of a repeated message."""
+    first_seen: float
+    repeat_count: int = 0
+
+
+# suppression windows by (level, message), and token buckets by level
+log_suppressions: dict[tuple[str, str], LogSuppression] = {}
+level_tokens: dict[str, tuple[float, float]] = {}
+rate_limited_counts: dict[str, int] = {}
+suppressed_log_record_count = 0
+rate_limited_log_record_count = 0
+
+
+def allocate_timestamp_ms() -> int:
+    """Return the current Unix timestamp in milliseconds, greater than all previously returned ones.
+
+    Timestamps are allocated under :data:`log_records_condition`, which is
+    re-entrant, so the signal handlers can log while the main thread holds it.
+    """
+    global last_timestamp_ms
+    with log_records_condition:
+        last_timestamp_ms = max(int(time.time_ns() / 1000_000), last_timestamp_ms + 1)
+        return last_timestamp_ms
+
 
 def log(level: str, message: str):
-    """Log a message and attempt to publish it via MQTT.
+    """Log a message and queue it for publication via MQTT.
 
-    The message is always printed to stdout. If the MQTT publication fails, the log
-    entry is stored locally in an SQLite buffer database for later processing.
+    The message is always printed to stdout and kept in the capture ring. It is
+    handed to the shipper thread unless the log level of the calling module
+    filters it (see module docstring).
 
     Args:
       level: Log level (e.g. ``DEBUG``, ``INFO``, ``WARN``, ``ERROR``).
       message: Log message text.
     """
     print(f'[{level}] {message}')
-    if level == 'DEBUG' and LOG_LEVEL != 'DEBUG':
+    module = get_caller_module()
+    with captured_records_lock:
+        captured_records.append((int(time.time_ns() / 1000_000), level, module,
+                                 message[:LOG_CAPTURE_MAX_MESSAGE_CHARS]))
+    module_level = get_log_level(module)
+    if module_level is None:
+        if level == 'DEBUG' and LOG_LEVEL != 'DEBUG':
+            return
+    elif LOG_LEVEL_RANKS.get(level, 1) < LOG_LEVEL_RANKS.get(module_level, 1):
         return
+    if threading.current_thread() is shipper_thread:
+        return
+
+    with log_records_condition:
+        if admit_log_record(level, message):
+            queue_log_record(level, message)
+    start_shipper()
+
+
+def get_caller_module() -> str:
+    """Return the name of the module that called the logging functions (``main`` for the entry point)."""
+    frame: Optional[FrameType] = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return __name__
+    module: str = frame.f_globals.get('__name__') or '?'
+    return 'main' if module == '__main__' else module
+
+
+def get_log_level(module: str) -> Optional[str]:
+    """Return the log level set at runtime for a module or its closest parent package, or as the default.
+
+    Returns:
+      ``None`` if no level was set at runtime, ``LOG_LEVEL`` applies then.
+    """
+    if len(module_log_levels) == 0:
+        return default_log_level
+    matches = [name for name in module_log_levels if module == name or module.startswith(name + '.')]
+    if len(matches) == 0:
+        return default_log_level
+    return module_log_levels[max(matches, key=len)]
+
 
-    # import GatewayMqttClient at runtime to avoid circular imports
-    global GatewayMqttClient
-    if GatewayMqttClient is None:
-        GatewayMqttClient = importlib.import_module('modules.mqtt').GatewayMqttClient
+def set_log_level(level: Optional[str], module: Optional[str] = None) -> None:
+    """Set the log level of a module and its submodules, or the default level, at runtime.
 
-    # import UtilsPaths at runtime to avoid circular imports
-    global UtilsPaths
+    Args:
+      level: Log level (``DEBUG``, ``INFO``, ``WARN`` or ``ERROR``), ``None`` to
+        remove the level of the module, or to restore the ``LOG_LEVEL`` behavior
+        as the default.
+      module: Module name (e.g. ``modules.mqtt``), ``None`` for the default level.
+
+    Raises:
+      ValueError: If the level is unknown.
+    """
+    global default_log_level
+    if level is not None and level not in LOG_LEVEL_RANKS:
+        raise ValueError(f"unknown log level '{level}', use one of {', '.join(LOG_LEVEL_RANKS)}")
+    if module is None:
+        default_log_level = level
+    elif level is None:
+        module_log_levels.pop(module, None)
+    else:
+        module_log_levels[module] = level
+
+
+def get_log_levels() -> dict[str, Any]:
+    """Return the default log level and the levels set for modules at runtime."""
+    return {"default": default_log_level or LOG_LEVEL, "default_set_at_runtime": default_log_level is not None,
+            "modules": dict(module_log_levels)}
+
+
+def get_captured_records(module: Optional[str] = None, min_level: Optional[str] = None,
+                         contains: Optional[str] = None, since_ms: Optional[int] = None,
+                         limit: Optional[int] = None) -> list[dict[str, Any]]:
+    """Return the most recent records of the capture ring that match all given filters, oldest first.
+
+    Args:
+      module: Module name; records of the module and its submodules match.
+      min_level: Minimum log level.
+      contains: Text the message contains.
+      since_ms: Minimum Unix timestamp in milliseconds.
+      limit: Maximum number of returned records.
+    """
+    with captured_records_lock:
+        records = list(captured_records)
+    min_rank = LOG_LEVEL_RANKS.get(min_level or 'DEBUG', 0)
+    matching = [
+        {"ts": timestamp_ms, "level": level, "module": record_module, "message": message}
+        for timestamp_ms, level, record_module, message in records
+        if (module is None or record_module == module or record_module.startswith(module + '.'))
+        and LOG_LEVEL_RANKS.get(level, 1) >= min_rank
+        and (contains is None or contains in message)
+        and (since_ms is None or timestamp_ms >= since_ms)
+    ]
+    return matching if limit is None else matching[max(0, len(matching) - limit):]
+
+
+def queue_log_record(level: str, message: str) -> None:
+    """Queue a log record for the shipper. Must hold :data:`log_records_condition`."""
+    global dropped_log_record_count
+    if len(log_records) == log_records.maxlen:
+        dropped_log_record_count += 1
+    log_records.append((level, message, allocate_timestamp_ms()))
+    if len(log_records) >= LOG_SHIP_BATCH_SIZE:
+        log_records_condition.notify()
+
+
+def admit_log_record(level: str, message: str) -> bool:
+    """Return whether a record passes the suppression window and the token bucket of its level.
+
+    Must hold :data:`log_records_condition`.
+    """
+    global suppressed_log_record_count, rate_limited_log_record_count
+    now = time.monotonic()
+    key = (level, message)
+    suppression = log_suppressions.get(key)
+    if suppression is not None and now - suppression.first_seen < LOG_DEDUP_WINDOW_S:
+        suppression.repeat_count += 1
+        suppressed_log_record_count += 1
+        return False
+    if suppression is not None:
+        release_suppression(key, suppression)
+    if not take_level_token(level, now):
+        rate_limited_counts[level] = rate_limited_counts.get(level, 0) + 1
+        rate_limited_log_record_count += 1
+        return False
+    if LOG_DEDUP_WINDOW_S > 0 and len(log_suppressions) < LOG_DEDUP_MAX_MESSAGES:
+        log_suppressions[key] = LogSuppression(now)
+    return True
+
+
+def take_level_token(level: str, now: float) -> bool:
+    """Take a token from the bucket of a level, if it has one."""
+    if LOG_MAX_RECORDS_PER_MIN <= 0:
+        return True
+    tokens, updated = level_tokens.get(level, (LOG_MAX_RECORDS_PER_MIN, now))
+    tokens = min(LOG_MAX_RECORDS_PER_MIN, tokens + (now - updated) * LOG_MAX_RECORDS_PER_MIN / 60)
+    if tokens < 1:
+        level_tokens[level] = (tokens, now)
+        return False
+    level_tokens[level] = (tokens - 1, now)
+    return True
+
+
+def release_suppression(key: tuple[str, str], suppression: LogSuppression) -> None:
+    """End a suppression window, queueing the repeat count. Must hold :data:`log_records_condition`."""
+    del log_suppressions[key]
+    if suppression.repeat_count > 0:
+        level, message = key
+        queue_log_record(level, f"{message} (repeated {suppression.repeat_count} times "
+                                f"within {round(LOG_DEDUP_WINDOW_S)} s)")
+
+
+def release_log_summaries() -> None:
+    """Queue the records summarizing suppressed messages whose window or rate limit has passed."""
+    with log_records_condition:
+        now = time.monotonic()
+        for key, suppression in list(log_suppressions.items()):
+            if now - suppression.first_seen >= LOG_DEDUP_WINDOW_S:
+                release_suppression(key, suppression)
+        for level, count in list(rate_limited_counts.items()):
+            if take_level_token(level, now):
+                del rate_limited_counts[level]
+                queue_log_record(level, f"{count} {level} log messages dropped by the rate limit "
+                                        f"of {round(LOG_MAX_RECORDS_PER_MIN)} messages per minute")
+
+
+def start_shipper() -> None:
+    """Start the shipper thread if it is not running yet."""
+    global shipper_thread
+    if shipper_thread is not None:
+        return
+    with log_records_condition:
+        if shipper_thread is None:
+            shipper_thread = threading.Thread(target=run_shipper, name="log-shipper", daemon=True)
+            shipper_thread.start()
+
+
+def run_shipper() -> None:
+    """Publish the queued log records in batches, and spill them to the database while offline."""
+    while True:
+        with log_records_condition:
+            if len(log_records) < LOG_SHIP_BATCH_SIZE:
+                log_records_condition.wait(LOG_SHIP_INTERVAL_S)
+        try:
+            release_log_summaries()
+            ship_log_records()
+        except Exception as e:
+            print(f'Failed to ship log messages: {e}')
+
+
+def take_log_records(max_count: Optional[int] = None) -> list[tuple[str, str, int]]:
+    """Remove and return the oldest queued log records."""
+    with log_records_condition:
+        count = len(log_records) if max_count is None else min(max_count, len(log_records))
+        return [log_records.popleft() for _ in range(count)]
+
+
+def ship_log_records() -> None:
+    """Publish the queued log records while connected, otherwise move them into the database."""
+    # import the MQTT module at runtime to avoid circular imports
+    global GatewayMqttClient, MqttModule
+    if MqttModule is None:
+        MqttModule = importlib.import_module('modules.mqtt')
+        GatewayMqttClient = MqttModule.GatewayMqttClient
+
+    while len(log_records) > 0:
+        mqtt_client = GatewayMqttClient()
+        if not (mqtt_client.initialized and mqtt_client.connected):
+            spill_log_records()
+            return
+        records = take_log_records(LOG_SHIP_BATCH_SIZE)
+        if not mqtt_client.publish_telemetry_batch([
+                MqttModule.build_log_telemetry_payload(level, message, timestamp_ms)
+                for level, message, timestamp_ms in records]):
+            print(f'Failed to publish {len(records)} log messages via MQTT, buffering them.')
+            buffer_log_records(records)
+            spill_log_records()
+            return
+
+
+def spill_log_records() -> None:
+    """Move all queued log records into the log buffer database, in one transaction."""
+    records = take_log_records()
+    if len(records) > 0:
+        buffer_log_records(records)
+
+
+def buffer_log_records(records: list[tuple[str, str, int]]) -> None:
+    """Write log records into the log buffer database, to be published by the main loop."""
+    log_buffer_queue = get_log_buffer_queue()
+    if log_buffer_queue is None:
+        print(f'Log buffer database unavailable, dropping {len(records)} log messages.')
+        return
+    print(f'Buffering {len(records)} unpublished log messages.')
+    log_buffer_queue.push_many(records)
+
+
+def get_log_buffer_queue():
+    """Return the queue of the log buffer database, opening the database on first use."""
+    # import the dependencies at runtime to avoid circular imports
+    global UtilsPaths, Sqlite, LogBufferTable
     if UtilsPaths is None:
         UtilsPaths = importlib.import_module('utils.paths')
-
-    # import sqlite at runtime to avoid circular imports
-    global Sqlite
     if Sqlite is None:
         Sqlite = importlib.import_module('modules.sqlite')
+    if LogBufferTable is None:
+        LogBufferTable = importlib.import_module('db_schemas.log_buffer_table')
 
     # initialize gateway_logs_buffer_db if not already initialized
-    global gateway_logs_buffer_db
+    global gateway_logs_buffer_db, gateway_logs_buffer_queue, gateway_logs_buffer_db_failed_at
     if gateway_logs_buffer_db is None:
+        if (gateway_logs_buffer_db_failed_at is not None
+                and time.monotonic() - gateway_logs_buffer_db_failed_at < LOG_BUFFER_DB_RETRY_S):
+            return None
         gateway_logs_buffer_db = Sqlite.SqliteConnection(UtilsPaths.GATEWAY_LOGS_BUFFER_DB_PATH, dont_retry=True)
         if gateway_logs_buffer_db.db_unavailable:
             gateway_logs_buffer_db = None
+            gateway_logs_buffer_db_failed_at = time.monotonic()
+            return None
+        gateway_logs_buffer_db.execute(LogBufferTable.CREATE_LOG_BUFFER_TABLE_QUERY)
+        gateway_logs_buffer_queue = Sqlite.DurableQueue(
+            gateway_logs_buffer_db, Sqlite.SqliteTables.LOG_BUFFER.value, LogBufferTable.LOG_BUFFER_COLUMNS)
+    return gateway_logs_buffer_queue
 
-    # attempt to publish log message via MQTT
-    publish_failure = False
+
+def flush_log_records() -> None:
+    """Move the queued log records into the log buffer database, e.g. before shutting down."""
     try:
-        if not GatewayMqttClient().publish_log(level, message):
-            publish_failure = True
-            print(f'Failed to publish log message via MQTT.')
+        release_log_summaries()
+        spill_log_records()
     except Exception as e:
-        publish_failure = True
-        print(f'Failed to publish log message via MQTT: {e}')
-
-    # buffer unpublished message in sqlite db to be published later
-    if publish_failure and gateway_logs_buffer_db is not None:
-        print(f'Buffering unpublished message.')
-        gateway_logs_buffer_db.execute("""
-            CREATE TABLE IF NOT EXISTS log_buffer (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                log_level text,
-                message text,
-                timestamp_ms INTEGER
-            );
-        """)
-        gateway_logs_buffer_db.execute(
-            "INSERT INTO log_buffer (log_level, message, timestamp_ms) VALUES (?, ?, ?)",
-            (level, message, int(time.time_ns() / 1000_000))
-        )
+        print(f'Failed to buffer log messages: {e}')
+
+
+def get_telemetry_values() -> dict[str, int]:
+    """Return the number of queued, dropped and suppressed log records for the auxiliary telemetry."""
+    return {
+        "log_records_queued": len(log_records),
+        "log_records_dropped": dropped_log_record_count,
+        "log_records_deduplicated": suppressed_log_record_count,
+        "log_records_rate_limited": rate_limited_log_record_count,
+    }
+
 
 def debug(message: str):
     """Log a DEBUG-level message."""
@@ -107,4 +464,4 @@ def error(message: str):
 
 def warn(message: str):
     """Log a WARN-level message."""
-    log('WARN', message)
\ No newline at end of file
+    log('WARN', message)
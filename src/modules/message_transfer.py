@@ -0,0 +1,197 @@
+"""Batched transfer of controller messages into the uplink queue and archive.
+
+The controller writes its messages into the ``messages`` table of the
+communication queue database. This module moves them from there into the
+``pending_mqtt_messages`` table (the uplink queue) and into the local archive.
+
+Instead of moving one row per main loop iteration with one autocommit statement
+per write, rows are moved in batches: the pending inserts and the removal of the
+transferred controller rows are committed in a single transaction. Archive rows
+are buffered in memory and written in bulk, either when the buffer is full, when
+it is old enough, or when the gateway shuts down.
+
+Cursor mode
+-----------
+With ``TEG_CONTROLLER_QUEUE_MODE=cursor``, controller messages are no longer
+copied into the uplink queue. Instead, two :class:`modules.sqlite.QueueCursor`
+instances read the ``messages`` table independently: the ``archive`` cursor used
+here, which only archives, and the ``uplink`` cursor used by
+:class:`modules.pending_publisher.PendingMessagePublisher`. Rows consumed by both
+are removed in bulk by the main loop when it is idle. The archive cursor only
+advances once the archive rows are written, so no archive rows are lost on a
+hard kill.
+
+Notes
+-----
+- A batch is limited by a maximum number of rows and by a processing time budget,
+  so a single transfer never stalls the main loop.
+- Controller log messages are forwarded but not archived.
+- In the default mode, archive rows still in the buffer are lost if the process
+  is killed without a graceful shutdown; the messages themselves remain in the
+  uplink queue.
+- Switching back from cursor mode drops the cursors. Rows the uplink cursor had
+  consumed but the archive cursor had not are published again.
+"""
+
+import json
+import os
+from time import monotonic
+from typing import Optional
+
+from modules import sqlite
+from modules.archive import GatewayArchive
+from modules.compression import PayloadCodec
+from modules.logging import warn, debug
+
+# "copy" moves controller messages into the uplink queue, "cursor" reads them in place
+CONTROLLER_QUEUE_CURSOR_MODE: bool = (os.environ.get("TEG_CONTROLLER_QUEUE_MODE") or "copy") == "cursor"
+# Minimum number of rows consumed by all cursors before the controller queue is truncated
+CURSOR_TRUNCATE_MIN_ROWS: int = 1_000
+
+# Maximum number of controller messages moved per transaction
+TRANSFER_MAX_BATCH_SIZE: int = 500
+# Maximum time spent preparing a single batch
+TRANSFER_MAX_BATCH_DURATION_MS: int = 200
+# Maximum number of buffered archive rows before they are written to disk
+ARCHIVE_BUFFER_MAX_SIZE: int = 1_000
+# Maximum age of the oldest buffered archive row before the buffer is written to disk
+ARCHIVE_FLUSH_INTERVAL_MS: int = 10_000
+
+
+class ControllerMessageTransfer:
+    """Move controller messages into the uplink queue and the archive in batches.
+
+    Attributes
+    ----------
+    controller_queue:
+      Queue of controller messages (``messages`` table).
+    pending_queue:
+      Queue of messages waiting for upload (``pending_mqtt_messages`` table), in
+      the same database as :attr:`controller_queue`.
+    archive:
+      Archive the messages are written to.
+    payload_codec:
+      Encodes payloads for storage in the pending queue.
+    archive_cursor:
+      Cursor over :attr:`controller_queue` in cursor mode, ``None`` otherwise.
+    archive_buffer:
+      ``(timestamp_ms, values_json)`` rows waiting to be written to the archive.
+    """
+
+    def __init__(self, controller_queue: sqlite.DurableQueue, pending_queue: sqlite.DurableQueue,
+                 archive: GatewayArchive, payload_codec: PayloadCodec,
+                 archive_cursor: Optional[sqlite.QueueCursor] = None) -> None:
+        self.controller_queue = controller_queue
+        self.pending_queue = pending_queue
+        self.archive = archive
+        self.payload_codec = payload_codec
+        self.archive_cursor = archive_cursor
+        self.archive_buffer: list[tuple[int, str]] = []
+        self.archive_buffer_since: Optional[float] = None
+        # highest controller message id read into the archive buffer (cursor mode)
+        self.last_buffered_id = 0
+
+    def transfer_batch(self) -> int:
+        """Move the oldest controller messages into the uplink queue.
+
+        Up to :data:`TRANSFER_MAX_BATCH_SIZE` rows are moved within a single
+        transaction. Non-log messages are added to the archive buffer afterwards.
+        In cursor mode, rows are only added to the archive buffer.
+
+        Returns:
+          Number of controller messages transferred.
+        """
+        if self.archive_cursor is not None:
+            rows = self.archive_cursor.peek_batch(TRANSFER_MAX_BATCH_SIZE, after_id=self.last_buffered_id)
+        else:
+            rows = self.controller_queue.peek_batch(TRANSFER_MAX_BATCH_SIZE)
+        if len(rows) == 0:
+            return 0
+
+        start_time = monotonic()
+        pending_rows: list[tuple] = []
+        archive_rows: list[tuple[int, str]] = []
+        last_message_id = None
+        for message_id, message_type, message in rows:
+            # archive controller messages in the archive sqlite db, except for log messages
+            if "log" not in (message_type or ""):
+                try:
+                    message_obj = json.loads(message)
+                    archive_rows.append((message_obj["ts"], json.dumps(message_obj["values"])))
+                except (ValueError, KeyError, TypeError) as e:
+                    warn(f"[TRANSFER] Not archiving malformed controller message {message_id}: {e}")
+            if self.archive_cursor is None:
+                pending_rows.append((message_type, *self.payload_codec.encode(message)))
+            else:
+                pending_rows.append((message_type, message))
+            last_message_id = message_id
+            if (monotonic() - start_time) * 1000 > TRANSFER_MAX_BATCH_DURATION_MS:
+                break
+
+        assert last_message_id is not None
+        if self.archive_cursor is not None:
+            self.last_buffered_id = last_message_id
+            self.buffer_archive_rows(archive_rows)
+            return len(pending_rows)
+
+        # add messages to the pending queue and remove them from the controller queue atomically
+        committed = self.controller_queue.db.execute_batch([
+            (self.pending_queue.push_query, pending_rows),
+            (self.controller_queue.ack_through_query, [(last_message_id,)]),
+        ])
+        # the dictionary may only change between transactions
+        self.payload_codec.end_batch()
+        if not committed:
+            return 0
+        debug(f"[TRANSFER] Transferred {len(pending_rows)} controller messages")
+        self.buffer_archive_rows(archive_rows)
+        return len(pending_rows)
+
+    def buffer_archive_rows(self, archive_rows: list[tuple[int, str]]) -> None:
+        """Add rows to the archive buffer and write it to disk if due."""
+        if len(archive_rows) == 0 and self.archive_cursor is None:
+            return
+        if self.archive_buffer_since is None:
+            self.archive_buffer_since = monotonic()
+        self.archive_buffer.extend(archive_rows)
+        self.flush_archive_if_due()
+
+    def flush_archive_if_due(self) -> None:
+        """Write the archive buffer to disk if it is full or old enough."""
+        if self.archive_buffer_since is None:
+            return
+        if (len(self.archive_buffer) >= ARCHIVE_BUFFER_MAX_SIZE
+                or (monotonic() - self.archive_buffer_since) * 1000 >= ARCHIVE_FLUSH_INTERVAL_MS):
+            self.flush_archive()
+
+    def ms_until_archive_flush(self) -> Optional[float]:
+        """Return the time until the archive buffer is due to be written to disk.
+
+        Returns:
+          Milliseconds until the flush is due, or ``None`` if the buffer is empty.
+        """
+        if self.archive_buffer_since is None:
+            return None
+        return max(0.0, ARCHIVE_FLUSH_INTERVAL_MS - (monotonic() - self.archive_buffer_since) * 1000)
+
+    def flush_archive(self) -> int:
+        """Write all buffered archive rows to the archive, in one transaction per shard.
+
+        In cursor mode, the archive cursor is advanced past the buffered messages
+        afterwards, also if all of them were log messages.
+
+        Returns:
+          Number of archived rows written.
+        """
+        archive_rows = self.archive_buffer
+        self.archive_buffer = []
+        self.archive_buffer_since = None
+        if len(archive_rows) > 0 and not self.archive.insert_many(archive_rows):
+            warn(f"[TRANSFER] Failed to archive {len(archive_rows)} controller messages")
+            if self.archive_cursor is not None:
+                # read the messages again
+                self.last_buffered_id = self.archive_cursor.position
+            return 0
+        if self.archive_cursor is not None:
+            self.archive_cursor.ack_through(self.last_buffered_id)
+        return len(archive_rows)
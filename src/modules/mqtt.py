@@ -8,7 +8,10 @@ The client is responsible for:
 - Establishing a TLS-secured MQTT connection using a ThingsBoard access token.
 - Subscribing to RPC, attribute, and OTA update topics.
 - Publishing telemetry and attributes (including OTA software state ``sw_state``).
-- Providing a thread-safe inbound message queue for the gateway main loop.
+- Providing a bounded inbound message queue for the gateway main loop (see
+  :mod:`modules.inbound_queue`).
+- Tracking acknowledgements (PUBACK) of asynchronously published QoS 1 messages,
+  and reporting their round-trip times to :mod:`modules.rate_controller`.
 
 Notes
 -----
@@ -22,15 +25,70 @@ import os
 import ssl
 import json
 import time
-from queue import Queue
-from typing import Any, Optional, Union
+from collections import OrderedDict
+from threading import Condition, RLock
+from typing import Any, Iterable, Optional, Union
 
-from paho.mqtt.client import Client
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
 
-from modules.logging import info, error, debug, warn
+from modules.inbound_queue import InboundMessageQueue
+from modules.logging import allocate_timestamp_ms, info, error, debug, warn
+from modules.rate_controller import UplinkRateController
+from utils.wakeup import notify_main_loop
 
 singleton_instance: Optional["GatewayMqttClient"] = None
 
+# Maximum number of unacknowledged QoS > 0 messages handed to the broker at once
+MAX_INFLIGHT_MESSAGES: int = 32
+# Shared attributes requested after connecting
+SHARED_ATTRIBUTE_KEYS: str = "sw_title,sw_url,sw_version,FILES"
+# Maximum number of acknowledgements kept for message ids that are not registered yet
+MAX_EARLY_ACKS: int = 1_000
+
+
+def join_telemetry_payloads(messages: list[str]) -> str:
+    """Join JSON-encoded telemetry payloads into one JSON array payload.
+
+    ThingsBoard accepts a JSON array of ``{ts, values}`` objects on the telemetry
+    topic. The payloads are concatenated as text without being re-serialized;
+    payloads that are arrays themselves are merged into the outer array.
+
+    Args:
+      messages: JSON-encoded telemetry objects or arrays of objects.
+
+    Returns:
+      JSON array payload string.
+    """
+    elements = []
+    for message in messages:
+        message = message.strip()
+        if message.startswith("["):
+            message = message[1:-1].strip()
+        if len(message) > 0:
+            elements.append(message)
+    return "[" + ",".join(elements) + "]"
+
+
+def build_log_telemetry_payload(log_level: str, log_message: str, timestamp_ms: int) -> str:
+    """Build the telemetry payload for a gateway log record.
+
+    Args:
+      log_level: Severity string.
+      log_message: Log message text, prefixed with ``GATEWAY -`` followed by a space.
+      timestamp_ms: Unix timestamp in milliseconds.
+
+    Returns:
+      JSON-encoded telemetry payload.
+    """
+    return json.dumps({
+        "ts": timestamp_ms,
+        "values": {
+            "severity": log_level,
+            "message": "GATEWAY - " + log_message
+        }
+    })
+
+
 class GatewayMqttClient(Client):
     """MQTT client used by the Edge Gateway to communicate with ThingsBoard.
 
@@ -38,13 +96,29 @@ class GatewayMqttClient(Client):
     topics and exposes helper methods to publish telemetry, attributes, and software
     update state.
 
-    Incoming MQTT messages are placed into :attr:`message_queue` as dictionaries with
-    ``topic`` and parsed JSON ``payload`` fields.
+    Incoming MQTT messages are placed into :attr:`message_queue` unparsed, and taken
+    by :meth:`get_message` as dictionaries with ``topic`` and parsed JSON ``payload``
+    fields.
+
+    Messages published via :meth:`publish_message_async` are tracked by their message
+    id until the broker acknowledges them; acknowledged ids can be collected with
+    :meth:`pop_acked_message_ids`.
+
+    Inbound messages, acknowledgements and connection changes wake up the gateway
+    main loop (see :mod:`utils.wakeup`).
     """
     attribute_request_id: int = 0
     initialized: bool = False
     connected: bool = False
-    message_queue: Queue = Queue()
+    message_queue: InboundMessageQueue = InboundMessageQueue()
+    unacked_message_ids: set[int] = set()
+    acked_message_ids: set[int] = set()
+    # monotonic send time of unacknowledged asynchronous publishes, by message id
+    publish_sent_at: dict[int, float] = {}
+    # monotonic ack time of message ids acknowledged before publish_message_async registered them
+    early_acks: OrderedDict[int, float] = OrderedDict()
+    publish_ack_lock: RLock = RLock()
+    publish_ack_condition: Condition = Condition(publish_ack_lock)
 
     def __init__(self):
         global singleton_instance
@@ -78,15 +152,21 @@ class GatewayMqttClient(Client):
         else:
             self.tls_set(cert_reqs=ssl.CERT_REQUIRED)
         self.username_pw_set(access_token, "")
+        self.max_inflight_messages_set(MAX_INFLIGHT_MESSAGES)
 
         # set up the callbacks
         self.on_connect = self.__on_connect
         self.on_message = self.__on_message
         self.on_disconnect = self.__on_disconnect
+        self.on_publish = self.__on_publish
 
         self.initialized = True
         self.connected = False
         self.attribute_request_id = 0
+        self.unacked_message_ids = set()
+        self.acked_message_ids = set()
+        self.publish_sent_at = {}
+        self.early_acks = OrderedDict()
 
         return self
 
@@ -109,19 +189,58 @@ class GatewayMqttClient(Client):
         self.subscribe("v2/fw/response/+")
 
         self.connected = True
-        self.request_attributes({"sharedKeys": "sw_title,sw_url,sw_version,FILES"})
+        self.request_attributes({"sharedKeys": SHARED_ATTRIBUTE_KEYS})
         self.update_sys_info_attribute()
+        notify_main_loop()
 
     def __on_disconnect(self, _client, _userdata, result_code) -> None:
         self.connected = False
+        UplinkRateController().on_failure()
         info(f"[MQTT] Disconnected from ThingsBoard with result code: {result_code}")
         self.graceful_exit()
+        notify_main_loop()
 
     def __on_message(self, _client, _userdata, msg) -> None:
-        self.message_queue.put({
-            "topic": msg.topic,
-            "payload": json.loads(msg.payload)
-        })
+        # parsed by the main loop, this thread also keeps the connection alive
+        if not self.message_queue.put(msg.topic, msg.payload):
+            print(f"[MQTT] Inbound message queue is full, dropped message on topic {msg.topic}")
+        notify_main_loop()
+
+    def __on_publish(self, _client, _userdata, mid) -> None:
+        # called while paho holds its outgoing message mutex, which publish() takes as well:
+        # publish_ack_lock is never held while calling publish()
+        with self.publish_ack_lock:
+            sent_at = self.publish_sent_at.pop(mid, None)
+            if mid in self.unacked_message_ids:
+                self.unacked_message_ids.discard(mid)
+                self.acked_message_ids.add(mid)
+                self.publish_ack_condition.notify_all()
+                notify_main_loop()
+            else:
+                # publish_message_async may not have registered the id yet
+                self.early_acks[mid] = time.monotonic()
+                self.early_acks.move_to_end(mid)
+                if len(self.early_acks) > MAX_EARLY_ACKS:
+                    self.early_acks.popitem(last=False)
+        if sent_at is not None:
+            UplinkRateController().on_ack((time.monotonic() - sent_at) * 1000)
+
+    def get_message(self) -> Optional[dict[str, Any]]:
+        """Take the next inbound message.
+
+        Once the queue has drained after attribute updates were dropped, the
+        attributes are requested again.
+
+        Returns:
+          A dictionary with the ``topic`` and the parsed ``payload``, ``None`` if no
+          message is queued.
+        """
+        msg = self.message_queue.get()
+        if msg is None and self.message_queue.dropped_attribute_updates and self.connected:
+            self.message_queue.dropped_attribute_updates = False
+            warn("[MQTT] Inbound attribute updates were dropped, requesting the attributes again")
+            self.request_attributes({"sharedKeys": SHARED_ATTRIBUTE_KEYS})
+        return msg
 
     def publish_sw_state(self, version: str, state: str, msg : Optional[str]=None) -> None:
         """Publish ThingsBoard OTA software state telemetry.
@@ -149,6 +268,17 @@ class GatewayMqttClient(Client):
         """
         return self.publish_message_raw("v1/devices/me/telemetry", message)
 
+    def publish_telemetry_batch(self, messages: list[str]) -> bool:
+        """Publish several telemetry payloads as a single MQTT message.
+
+        Args:
+          messages: JSON-encoded telemetry payloads (see :func:`join_telemetry_payloads`).
+
+        Returns:
+          ``True`` if the publish succeeded, otherwise ``False``.
+        """
+        return self.publish_telemetry(join_telemetry_payloads(messages))
+
     def publish_message_raw(self, topic: str, message: str) -> bool:
         """Publish a raw MQTT message to a topic.
 
@@ -167,10 +297,98 @@ class GatewayMqttClient(Client):
             self.publish(topic, message).wait_for_publish(5)
         except Exception as e:
             print(f'[MQTT] Failed to publish message "{message}" to topic "{topic}": {e}')
+            UplinkRateController().on_failure()
             return False
 
         return True
 
+    def publish_message_async(self, topic: str, message: str, qos: int = 1) -> Optional[int]:
+        """Publish a message without waiting for the broker acknowledgement.
+
+        The returned message id is reported by :meth:`pop_acked_message_ids` once the
+        broker acknowledged the message (PUBACK for QoS 1).
+
+        Args:
+          topic: MQTT topic.
+          message: JSON-encoded payload string.
+          qos: MQTT quality of service level.
+
+        Returns:
+          The MQTT message id, or ``None`` if the message could not be published.
+        """
+        if not self.initialized or not self.connected:
+            print(f'[MQTT] MQTT client is not connected/initialized, cannot publish message to topic "{topic}"')
+            return None
+        try:
+            sent_at = time.monotonic()
+            # not under publish_ack_lock, see __on_publish
+            message_info = self.publish(topic, message, qos=qos)
+        except Exception as e:
+            print(f'[MQTT] Failed to publish message to topic "{topic}": {e}')
+            UplinkRateController().on_failure()
+            return None
+        if message_info.rc != MQTT_ERR_SUCCESS:
+            print(f'[MQTT] Failed to publish message to topic "{topic}": rc={message_info.rc}')
+            UplinkRateController().on_failure()
+            return None
+
+        mid = message_info.mid
+        with self.publish_ack_lock:
+            acked_at = self.early_acks.pop(mid, None)
+            # acks older than this publish belong to an earlier message with the same id
+            if acked_at is not None and acked_at >= sent_at:
+                self.acked_message_ids.add(mid)
+                self.publish_ack_condition.notify_all()
+            else:
+                self.unacked_message_ids.add(mid)
+                self.publish_sent_at[mid] = sent_at
+        if acked_at is not None and acked_at >= sent_at:
+            UplinkRateController().on_ack((acked_at - sent_at) * 1000)
+            notify_main_loop()
+        return mid
+
+    def pop_acked_message_ids(self, message_ids: Iterable[int]) -> set[int]:
+        """Return and forget those of the given asynchronous publishes that were acknowledged.
+
+        Args:
+          message_ids: Message ids the caller is waiting for.
+
+        Returns:
+          The subset of ``message_ids`` acknowledged since they were published.
+        """
+        with self.publish_ack_lock:
+            acked_message_ids = self.acked_message_ids.intersection(message_ids)
+            self.acked_message_ids.difference_update(acked_message_ids)
+        return acked_message_ids
+
+    def wait_for_message_ack(self, message_id: int, timeout_s: float) -> bool:
+        """Block until an asynchronous publish is acknowledged, then stop tracking it.
+
+        Args:
+          message_id: Message id returned by :meth:`publish_message_async`.
+          timeout_s: Maximum time to wait in seconds.
+
+        Returns:
+          ``True`` if the publish was acknowledged, ``False`` on timeout.
+        """
+        with self.publish_ack_condition:
+            acked = self.publish_ack_condition.wait_for(lambda: message_id in self.acked_message_ids, timeout_s)
+            self.acked_message_ids.discard(message_id)
+            self.unacked_message_ids.discard(message_id)
+            self.publish_sent_at.pop(message_id, None)
+        if not acked:
+            UplinkRateController().on_failure()
+        return acked
+
+    def forget_message_ids(self, message_ids: Iterable[int]) -> None:
+        """Stop tracking the given asynchronous publishes, acknowledged or not."""
+        message_ids = list(message_ids)
+        with self.publish_ack_lock:
+            self.unacked_message_ids.difference_update(message_ids)
+            self.acked_message_ids.difference_update(message_ids)
+            for message_id in message_ids:
+                self.publish_sent_at.pop(message_id, None)
+
     def request_attributes(self, request_dict: dict) -> bool:
         """Request shared/client attributes from ThingsBoard.
 
@@ -192,19 +410,13 @@ class GatewayMqttClient(Client):
           log_message: Log message text. The gateway prefixes the message with
             ``GATEWAY -`` followed by a space before publishing.
           timestamp_ms: Optional Unix timestamp in milliseconds. If not provided, a
-            timestamp is generated locally.
+            unique timestamp is allocated locally (see :func:`modules.logging.allocate_timestamp_ms`).
 
         Returns:
           ``True`` if the publish succeeded, otherwise ``False``.
         """
-        time.sleep(1/1000) # sleep for 1ms to avoid duplicate timestamps
-        return self.publish_telemetry(json.dumps({
-            "ts": timestamp_ms or int(time.time_ns() / 1000_000),
-            "values": {
-                "severity": log_level,
-                "message": "GATEWAY - " + log_message
-            }
-        }))
+        return self.publish_telemetry(build_log_telemetry_payload(
+            log_level, log_message, timestamp_ms or allocate_timestamp_ms()))
 
     def update_sys_info_attribute(self) -> None:
         """Publish basic system information as a client attribute.
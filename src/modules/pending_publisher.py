@@ -0,0 +1,335 @@
+"""Batched, pipelined publishing of the pending MQTT message queue.
+
+Controller messages waiting for upload are stored in the ``pending_mqtt_messages``
+table of the communication queue database. This module drains that table by
+packing many rows into a single ThingsBoard telemetry payload (a JSON array of
+``{ts, values}`` objects) instead of publishing one row per MQTT round-trip.
+
+Batches are published with QoS 1 without waiting for each acknowledgement. Up to
+``TEG_PUBLISH_WINDOW_SIZE`` batches are kept in flight at the same time, so the
+throughput is no longer capped at one batch per broker round-trip. The rows of a
+batch are removed from the queue only once its PUBACK arrives. Rows stored in a
+compressed format (see :mod:`modules.compression`) are decoded right before they
+are packed into a payload.
+
+Configuration
+-------------
+- ``TEG_TELEMETRY_BATCH_MAX_RECORDS``: Maximum number of rows per payload (default: 200).
+  The rows per payload and the publish rate are further limited by
+  :mod:`modules.rate_controller`, depending on the state of the link.
+- ``TEG_TELEMETRY_BATCH_MAX_BYTES``: Maximum payload size in bytes (default: 32768).
+  A single row larger than the budget is still published on its own.
+- ``TEG_PUBLISH_WINDOW_SIZE``: Maximum number of unacknowledged batches (default: 8).
+- ``TEG_UPLINK_DRAIN_ORDER``: ``fifo`` (default) or ``newest_first``.
+- ``TEG_BACKFILL_MAX_MESSAGES_PER_S``: Publish rate of the backfill in newest-first
+  mode (default: 100).
+- ``TEG_UPLINK_MAX_AGE_S``: Age in seconds after which controller messages are no
+  longer published (default: ``0``, no limit).
+
+In cursor mode (see :mod:`modules.message_transfer`), a second publisher reads
+the controller ``messages`` table directly through the ``uplink``
+:class:`modules.sqlite.QueueCursor`; acknowledged batches then advance the cursor
+instead of deleting rows.
+
+Newest-first drain
+------------------
+After a long outage, draining the queue oldest first keeps the dashboards hours
+behind until the whole backlog is sent. With ``TEG_UPLINK_DRAIN_ORDER=newest_first``,
+a :class:`NewestFirstDrain` splits each queue into two publishers:
+
+- The live publisher only sends rows after a split id. Whenever more than one
+  batch of rows is waiting after it, the split moves forward, so the next batch
+  always contains the newest rows.
+- The backfill publisher sends the rows up to the split, oldest first, at no more
+  than ``TEG_BACKFILL_MAX_MESSAGES_PER_S`` messages per second. It never
+  publishes rows the live publisher has in flight.
+
+With ``TEG_UPLINK_MAX_AGE_S``, controller messages older than the given age are
+removed from the queue without being published. They are still archived (see
+:mod:`modules.message_transfer`) and can be republished from there. Controller
+log messages are always published, since they are not archived.
+
+Notes
+-----
+- Delivery is at-least-once: if a batch is not acknowledged within
+  :data:`PUBLISH_ACK_TIMEOUT_MS` or the connection is lost, all unacknowledged
+  rows are published again.
+- In newest-first cursor mode, rows acknowledged ahead of the cursor position
+  are only tracked in memory, so they are published again after a restart.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from time import monotonic, time_ns
+from typing import Optional, Union
+
+from modules import sqlite
+from modules.compression import PayloadCodec
+from modules.logging import debug, warn
+from modules.mqtt import GatewayMqttClient, MAX_INFLIGHT_MESSAGES, join_telemetry_payloads
+from modules.rate_controller import UplinkRateController
+
+TELEMETRY_BATCH_MAX_RECORDS: int = int(os.environ.get("TEG_TELEMETRY_BATCH_MAX_RECORDS") or 200)
+TELEMETRY_BATCH_MAX_BYTES: int = int(os.environ.get("TEG_TELEMETRY_BATCH_MAX_BYTES") or 32_768)
+PUBLISH_WINDOW_SIZE: int = min(int(os.environ.get("TEG_PUBLISH_WINDOW_SIZE") or 8), MAX_INFLIGHT_MESSAGES)
+# "fifo" publishes the oldest rows first, "newest_first" the newest rows and backfills the older ones
+UPLINK_NEWEST_FIRST: bool = (os.environ.get("TEG_UPLINK_DRAIN_ORDER") or "fifo") == "newest_first"
+BACKFILL_MAX_MESSAGES_PER_S: float = float(os.environ.get("TEG_BACKFILL_MAX_MESSAGES_PER_S") or 100)
+UPLINK_MAX_AGE_MS: int = int(float(os.environ.get("TEG_UPLINK_MAX_AGE_S") or 0) * 1000)
+# Time after which unacknowledged batches are considered lost and published again
+PUBLISH_ACK_TIMEOUT_MS: int = 30_000
+
+
+@dataclass
+class InFlightBatch:
+    """Range of pending queue rows covered by one unacknowledged publish."""
+    first_message_id: int
+    last_message_id: int
+    message_count: int
+    sent_at: float
+
+
+class PendingMessagePublisher:
+    """Publish rows of the pending MQTT message queue in pipelined batches.
+
+    Attributes
+    ----------
+    pending_queue:
+      Queue of messages waiting for upload (``pending_mqtt_messages`` table), or
+      the uplink cursor over the controller ``messages`` table.
+    payload_codec:
+      Decodes compressed queue payloads right before they are published.
+    in_flight:
+      Unacknowledged batches by MQTT message id.
+    last_dispatched_id:
+      Highest queue row id handed to the MQTT client so far.
+    min_id / max_id:
+      Only rows with ``min_id < id <= max_id`` are published (``max_id``: ``None``
+      for no upper bound).
+    yield_to:
+      Another publisher of the same queue. Rows it has in flight are not published.
+    dispatched_count / drained_count / expired_count:
+      Rows handed to the MQTT client, rows removed from the queue (acknowledged,
+      invalid or expired), and rows removed for exceeding :data:`UPLINK_MAX_AGE_MS`,
+      since the start.
+    """
+
+    def __init__(self, pending_queue: Union[sqlite.DurableQueue, sqlite.QueueCursor],
+                 payload_codec: PayloadCodec) -> None:
+        self.pending_queue = pending_queue
+        self.payload_codec = payload_codec
+        self.in_flight: dict[int, InFlightBatch] = {}
+        self.last_dispatched_id = 0
+        self.min_id = 0
+        self.max_id: Optional[int] = None
+        self.yield_to: Optional[PendingMessagePublisher] = None
+        self.dispatched_count = 0
+        self.drained_count = 0
+        self.expired_count = 0
+
+    def publish_batch(self) -> int:
+        """Process acknowledgements and publish the next batch if the window allows.
+
+        Rows that cannot be decoded or are not valid JSON are dropped from the
+        queue, since ThingsBoard would reject the whole payload otherwise.
+
+        Returns:
+          Number of queue rows acknowledged or dispatched, ``0`` if nothing happened.
+        """
+        processed_rows = self.process_acks()
+        rate_controller = UplinkRateController()
+        if len(self.in_flight) >= PUBLISH_WINDOW_SIZE or not rate_controller.is_allowed():
+            return processed_rows
+
+        after_id = max(self.last_dispatched_id, self.min_id)
+        if self.max_id is not None and after_id >= self.max_id:
+            return processed_rows
+        rows = self.pending_queue.peek_batch(rate_controller.get_batch_size(TELEMETRY_BATCH_MAX_RECORDS),
+                                             after_id=after_id)
+        if len(rows) == 0:
+            return processed_rows
+
+        batch: list[str] = []
+        batch_size_bytes = 2  # enclosing brackets
+        first_message_id = rows[0][0]
+        last_message_id = None
+        covered_rows = 0
+        expired_before_ms = int(time_ns() / 1_000_000) - UPLINK_MAX_AGE_MS
+        for message_id, message_type, stored_message, *payload_encoding in rows:
+            if self.max_id is not None and message_id > self.max_id:
+                break
+            if self.yield_to is not None and self.yield_to.is_in_flight(message_id):
+                break
+            try:
+                message = self.payload_codec.decode(stored_message, *payload_encoding)
+                message_obj = json.loads(message)
+            except (ValueError, TypeError) as e:
+                warn(f"[PUBLISHER] Dropping invalid pending message {message_id}: {e}")
+                last_message_id = message_id
+                covered_rows += 1
+                continue
+            if UPLINK_MAX_AGE_MS > 0 and "log" not in (message_type or "") and type(message_obj) is dict \
+                    and type(message_obj.get("ts")) is int and message_obj["ts"] < expired_before_ms:
+                # archived already, republish from the archive if needed
+                last_message_id = message_id
+                covered_rows += 1
+                self.expired_count += 1
+                continue
+            message_size_bytes = len(message.encode("utf-8")) + 1
+            if len(batch) > 0 and batch_size_bytes + message_size_bytes > TELEMETRY_BATCH_MAX_BYTES:
+                break
+            batch.append(message)
+            batch_size_bytes += message_size_bytes
+            last_message_id = message_id
+            covered_rows += 1
+        if last_message_id is None:
+            return processed_rows
+
+        if len(batch) == 0:
+            # only invalid or expired rows, nothing to wait for
+            self.pending_queue.ack_ranges([(first_message_id, last_message_id)])
+            self.drained_count += covered_rows
+            return processed_rows + covered_rows
+
+        debug(f"[PUBLISHER] Sending {len(batch)} controller messages ({batch_size_bytes} bytes)")
+        mid = GatewayMqttClient().publish_message_async("v1/devices/me/telemetry", join_telemetry_payloads(batch))
+        if mid is None:
+            return processed_rows
+        rate_controller.consume(len(batch))
+        self.in_flight[mid] = InFlightBatch(first_message_id, last_message_id, covered_rows, monotonic())
+        self.last_dispatched_id = last_message_id
+        self.dispatched_count += covered_rows
+        return processed_rows + covered_rows
+
+    def process_acks(self) -> int:
+        """Remove acknowledged batches from the queue and recover lost ones.
+
+        Returns:
+          Number of queue rows removed.
+        """
+        if len(self.in_flight) == 0:
+            return 0
+        mqtt_client = GatewayMqttClient()
+        acked_batches = [self.in_flight.pop(mid) for mid in mqtt_client.pop_acked_message_ids(self.in_flight.keys())]
+        self.pending_queue.ack_ranges([(batch.first_message_id, batch.last_message_id) for batch in acked_batches])
+
+        oldest_sent_at = min((batch.sent_at for batch in self.in_flight.values()), default=None)
+        if not mqtt_client.is_connected() or (
+                oldest_sent_at is not None and (monotonic() - oldest_sent_at) * 1000 > PUBLISH_ACK_TIMEOUT_MS):
+            if len(self.in_flight) > 0:
+                warn(f"[PUBLISHER] {len(self.in_flight)} batches were not acknowledged, publishing them again")
+                if mqtt_client.is_connected():
+                    # disconnects are reported by the MQTT client
+                    UplinkRateController().on_failure()
+            self.reset_window()
+
+        acked_rows = sum(batch.message_count for batch in acked_batches)
+        self.drained_count += acked_rows
+        return acked_rows
+
+    def reset_window(self) -> None:
+        """Forget all unacknowledged batches so that their rows are published again."""
+        GatewayMqttClient().forget_message_ids(self.in_flight.keys())
+        self.in_flight = {}
+        self.last_dispatched_id = 0
+
+    def is_in_flight(self, message_id: int) -> bool:
+        """Return whether a queue row was published but not acknowledged yet."""
+        return any(batch.first_message_id <= message_id <= batch.last_message_id for batch in self.in_flight.values())
+
+    def oldest_timestamp_ms(self) -> Optional[int]:
+        """Return the ``ts`` of the oldest queued message, ``None`` if the queue is empty or it has none."""
+        rows = self.pending_queue.peek_batch(1, after_id=self.min_id)
+        if len(rows) == 0 or (self.max_id is not None and rows[0][0] > self.max_id):
+            return None
+        _message_id, _message_type, stored_message, *payload_encoding = rows[0]
+        try:
+            message = json.loads(self.payload_codec.decode(stored_message, *payload_encoding))
+        except (ValueError, TypeError):
+            return None
+        timestamp_ms = message.get("ts") if type(message) is dict else None
+        return timestamp_ms if type(timestamp_ms) is int else None
+
+    def ms_until_ack_timeout(self) -> Optional[float]:
+        """Return the time until the oldest in-flight batch times out.
+
+        Returns:
+          Milliseconds until the timeout, or ``None`` if no batch is in flight.
+        """
+        oldest_sent_at = min((batch.sent_at for batch in self.in_flight.values()), default=None)
+        if oldest_sent_at is None:
+            return None
+        return max(0.0, PUBLISH_ACK_TIMEOUT_MS - (monotonic() - oldest_sent_at) * 1000)
+
+
+class NewestFirstDrain:
+    """Publish the newest rows of a queue first and backfill the older rows at a limited rate.
+
+    Attributes
+    ----------
+    pending_queue:
+      Queue drained by both publishers.
+    live:
+      Publishes the rows after :attr:`split_id`.
+    backfill:
+      Publishes the rows up to :attr:`split_id`, oldest first.
+    split_id:
+      Highest queue row id left to the backfill.
+    backfill_not_before:
+      Monotonic time before which the backfill must not publish, to keep its rate limit.
+    """
+
+    def __init__(self, pending_queue: Union[sqlite.DurableQueue, sqlite.QueueCursor],
+                 payload_codec: PayloadCodec) -> None:
+        self.pending_queue = pending_queue
+        self.live = PendingMessagePublisher(pending_queue, payload_codec)
+        self.backfill = PendingMessagePublisher(pending_queue, payload_codec)
+        self.backfill.yield_to = self.live
+        self.split_id = 0
+        self.backfill.max_id = self.split_id
+        self.backfill_not_before = 0.0
+
+    def update_split(self) -> None:
+        """Leave the older rows to the backfill if more than one batch is waiting for the live publisher."""
+        last_id = self.pending_queue.last_id()
+        if last_id - max(self.live.last_dispatched_id, self.split_id) <= TELEMETRY_BATCH_MAX_RECORDS:
+            return
+        self.split_id = last_id - TELEMETRY_BATCH_MAX_RECORDS
+        self.live.min_id = self.backfill.max_id = self.split_id
+        debug(f"[PUBLISHER] Publishing the newest messages first, backfilling up to row {self.split_id}")
+
+    def publish_live(self) -> int:
+        """Publish the next batch of the newest rows, see :meth:`PendingMessagePublisher.publish_batch`."""
+        self.update_split()
+        return self.live.publish_batch()
+
+    def publish_backfill(self) -> int:
+        """Publish the next batch of older rows if the rate limit allows.
+
+        Returns:
+          Number of queue rows acknowledged or dispatched, ``0`` if nothing happened.
+        """
+        if monotonic() < self.backfill_not_before:
+            return self.backfill.process_acks()
+        dispatched_count = self.backfill.dispatched_count
+        processed_rows = self.backfill.publish_batch()
+        dispatched_count = self.backfill.dispatched_count - dispatched_count
+        if dispatched_count > 0:
+            self.backfill_not_before = max(monotonic(), self.backfill_not_before) \
+                + dispatched_count / BACKFILL_MAX_MESSAGES_PER_S
+        return processed_rows
+
+    def live_depth(self) -> int:
+        """Return the approximate number of rows waiting for the live publisher."""
+        return min(self.pending_queue.depth(),
+                   max(0, self.pending_queue.last_id() - max(self.live.last_dispatched_id, self.split_id)))
+
+    def backfill_depth(self) -> int:
+        """Return the approximate number of rows waiting for the backfill."""
+        return max(0, self.pending_queue.depth() - self.live_depth())
+
+    def ms_until_backfill(self) -> Optional[float]:
+        """Return the time until the backfill may publish again, ``None`` if it is not rate limited."""
+        remaining_s = self.backfill_not_before - monotonic()
+        return remaining_s * 1000 if remaining_s > 0 else None
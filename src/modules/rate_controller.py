@@ -0,0 +1,186 @@
+"""Adaptive rate control of the uplink.
+
+Without feedback, the gateway publishes as fast as the main loop iterates. On a
+weak cellular link, this fills the send buffers until the broker connection
+times out, and the gateway exits to reconnect. The :class:`UplinkRateController`
+adapts the publish rate to the link instead, in the style of TCP congestion
+control (additive increase, multiplicative decrease):
+
+- Every acknowledged publish (PUBACK) is a round-trip time (RTT) sample. While
+  the RTT stays close to the lowest RTT seen recently, the message rate and the
+  batch size are increased by a constant step per acknowledgement.
+- If the RTT grows beyond :data:`RTT_CONGESTION_FACTOR` times the lowest RTT (and
+  by at least :data:`RTT_CONGESTION_MIN_INCREASE_MS`), the send buffers of the
+  link are filling up. The rate and the batch size are halved.
+- Failed publishes, acknowledgement timeouts and disconnects halve them as well.
+
+At most one decrease happens per RTT, since all publishes of a burst report the
+same congestion. The message rate is enforced with a token bucket by the
+publishers of the uplink lanes (see :mod:`modules.uplink_scheduler`); RPC
+responses and the health telemetry are not limited.
+
+Configuration
+-------------
+- ``TEG_UPLINK_MAX_MESSAGES_PER_S``: Upper bound of the message rate (default: 2000).
+- ``TEG_UPLINK_MIN_MESSAGES_PER_S``: Lower bound of the message rate (default: 5).
+
+Notes
+-----
+- The state of the controller is reported with the auxiliary telemetry (see
+  :meth:`UplinkRateController.get_telemetry_values`).
+"""
+
+import math
+import os
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Any, Optional
+
+from modules.logging import debug
+
+UPLINK_MAX_MESSAGES_PER_S: float = float(os.environ.get("TEG_UPLINK_MAX_MESSAGES_PER_S") or 2_000)
+UPLINK_MIN_MESSAGES_PER_S: float = float(os.environ.get("TEG_UPLINK_MIN_MESSAGES_PER_S") or 5)
+# Message rate after startup
+UPLINK_INITIAL_MESSAGES_PER_S: float = 200
+# Rate and batch size increase per acknowledged publish
+RATE_ADDITIVE_INCREASE_PER_S: float = 10
+BATCH_SCALE_ADDITIVE_INCREASE: float = 0.05
+# Factor applied to the rate and the batch size on congestion
+MULTIPLICATIVE_DECREASE: float = 0.5
+# Smallest batch size, as a share of the maximum batch size
+MIN_BATCH_SCALE: float = 0.05
+# RTT increase over the lowest recent RTT that is considered congestion
+RTT_CONGESTION_FACTOR: float = 2.0
+RTT_CONGESTION_MIN_INCREASE_MS: float = 500
+# Number of recent RTT samples the lowest RTT is taken from
+RTT_BASELINE_SAMPLES: int = 200
+# Weight of a new sample in the smoothed RTT
+RTT_SMOOTHING: float = 0.125
+# Messages that may be sent at once after an idle period, in seconds of the current rate
+TOKEN_BUCKET_BURST_S: float = 1.0
+
+singleton_instance: Optional["UplinkRateController"] = None
+
+
+class UplinkRateController:
+    """Adapt the uplink message rate and batch size to the measured RTT.
+
+    Implemented as a singleton, so the MQTT client and the publishers share the
+    state. All methods are thread-safe.
+
+    Attributes
+    ----------
+    rate:
+      Current message rate limit in messages per second.
+    batch_scale:
+      Current batch size, as a share of the maximum batch size.
+    smoothed_rtt_ms:
+      Exponentially smoothed RTT, ``None`` before the first sample.
+    rtt_samples:
+      Recent RTT samples, the lowest of which is the congestion-free baseline.
+    tokens:
+      Messages that may be sent right now; negative while a batch larger than the
+      available tokens is paid off.
+    """
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            debug("[RATE] Initializing UplinkRateController")
+            super().__init__()
+            singleton_instance = self
+            self.lock = Lock()
+            self.rate = min(UPLINK_INITIAL_MESSAGES_PER_S, UPLINK_MAX_MESSAGES_PER_S)
+            self.batch_scale = 1.0
+            self.smoothed_rtt_ms: Optional[float] = None
+            self.rtt_samples: deque[float] = deque(maxlen=RTT_BASELINE_SAMPLES)
+            self.last_decrease = 0.0
+            self.decrease_count = 0
+            self.failure_count = 0
+            self.tokens = 0.0
+            self.tokens_updated = monotonic()
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(UplinkRateController, cls).__new__(cls)
+
+    def on_ack(self, rtt_ms: float) -> None:
+        """Record the RTT of an acknowledged publish and adapt the rate."""
+        with self.lock:
+            self.rtt_samples.append(rtt_ms)
+            if self.smoothed_rtt_ms is None:
+                self.smoothed_rtt_ms = rtt_ms
+            else:
+                self.smoothed_rtt_ms += RTT_SMOOTHING * (rtt_ms - self.smoothed_rtt_ms)
+            baseline_rtt_ms = min(self.rtt_samples)
+            if rtt_ms > max(baseline_rtt_ms * RTT_CONGESTION_FACTOR, baseline_rtt_ms + RTT_CONGESTION_MIN_INCREASE_MS):
+                self.decrease(f"RTT of {round(rtt_ms)} ms (baseline: {round(baseline_rtt_ms)} ms)")
+                return
+            self.rate = min(UPLINK_MAX_MESSAGES_PER_S, self.rate + RATE_ADDITIVE_INCREASE_PER_S)
+            self.batch_scale = min(1.0, self.batch_scale + BATCH_SCALE_ADDITIVE_INCREASE)
+
+    def on_failure(self) -> None:
+        """Record a failed or unacknowledged publish, or a disconnect."""
+        with self.lock:
+            self.failure_count += 1
+            self.decrease("failed publish")
+
+    def decrease(self, reason: str) -> None:
+        """Decrease the rate and batch size, at most once per RTT. Must hold :attr:`lock`."""
+        now = monotonic()
+        if (now - self.last_decrease) * 1000 < (self.smoothed_rtt_ms or 0):
+            return
+        self.last_decrease = now
+        self.decrease_count += 1
+        self.rate = max(UPLINK_MIN_MESSAGES_PER_S, self.rate * MULTIPLICATIVE_DECREASE)
+        self.batch_scale = max(MIN_BATCH_SCALE, self.batch_scale * MULTIPLICATIVE_DECREASE)
+        # print instead of logging, the log message would be published itself
+        print(f"[RATE] Congestion ({reason}), limiting uplink to {round(self.rate)} messages/s")
+
+    def get_batch_size(self, max_batch_size: int) -> int:
+        """Return the current batch size for a publisher with the given maximum batch size."""
+        with self.lock:
+            return max(1, math.floor(max_batch_size * self.batch_scale))
+
+    def refill_tokens(self) -> None:
+        """Add the tokens accumulated since the last refill. Must hold :attr:`lock`."""
+        now = monotonic()
+        self.tokens = min(max(self.rate * TOKEN_BUCKET_BURST_S, 1.0),
+                          self.tokens + (now - self.tokens_updated) * self.rate)
+        self.tokens_updated = now
+
+    def is_allowed(self) -> bool:
+        """Return whether a publish is allowed by the rate limit right now."""
+        with self.lock:
+            self.refill_tokens()
+            return self.tokens > 0
+
+    def consume(self, message_count: int) -> None:
+        """Account for published messages. The bucket may go negative for a large batch."""
+        with self.lock:
+            self.refill_tokens()
+            self.tokens -= message_count
+
+    def ms_until_allowed(self) -> Optional[float]:
+        """Return the time until a publish is allowed again, ``None`` if it is allowed now."""
+        with self.lock:
+            self.refill_tokens()
+            if self.tokens > 0:
+                return None
+            return (-self.tokens / self.rate) * 1000 + 1
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return the controller state for the auxiliary telemetry."""
+        with self.lock:
+            return {
+                "uplink_rate_limit": round(self.rate, 1),
+                "uplink_batch_scale": round(self.batch_scale, 2),
+                "uplink_rtt_ms": round(self.smoothed_rtt_ms) if self.smoothed_rtt_ms is not None else None,
+                "uplink_rtt_baseline_ms": round(min(self.rtt_samples)) if len(self.rtt_samples) > 0 else None,
+                "uplink_rate_decreases": self.decrease_count,
+                "uplink_publish_failures": self.failure_count,
+            }
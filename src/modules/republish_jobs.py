@@ -0,0 +1,303 @@
+"""Background republishing of archived controller messages.
+
+Republishing a time range of the archive can take hours over a slow uplink. To
+keep the main loop responsive, the ``archive_republish_messages`` RPC only
+creates a job; a background thread publishes the messages batch by batch.
+
+Jobs are persisted in the ``republish_jobs`` table of ``GATEWAY_JOBS_DB_PATH``
+together with the archive position of the last republished message. The
+archive is read with keyset pagination on ``(timestamp_ms, id)`` (see
+:meth:`modules.archive.GatewayArchive.iter_messages`), so a job resumes exactly
+where it stopped after a pause or a gateway restart, and messages sharing a
+timestamp are never skipped.
+
+Behaviour
+---------
+- Jobs run one at a time, in the order they were created.
+- Each batch is published as one telemetry payload with QoS 1. The job position
+  only advances once the broker acknowledged the batch.
+- The publish rate is limited to ``TEG_REPUBLISH_MAX_MESSAGES_PER_S`` messages
+  per second (default: 100), leaving bandwidth for live data.
+- Batches are only published while the uplink has no live data or logs queued
+  (the ``backlog`` lane of :mod:`modules.uplink_scheduler`).
+- Progress and ETA of the active job are reported with the auxiliary telemetry
+  (see :meth:`RepublishJobRunner.get_telemetry_values`).
+"""
+
+import json
+import os
+import threading
+from dataclasses import dataclass
+from time import monotonic, sleep, time_ns
+from typing import Any, Optional
+
+import utils.paths
+from db_schemas.republish_jobs_table import CREATE_REPUBLISH_JOBS_TABLE_QUERY, REPUBLISH_JOBS_COLUMNS
+from modules import sqlite
+from modules.archive import ArchivePosition, GatewayArchive
+from modules.logging import debug, info, warn
+from modules.mqtt import GatewayMqttClient, join_telemetry_payloads
+from modules.pending_publisher import TELEMETRY_BATCH_MAX_BYTES, TELEMETRY_BATCH_MAX_RECORDS
+from modules.rate_controller import UplinkRateController
+from modules.uplink_scheduler import UplinkScheduler
+
+REPUBLISH_MAX_MESSAGES_PER_S: float = float(os.environ.get("TEG_REPUBLISH_MAX_MESSAGES_PER_S") or 100)
+# Time to wait for the acknowledgement of a batch before it is published again
+REPUBLISH_ACK_TIMEOUT_S: int = 30
+# Time to wait before retrying while the MQTT client is disconnected
+REPUBLISH_OFFLINE_RETRY_S: int = 5
+
+JOB_STATUS_RUNNING: str = "running"
+JOB_STATUS_PAUSED: str = "paused"
+JOB_STATUS_DONE: str = "done"
+JOB_STATUS_CANCELLED: str = "cancelled"
+# Allowed status changes via RPC, by target status
+JOB_STATUS_TRANSITIONS: dict[str, set[str]] = {
+    JOB_STATUS_PAUSED: {JOB_STATUS_RUNNING},
+    JOB_STATUS_RUNNING: {JOB_STATUS_PAUSED},
+    JOB_STATUS_CANCELLED: {JOB_STATUS_RUNNING, JOB_STATUS_PAUSED},
+}
+
+singleton_instance: Optional["RepublishJobRunner"] = None
+
+
+@dataclass
+class RepublishJob:
+    """State of one archive republish job, as stored in the ``republish_jobs`` table."""
+    id: int
+    start_timestamp_ms: int
+    end_timestamp_ms: int
+    status: str
+    position: Optional[ArchivePosition]
+    published_count: int
+    total_count: int
+    created_at_ms: int
+    updated_at_ms: int
+
+    @staticmethod
+    def from_row(row: tuple) -> "RepublishJob":
+        """Create a job from a row with the columns in ``REPUBLISH_JOBS_COLUMNS``."""
+        (job_id, start_timestamp_ms, end_timestamp_ms, status, shard_key, timestamp_ms, message_id,
+         published_count, total_count, created_at_ms, updated_at_ms) = row
+        position = None if shard_key is None else ArchivePosition(shard_key, timestamp_ms, message_id)
+        return RepublishJob(job_id, start_timestamp_ms, end_timestamp_ms, status, position,
+                            published_count, total_count, created_at_ms, updated_at_ms)
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return a JSON-serializable summary of the job."""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "start_timestamp_ms": self.start_timestamp_ms,
+            "end_timestamp_ms": self.end_timestamp_ms,
+            "published_count": self.published_count,
+            "total_count": self.total_count,
+            "last_timestamp_ms": None if self.position is None else self.position.timestamp_ms,
+        }
+
+
+class RepublishJobRunner:
+    """Create, control and run archive republish jobs.
+
+    Implemented as a singleton, so the RPC handlers and the background thread
+    share the job state.
+    """
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            debug("[REPUBLISH] Initializing RepublishJobRunner")
+            super().__init__()
+            singleton_instance = self
+            self.table = sqlite.SqliteTables.REPUBLISH_JOBS.value
+            self.db = sqlite.SqliteConnection(utils.paths.GATEWAY_JOBS_DB_PATH)
+            self.db.execute(CREATE_REPUBLISH_JOBS_TABLE_QUERY)
+            self.select_query = f"SELECT {', '.join(REPUBLISH_JOBS_COLUMNS)} FROM {self.table}"
+            self.jobs_changed = threading.Event()
+            self.thread: Optional[threading.Thread] = None
+            # publish rate of the active job since it was picked up
+            self.active_job: Optional[RepublishJob] = None
+            self.active_since: Optional[float] = None
+            self.active_published_count = 0
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(RepublishJobRunner, cls).__new__(cls)
+
+    def start(self) -> None:
+        """Start the background thread running the jobs."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def create_job(self, start_timestamp_ms: int, end_timestamp_ms: int) -> Optional[RepublishJob]:
+        """Create a running job republishing the messages within a time range.
+
+        Args:
+          start_timestamp_ms: Exclusive start of the range.
+          end_timestamp_ms: Exclusive end of the range.
+
+        Returns:
+          The created job, or ``None`` if it could not be stored.
+        """
+        total_count = GatewayArchive().count_messages(start_timestamp_ms, end_timestamp_ms)
+        now_ms = int(time_ns() / 1_000_000)
+        result = self.db.execute(
+            f"""INSERT INTO {self.table} (start_timestamp_ms, end_timestamp_ms, status, total_count, created_at_ms, updated_at_ms)
+            VALUES (?, ?, ?, ?, ?, ?) RETURNING {', '.join(REPUBLISH_JOBS_COLUMNS)}""",
+            (start_timestamp_ms, end_timestamp_ms, JOB_STATUS_RUNNING, total_count, now_ms, now_ms))
+        if not result or len(result[0]) != len(REPUBLISH_JOBS_COLUMNS):
+            return None
+        self.jobs_changed.set()
+        return RepublishJob.from_row(result[0])
+
+    def get_job(self, job_id: int) -> Optional[RepublishJob]:
+        """Return a job by id."""
+        result = self.db.execute(f"{self.select_query} WHERE id = ?", (job_id,))
+        if not result or len(result[0]) != len(REPUBLISH_JOBS_COLUMNS):
+            return None
+        return RepublishJob.from_row(result[0])
+
+    def get_jobs(self, limit: int = 20) -> list[RepublishJob]:
+        """Return the most recent jobs, newest first."""
+        result = self.db.execute(f"{self.select_query} ORDER BY id DESC LIMIT ?", (limit,))
+        return [RepublishJob.from_row(row) for row in result or [] if len(row) == len(REPUBLISH_JOBS_COLUMNS)]
+
+    def set_job_status(self, job_id: int, status: str) -> Optional[str]:
+        """Pause, resume or cancel a job.
+
+        Args:
+          job_id: Job id.
+          status: New status, a key of :data:`JOB_STATUS_TRANSITIONS`.
+
+        Returns:
+          An error string if the status cannot be changed, otherwise ``None``.
+        """
+        job = self.get_job(job_id)
+        if job is None:
+            return f"job {job_id} not found"
+        if job.status not in JOB_STATUS_TRANSITIONS.get(status, set()):
+            return f"job {job_id} is {job.status}"
+        self.db.execute(f"UPDATE {self.table} SET status = ?, updated_at_ms = ? WHERE id = ?",
+                        (status, int(time_ns() / 1_000_000), job_id))
+        info(f"[REPUBLISH] Job {job_id} is {status}")
+        self.jobs_changed.set()
+        return None
+
+    def run(self) -> None:
+        """Run the jobs one batch at a time."""
+        while True:
+            try:
+                result = self.db.execute(f"{self.select_query} WHERE status = ? ORDER BY id LIMIT 1",
+                                         (JOB_STATUS_RUNNING,))
+                jobs = [RepublishJob.from_row(row) for row in result or [] if len(row) == len(REPUBLISH_JOBS_COLUMNS)]
+                if len(jobs) == 0:
+                    self.active_job = None
+                    self.jobs_changed.wait()
+                    self.jobs_changed.clear()
+                    continue
+                if self.active_job is None or self.active_job.id != jobs[0].id:
+                    self.active_since = monotonic()
+                    self.active_published_count = 0
+                self.active_job = jobs[0]
+                if not GatewayMqttClient().is_connected():
+                    sleep(REPUBLISH_OFFLINE_RETRY_S)
+                    continue
+                # the backlog lane only publishes once live data and logs are sent
+                if not UplinkScheduler().idle.wait(REPUBLISH_OFFLINE_RETRY_S):
+                    continue
+                self.publish_next_batch(jobs[0])
+            except Exception as e:
+                warn(f"[REPUBLISH] Failed to run republish job: {e}")
+                sleep(REPUBLISH_OFFLINE_RETRY_S)
+
+    def publish_next_batch(self, job: RepublishJob) -> None:
+        """Publish the next batch of a job and persist its new position."""
+        batch_start = monotonic()
+        batch: list[str] = []
+        batch_size_bytes = 2  # enclosing brackets
+        covered_count = 0
+        last_position = None
+        messages = GatewayArchive().iter_messages(job.start_timestamp_ms, job.end_timestamp_ms,
+                                                  page_size=TELEMETRY_BATCH_MAX_RECORDS, after=job.position)
+        for position, message in messages:
+            try:
+                payload = json.dumps({"ts": position.timestamp_ms, "values": json.loads(message)})
+            except (ValueError, TypeError) as e:
+                warn(f"[REPUBLISH] Skipping malformed archived message {position.message_id}: {e}")
+                last_position = position
+                covered_count += 1
+                continue
+            if len(batch) > 0 and batch_size_bytes + len(payload) + 1 > TELEMETRY_BATCH_MAX_BYTES:
+                break
+            batch.append(payload)
+            batch_size_bytes += len(payload) + 1
+            last_position = position
+            covered_count += 1
+            if len(batch) >= TELEMETRY_BATCH_MAX_RECORDS:
+                break
+        messages.close()
+
+        if last_position is None:
+            info(f"[REPUBLISH] Job {job.id} done - {job.published_count} messages republished")
+            self.db.execute(f"UPDATE {self.table} SET status = ?, updated_at_ms = ? WHERE id = ? AND status = ?",
+                            (JOB_STATUS_DONE, int(time_ns() / 1_000_000), job.id, JOB_STATUS_RUNNING))
+            return
+
+        if len(batch) > 0:
+            # adaptive uplink rate limit, see modules.rate_controller
+            rate_controller = UplinkRateController()
+            sleep((rate_controller.ms_until_allowed() or 0) / 1000)
+            rate_controller.consume(len(batch))
+            mqtt_client = GatewayMqttClient()
+            mid = mqtt_client.publish_message_async("v1/devices/me/telemetry", join_telemetry_payloads(batch))
+            if mid is None or not mqtt_client.wait_for_message_ack(mid, REPUBLISH_ACK_TIMEOUT_S):
+                warn(f"[REPUBLISH] Batch of job {job.id} was not acknowledged, retrying")
+                sleep(REPUBLISH_OFFLINE_RETRY_S)
+                return
+
+        # a job paused or cancelled meanwhile keeps its status
+        self.db.execute(
+            f"""UPDATE {self.table} SET position_shard_key = ?, position_timestamp_ms = ?, position_message_id = ?,
+            published_count = published_count + ?, updated_at_ms = ? WHERE id = ?""",
+            (last_position.shard_key, last_position.timestamp_ms, last_position.message_id,
+             covered_count, int(time_ns() / 1_000_000), job.id))
+        self.active_published_count += covered_count
+        UplinkScheduler().record_sent("backlog", covered_count)
+        debug(f"[REPUBLISH] Job {job.id}: republished {covered_count} messages up to {last_position.timestamp_ms}")
+
+        # rate limit
+        sleep(max(0.0, covered_count / REPUBLISH_MAX_MESSAGES_PER_S - (monotonic() - batch_start)))
+
+    def get_backlog_depth(self) -> int:
+        """Return the number of messages the active job has yet to republish."""
+        job = self.active_job
+        return max(0, job.total_count - job.published_count) if job is not None else 0
+
+    def get_backlog_timestamp_ms(self) -> Optional[int]:
+        """Return the timestamp of the last message republished by the active job, if any."""
+        job = self.active_job
+        if job is None or job.position is None:
+            return None
+        return job.position.timestamp_ms
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return progress and ETA of the active job for the auxiliary telemetry."""
+        active_job = self.active_job
+        if active_job is None or self.active_since is None:
+            return {}
+        job = self.get_job(active_job.id) or active_job
+        remaining_count = max(0, job.total_count - job.published_count)
+        elapsed_s = monotonic() - self.active_since
+        rate = self.active_published_count / elapsed_s if elapsed_s > 0 else 0
+        return {
+            "republish_job_id": job.id,
+            "republish_job_status": job.status,
+            "republish_job_published_count": job.published_count,
+            "republish_job_total_count": job.total_count,
+            "republish_job_progress_percent": round(100 * job.published_count / job.total_count, 1) if job.total_count > 0 else 100.0,
+            "republish_job_eta_s": round(remaining_count / rate) if rate > 0 else None,
+        }
@@ -0,0 +1,313 @@
+"""Retention policy for the local archive and queue databases.
+
+Without limits, the archive grows until the storage is full. The
+:class:`RetentionEngine` runs in a background thread and keeps the archive and
+the queue databases within configurable budgets by evicting the oldest data
+first:
+
+- Archive shards (see :mod:`modules.archive`) older than the maximum age are
+  unlinked; older messages in shards overlapping the age limit are deleted.
+- If the archive exceeds its byte budget or the free disk space drops below the
+  configured minimum, the oldest shards are unlinked. Within the legacy shard or
+  the shard currently written to, the oldest messages are deleted instead.
+- Queue tables above their byte budget lose their oldest queued rows.
+- Optionally, archived messages older than a threshold are downsampled to one
+  message per interval and set of value keys.
+- With the normalized archive layout, messages stored as JSON are migrated to
+  the normalized layout.
+- With the compressed archive layout, the messages of every past hour are
+  packed into a compressed block.
+
+All deletes are done in small chunks with short pauses in between, so the
+database locks are never held for long and the main loop keeps running. The
+number of evicted messages is reported with the auxiliary telemetry (see
+:meth:`RetentionEngine.get_telemetry_values`).
+
+Configuration
+-------------
+- ``TEG_ARCHIVE_MAX_BYTES``: Byte budget of the archive (default: ``0``, no limit).
+- ``TEG_ARCHIVE_MAX_AGE_DAYS``: Maximum age of archived messages (default: ``0``, no limit).
+- ``TEG_MIN_FREE_DISK_BYTES``: Minimum free space on the archive's file system,
+  below which archive data is evicted even if the disk was filled by something
+  else (default: ``0``, disabled).
+- ``TEG_QUEUE_MAX_BYTES``: Byte budget of each queue table (default: ``0``, no limit).
+- ``TEG_ARCHIVE_DOWNSAMPLE_AFTER_DAYS``: Age after which archived messages are
+  downsampled (default: ``0``, disabled).
+- ``TEG_ARCHIVE_DOWNSAMPLE_INTERVAL_S``: Interval archived messages are
+  downsampled to (default: ``60``).
+
+Notes
+-----
+- When a write fails because the disk is full, :data:`modules.sqlite.storage_full_event`
+  wakes up the engine, which then evicts archive data even if no budget is exceeded.
+- The controller's ``messages`` table is not subject to the queue budget.
+"""
+
+import math
+import os
+import shutil
+import threading
+from time import sleep, time_ns
+from typing import Optional, Sequence, Union
+
+from modules import sqlite
+from modules.archive import ArchiveShard, GatewayArchive, ARCHIVE_BLOCK_PERIOD_MS, DAY_MS, LEGACY_SHARD_START_MS, \
+    LEGACY_SHARD_END_MS
+from modules.logging import info, warn
+
+ARCHIVE_MAX_BYTES: int = int(os.environ.get("TEG_ARCHIVE_MAX_BYTES") or 0)
+ARCHIVE_MAX_AGE_DAYS: float = float(os.environ.get("TEG_ARCHIVE_MAX_AGE_DAYS") or 0)
+MIN_FREE_DISK_BYTES: int = int(os.environ.get("TEG_MIN_FREE_DISK_BYTES") or 0)
+QUEUE_MAX_BYTES: int = int(os.environ.get("TEG_QUEUE_MAX_BYTES") or 0)
+ARCHIVE_DOWNSAMPLE_AFTER_DAYS: float = float(os.environ.get("TEG_ARCHIVE_DOWNSAMPLE_AFTER_DAYS") or 0)
+ARCHIVE_DOWNSAMPLE_INTERVAL_S: int = int(os.environ.get("TEG_ARCHIVE_DOWNSAMPLE_INTERVAL_S") or 60)
+
+# Interval between two retention runs
+RETENTION_CHECK_INTERVAL_S: int = 60
+# Maximum number of rows deleted per transaction
+RETENTION_DELETE_CHUNK_SIZE: int = 1_000
+# Pause between two chunks, giving other writers access to the database
+RETENTION_CHUNK_PAUSE_MS: int = 50
+# Archive data evicted after a write failed because the disk was full
+STORAGE_FULL_EVICTION_BYTES: int = 16 * 1024 * 1024
+# Time window downsampled per transaction
+DOWNSAMPLE_WINDOW_MS: int = 3_600_000
+# Delay after the end of a block period before it is packed, leaving time for late messages
+BLOCK_SEAL_DELAY_MS: int = 300_000
+
+
+def now_ms() -> int:
+    """Return the current Unix time in milliseconds."""
+    return int(time_ns() / 1_000_000)
+
+
+class RetentionEngine:
+    """Enforce the retention policy in a background thread.
+
+    Attributes
+    ----------
+    archive:
+      Archive to keep within its budget.
+    queues:
+      Queues whose databases are kept within the queue byte budget.
+    evicted_archive_messages / evicted_archive_shards / evicted_queue_messages / downsampled_messages / migrated_archive_messages / sealed_archive_messages:
+      Counters since the gateway started.
+    migrated_shards:
+      Write counts (see :attr:`modules.archive.GatewayArchive.write_counts`) of
+      the shards by path, at the time they had no messages stored as JSON left.
+    sealed_shards:
+      Write counts of the past shards by path, at the time all their messages
+      were packed into blocks.
+    """
+
+    def __init__(self, archive: GatewayArchive, queues: Sequence[sqlite.DurableQueue]) -> None:
+        self.archive = archive
+        self.queues = list(queues)
+        self.evicted_archive_messages = 0
+        self.evicted_archive_shards = 0
+        self.evicted_queue_messages = 0
+        self.downsampled_messages = 0
+        self.migrated_archive_messages = 0
+        self.migrated_shards: dict[str, int] = {}
+        self.sealed_archive_messages = 0
+        self.sealed_shards: dict[str, int] = {}
+        self.archive_size_bytes = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the background retention thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        """Enforce the retention policy periodically and whenever the disk is full."""
+        storage_full = False
+        while True:
+            try:
+                self.enforce(storage_full)
+            except Exception as e:
+                warn(f"[RETENTION] Failed to enforce retention policy: {e}")
+            storage_full = sqlite.storage_full_event.wait(RETENTION_CHECK_INTERVAL_S)
+            sqlite.storage_full_event.clear()
+
+    def enforce(self, storage_full: bool = False) -> None:
+        """Run all retention steps once.
+
+        Args:
+          storage_full: Whether a write failed because the disk was full.
+        """
+        if ARCHIVE_MAX_AGE_DAYS > 0:
+            self.enforce_archive_max_age(now_ms() - int(ARCHIVE_MAX_AGE_DAYS * DAY_MS))
+        if ARCHIVE_DOWNSAMPLE_AFTER_DAYS > 0:
+            self.downsample_archive(now_ms() - int(ARCHIVE_DOWNSAMPLE_AFTER_DAYS * DAY_MS))
+        self.enforce_archive_space(storage_full)
+        if self.archive.layout == "normalized":
+            self.migrate_archive_layout()
+        if self.archive.layout == "compressed":
+            self.seal_archive_blocks(now_ms() - BLOCK_SEAL_DELAY_MS)
+        if QUEUE_MAX_BYTES > 0:
+            for queue in self.queues:
+                self.enforce_queue_budget(queue)
+        self.archive_size_bytes = self.archive.size_bytes()
+
+    def enforce_archive_max_age(self, cutoff_timestamp_ms: int) -> None:
+        """Remove all archived messages older than ``cutoff_timestamp_ms``."""
+        for shard in self.archive.get_shards(end_timestamp_ms=cutoff_timestamp_ms):
+            if not shard.legacy and shard.end_ms <= cutoff_timestamp_ms:
+                self.evict_shard(shard)
+            else:
+                self.evict_oldest_messages(shard, cutoff_timestamp_ms)
+
+    def enforce_archive_space(self, storage_full: bool) -> None:
+        """Evict the oldest archive data while the archive exceeds its byte budget."""
+        excess_bytes = self.get_archive_excess_bytes(storage_full)
+        while excess_bytes > 0:
+            shards = self.archive.get_shards()
+            if len(shards) == 0:
+                return
+            oldest_shard = shards[0]
+            if not oldest_shard.legacy and len(shards) > 1:
+                self.evict_shard(oldest_shard)
+                excess_bytes = self.get_archive_excess_bytes(False)
+                continue
+
+            # delete the share of the messages matching the excess once per run
+            shard_size_bytes = self.archive.shard_size_bytes(oldest_shard)
+            message_count = self.archive.message_count(oldest_shard)
+            if shard_size_bytes == 0 or message_count == 0:
+                if oldest_shard.legacy:
+                    self.archive.remove_shard(oldest_shard)
+                    excess_bytes = self.get_archive_excess_bytes(False)
+                    continue
+                return
+            eviction_count = math.ceil(message_count * min(1.0, excess_bytes / shard_size_bytes))
+            self.evict_oldest_messages(oldest_shard, LEGACY_SHARD_END_MS, eviction_count)
+            return
+
+    def get_archive_excess_bytes(self, storage_full: bool) -> int:
+        """Return how many bytes of archive data have to be evicted."""
+        excess_bytes = STORAGE_FULL_EVICTION_BYTES if storage_full else 0
+        if ARCHIVE_MAX_BYTES > 0:
+            excess_bytes = max(excess_bytes, self.archive.size_bytes() - ARCHIVE_MAX_BYTES)
+        if MIN_FREE_DISK_BYTES > 0:
+            excess_bytes = max(excess_bytes, MIN_FREE_DISK_BYTES - shutil.disk_usage(self.archive.shards_path).free)
+        return excess_bytes
+
+    def evict_shard(self, shard: ArchiveShard) -> None:
+        """Remove a whole archive shard."""
+        message_count = self.archive.message_count(shard)
+        self.archive.remove_shard(shard)
+        self.evicted_archive_shards += 1
+        self.evicted_archive_messages += message_count
+        info(f"[RETENTION] Evicted archive shard '{os.path.basename(shard.path)}' ({message_count} messages)")
+
+    def evict_oldest_messages(self, shard: ArchiveShard, before_timestamp_ms: int,
+                              max_count: Union[int, float] = math.inf) -> None:
+        """Delete the oldest messages of a shard in chunks."""
+        evicted_count = 0
+        while evicted_count < max_count:
+            chunk_size = int(min(RETENTION_DELETE_CHUNK_SIZE, max_count - evicted_count))
+            deleted_count = self.archive.delete_oldest(shard, before_timestamp_ms, chunk_size)
+            evicted_count += deleted_count
+            self.evicted_archive_messages += deleted_count
+            if deleted_count < chunk_size:
+                break
+            sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+        if evicted_count > 0:
+            self.archive.compact(shard)
+        self.archive.release_connection(shard)
+        if evicted_count > 0:
+            info(f"[RETENTION] Evicted {evicted_count} messages from archive shard '{os.path.basename(shard.path)}'")
+
+    def downsample_archive(self, cutoff_timestamp_ms: int) -> None:
+        """Downsample all shards whose period ended before ``cutoff_timestamp_ms``."""
+        interval_ms = ARCHIVE_DOWNSAMPLE_INTERVAL_S * 1000
+        for shard in self.archive.get_shards(end_timestamp_ms=cutoff_timestamp_ms):
+            if shard.legacy or shard.end_ms > cutoff_timestamp_ms:
+                continue
+            if self.archive.get_downsampled_interval_ms(shard) == interval_ms:
+                self.archive.release_connection(shard)
+                continue
+            downsampled_count = 0
+            for window_start_ms in range(shard.start_ms, shard.end_ms, DOWNSAMPLE_WINDOW_MS):
+                downsampled_count += self.archive.downsample(
+                    shard, window_start_ms, min(window_start_ms + DOWNSAMPLE_WINDOW_MS, shard.end_ms), interval_ms)
+                sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+            self.archive.set_downsampled_interval_ms(shard, interval_ms)
+            self.archive.compact(shard)
+            self.archive.release_connection(shard)
+            self.downsampled_messages += downsampled_count
+            info(f"[RETENTION] Downsampled archive shard '{os.path.basename(shard.path)}' "
+                 f"to {ARCHIVE_DOWNSAMPLE_INTERVAL_S}s ({downsampled_count} messages removed)")
+
+    def migrate_archive_layout(self) -> None:
+        """Move archived messages stored as JSON to the normalized layout in chunks."""
+        for shard in self.archive.get_shards():
+            write_count = self.archive.write_counts.get(shard.path, 0)
+            if self.migrated_shards.get(shard.path) == write_count:
+                continue
+            migrated_count = 0
+            after_key: Optional[tuple[int, int]] = (LEGACY_SHARD_START_MS - 1, 0)
+            while after_key is not None:
+                chunk_count, after_key = self.archive.migrate_to_normalized(shard, after_key, RETENTION_DELETE_CHUNK_SIZE)
+                migrated_count += chunk_count
+                if after_key is not None:
+                    sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+            self.archive.release_connection(shard)
+            self.migrated_shards[shard.path] = write_count
+            if migrated_count > 0:
+                self.migrated_archive_messages += migrated_count
+                info(f"[RETENTION] Migrated {migrated_count} messages of archive shard "
+                     f"'{os.path.basename(shard.path)}' to the normalized layout")
+
+    def seal_archive_blocks(self, cutoff_timestamp_ms: int) -> None:
+        """Pack the messages of all block periods ended before ``cutoff_timestamp_ms`` into compressed blocks."""
+        for shard in self.archive.get_shards(end_timestamp_ms=cutoff_timestamp_ms):
+            write_count = self.archive.write_counts.get(shard.path, 0)
+            if self.sealed_shards.get(shard.path) == write_count:
+                continue
+            sealed_count = 0
+            block_start_ms = self.archive.get_next_block_start(shard, LEGACY_SHARD_START_MS)
+            while block_start_ms is not None and block_start_ms + ARCHIVE_BLOCK_PERIOD_MS <= cutoff_timestamp_ms:
+                sealed_count += self.archive.seal_block(shard, block_start_ms)
+                sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+                block_start_ms = self.archive.get_next_block_start(shard, block_start_ms + ARCHIVE_BLOCK_PERIOD_MS)
+            if sealed_count > 0:
+                self.archive.compact(shard)
+            self.archive.release_connection(shard)
+            if not shard.legacy and shard.end_ms <= cutoff_timestamp_ms:
+                self.sealed_shards[shard.path] = write_count
+            if sealed_count > 0:
+                self.sealed_archive_messages += sealed_count
+                info(f"[RETENTION] Packed {sealed_count} messages of archive shard "
+                     f"'{os.path.basename(shard.path)}' into compressed blocks")
+
+    def enforce_queue_budget(self, queue: sqlite.DurableQueue) -> None:
+        """Drop the oldest rows of a queue while its table exceeds the queue budget.
+
+        Only the queue table is measured, other tables of its database (e.g. the
+        controller's ``messages`` table) cannot be shrunk by dropping queued rows.
+        """
+        evicted_count = 0
+        while queue.depth() > 0 and queue.used_bytes() > QUEUE_MAX_BYTES:
+            dropped_count = queue.drop_oldest(RETENTION_DELETE_CHUNK_SIZE)
+            if dropped_count == 0:
+                break
+            evicted_count += dropped_count
+            sleep(RETENTION_CHUNK_PAUSE_MS / 1000)
+        if evicted_count > 0:
+            self.evicted_queue_messages += evicted_count
+            warn(f"[RETENTION] Queue table '{queue.table}' exceeded {QUEUE_MAX_BYTES} bytes, "
+                 f"dropped {evicted_count} oldest rows")
+
+    def get_telemetry_values(self) -> dict[str, int]:
+        """Return the retention counters for the auxiliary telemetry."""
+        return {
+            "retention_evicted_archive_messages": self.evicted_archive_messages,
+            "retention_evicted_archive_shards": self.evicted_archive_shards,
+            "retention_evicted_queue_messages": self.evicted_queue_messages,
+            "retention_downsampled_messages": self.downsampled_messages,
+            "retention_migrated_archive_messages": self.migrated_archive_messages,
+            "retention_sealed_archive_messages": self.sealed_archive_messages,
+            "archive_size_bytes": self.archive_size_bytes,
+        }
@@ -0,0 +1,281 @@
+"""Concurrent execution of RPC requests.
+
+RPC handlers used to run on the gateway main loop. A ``run_command`` with a long
+timeout or an archive query stopped the forwarding of telemetry, the controller
+restart watchdog and all other RPCs until it finished.
+
+The :class:`RpcExecutor` runs RPC handlers on a pool of worker threads instead.
+Every RPC method declares how it is executed (see ``RPC_METHODS`` in
+:mod:`on_mqtt_msg.on_rpc_request`):
+
+- ``inline``: Lightweight methods such as ``ping`` or ``list`` run right away on
+  the main loop.
+- ``max_concurrent``: Number of requests of the method that may run at once.
+  Further requests are rejected with an error response while the limit is
+  reached.
+- ``timeout_s``: Time after which the request is reported as timed out. Python
+  threads cannot be stopped, so the handler itself has to end; its slot is only
+  freed when it did.
+- ``job``: Long-running methods. If a job has not responded within
+  ``TEG_RPC_JOB_RESPONSE_WAIT_S``, the requester gets its job id instead, and the
+  response is kept with the job (RPC ``rpc_job_status``).
+
+Every request run by a worker is recorded as an :class:`RpcJob`; the most recent
+ones are listed by the RPC ``rpc_jobs``.
+
+Configuration
+-------------
+- ``TEG_RPC_WORKER_THREADS``: Number of worker threads (default: 4).
+- ``TEG_RPC_JOB_RESPONSE_WAIT_S``: Time a long-running method may take to respond
+  before the requester gets its job id (default: 5).
+"""
+
+import json
+import os
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass
+from time import time_ns
+from typing import Any, Callable, Optional
+
+from modules.logging import debug, error, info
+from modules.mqtt import GatewayMqttClient
+
+RPC_WORKER_THREADS: int = int(os.environ.get("TEG_RPC_WORKER_THREADS") or 4)
+RPC_JOB_RESPONSE_WAIT_S: float = float(os.environ.get("TEG_RPC_JOB_RESPONSE_WAIT_S") or 5)
+# Number of finished jobs kept for rpc_jobs and rpc_job_status
+RPC_JOB_HISTORY_SIZE: int = 50
+
+RPC_JOB_STATUS_QUEUED: str = "queued"
+RPC_JOB_STATUS_RUNNING: str = "running"
+RPC_JOB_STATUS_DONE: str = "done"
+RPC_JOB_STATUS_FAILED: str = "failed"
+RPC_JOB_STATUS_TIMED_OUT: str = "timed_out"
+
+RpcHandler = Callable[[str, Any, Any], Any]
+
+singleton_instance: Optional["RpcExecutor"] = None
+
+
+def publish_rpc_response(rpc_msg_id: str, response: Any) -> bool:
+    """Publish an RPC response on the ThingsBoard RPC response topic."""
+    return GatewayMqttClient().publish_message_raw(
+        "v1/devices/me/rpc/response/" + rpc_msg_id,
+        json.dumps({"message": response})
+    )
+
+
+def get_timestamp_ms() -> int:
+    return int(time_ns() / 1_000_000)
+
+
+@dataclass
+class RpcJob:
+    """An RPC request executed by a worker thread.
+
+    Attributes
+    ----------
+    responded:
+      Whether a response was published to the requester.
+    detached:
+      Whether the requester got the job id instead of the response; the response
+      is only kept in :attr:`result` then.
+    """
+    id: int
+    rpc_msg_id: str
+    method: str
+    params: Any
+    handler: RpcHandler
+    timeout_s: float
+    status: str = RPC_JOB_STATUS_QUEUED
+    created_at_ms: int = 0
+    started_at_ms: Optional[int] = None
+    finished_at_ms: Optional[int] = None
+    result: Any = None
+    responded: bool = False
+    detached: bool = False
+
+    def to_dict(self, with_result: bool = False) -> dict[str, Any]:
+        job_dict = {
+            "job_id": self.id,
+            "method": self.method,
+            "status": self.status,
+            "created_at_ms": self.created_at_ms,
+            "started_at_ms": self.started_at_ms,
+            "finished_at_ms": self.finished_at_ms,
+        }
+        if with_result:
+            job_dict["result"] = self.result
+        return job_dict
+
+
+class RpcExecutor:
+    """Run RPC handlers inline or on worker threads, within their concurrency limits.
+
+    Implemented as a singleton, so the RPC handlers find the job they run in.
+
+    Attributes
+    ----------
+    jobs:
+      Most recent jobs, oldest first.
+    running_counts:
+      Number of unfinished jobs by method.
+    rejected_count:
+      Requests rejected because their method was at its concurrency limit.
+    """
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            debug("[RPC] Initializing RpcExecutor")
+            super().__init__()
+            singleton_instance = self
+            self.lock = threading.Lock()
+            self.job_queue: queue.Queue[RpcJob] = queue.Queue()
+            self.jobs: deque[RpcJob] = deque(maxlen=RPC_JOB_HISTORY_SIZE)
+            self.running_counts: dict[str, int] = {}
+            self.rejected_count = 0
+            self.last_job_id = 0
+            # job run by the current worker thread, to capture its responses
+            self.current = threading.local()
+            self.workers = [threading.Thread(target=self.run_worker, name=f"rpc-worker-{i}", daemon=True)
+                            for i in range(max(1, RPC_WORKER_THREADS))]
+            for worker in self.workers:
+                worker.start()
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(RpcExecutor, cls).__new__(cls)
+
+    def execute(self, rpc_msg_id: str, method: str, params: Any, method_definition: dict[str, Any]) -> None:
+        """Run an RPC request as its method declares.
+
+        Args:
+          rpc_msg_id: ThingsBoard RPC request identifier.
+          method: RPC method name.
+          params: RPC params payload.
+          method_definition: Entry of the method in ``RPC_METHODS``.
+        """
+        handler: RpcHandler = method_definition["exec"]
+        if method_definition.get("inline", False):
+            self.run_handler(handler, rpc_msg_id, method, params)
+            return
+
+        max_concurrent: int = method_definition["max_concurrent"]
+        with self.lock:
+            if self.running_counts.get(method, 0) >= max_concurrent:
+                self.rejected_count += 1
+                busy = True
+            else:
+                busy = False
+                self.running_counts[method] = self.running_counts.get(method, 0) + 1
+                self.last_job_id += 1
+                job = RpcJob(self.last_job_id, rpc_msg_id, method, params, handler,
+                             method_definition["timeout_s"], created_at_ms=get_timestamp_ms())
+                self.jobs.append(job)
+        if busy:
+            error(f"[RPC] Rejected '{method}' request, {max_concurrent} requests of it are running already")
+            publish_rpc_response(rpc_msg_id, f"Error - '{method}' is busy ({max_concurrent} requests running), "
+                                             f"try again later")
+            return
+
+        self.start_timer(job.timeout_s, self.time_out, job)
+        if method_definition.get("job", False):
+            self.start_timer(RPC_JOB_RESPONSE_WAIT_S, self.detach, job)
+        self.job_queue.put(job)
+
+    @staticmethod
+    def start_timer(delay_s: float, function: Callable[[RpcJob], None], job: RpcJob) -> None:
+        timer = threading.Timer(delay_s, function, [job])
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def run_handler(handler: RpcHandler, rpc_msg_id: str, method: str, params: Any) -> bool:
+        """Run a handler, responding with an error if it raises.
+
+        Returns:
+          ``False`` if the handler raised an exception.
+        """
+        try:
+            handler(rpc_msg_id, method, params)
+            return True
+        except Exception as e:
+            error(f"Error executing RPC method '{method}': {e}")
+            RpcExecutor().send_response(rpc_msg_id, f"Error executing RPC method '{method}': {e}")
+            return False
+
+    def run_worker(self) -> None:
+        while True:
+            job = self.job_queue.get()
+            with self.lock:
+                # jobs that timed out while queued are not started anymore
+                started = job.status == RPC_JOB_STATUS_QUEUED
+                if started:
+                    job.status = RPC_JOB_STATUS_RUNNING
+                    job.started_at_ms = get_timestamp_ms()
+            succeeded = False
+            if started:
+                self.current.job = job
+                succeeded = self.run_handler(job.handler, job.rpc_msg_id, job.method, job.params)
+                self.current.job = None
+            with self.lock:
+                job.finished_at_ms = get_timestamp_ms()
+                if job.status == RPC_JOB_STATUS_RUNNING:
+                    job.status = RPC_JOB_STATUS_DONE if succeeded else RPC_JOB_STATUS_FAILED
+                self.running_counts[job.method] -= 1
+            if job.detached:
+                info(f"[RPC] Job {job.id} ({job.method}) is {job.status}")
+
+    def send_response(self, rpc_msg_id: str, response: Any) -> bool:
+        """Respond to an RPC request, or keep the response with its job if the requester got the job id."""
+        job: Optional[RpcJob] = getattr(self.current, "job", None)
+        if job is not None and job.rpc_msg_id == rpc_msg_id:
+            with self.lock:
+                job.result = response
+                if job.responded or job.detached:
+                    return True
+                job.responded = True
+        return publish_rpc_response(rpc_msg_id, response)
+
+    def detach(self, job: RpcJob) -> None:
+        """Give the requester the job id if the job has not responded yet."""
+        with self.lock:
+            if job.responded or job.finished_at_ms is not None:
+                return
+            job.detached = True
+            job.responded = True
+        publish_rpc_response(job.rpc_msg_id, f"OK - Job {job.id} is {job.status} - "
+                                             f"get its result with rpc_job_status ({{job_id: {job.id}}})")
+
+    def time_out(self, job: RpcJob) -> None:
+        """Report a job that exceeded the timeout of its method."""
+        with self.lock:
+            if job.finished_at_ms is not None:
+                return
+            job.status = RPC_JOB_STATUS_TIMED_OUT
+            respond = not job.responded
+            job.responded = True
+        error(f"[RPC] Job {job.id} ({job.method}) timed out after {job.timeout_s} seconds")
+        if respond:
+            publish_rpc_response(job.rpc_msg_id, f"Error - '{job.method}' timed out after {job.timeout_s} seconds")
+
+    def get_jobs(self) -> list[RpcJob]:
+        with self.lock:
+            return list(self.jobs)
+
+    def get_job(self, job_id: int) -> Optional[RpcJob]:
+        with self.lock:
+            return next((job for job in self.jobs if job.id == job_id), None)
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return the number of unfinished and rejected requests for the auxiliary telemetry."""
+        with self.lock:
+            return {
+                "rpc_jobs_running": sum(self.running_counts.values()),
+                "rpc_jobs_rejected": self.rejected_count,
+            }
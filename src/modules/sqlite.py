@@ -6,7 +6,10 @@ support concurrent access via locking, and automatically recover from corrupted
 or unavailable database files.
 
 Typical use cases include buffering telemetry, logs, and controller messages when
-network connectivity is unavailable.
+network connectivity is unavailable. Such buffers are accessed through
+:class:`DurableQueue`, a FIFO queue on top of a table, or through a
+:class:`QueueCursor`, a persisted read position that consumes a queue without
+deleting each row.
 
 Design goals
 ------------
@@ -17,15 +20,20 @@ Design goals
 Notes
 -----
 - Write-ahead logging (WAL) is enabled to improve concurrency.
-- Databases are reset automatically if they become unusable.
+- Databases are reset automatically if they become unusable. A full disk is not
+  treated as such: the failed write is dropped and :data:`storage_full_event` is
+  set, so that the retention engine (:mod:`modules.retention`) frees space.
+- Prepared statements are cached per connection, so frequently executed queries
+  should use parameters instead of formatting values into the SQL string.
 """
 
 import os
 import sqlite3
+from bisect import bisect_right
 from enum import Enum
 from time import sleep
-from typing import Any
-from threading import Lock
+from typing import Any, Sequence
+from threading import Event, Lock
 
 
 from utils.misc import fatal_error
@@ -37,6 +45,24 @@ class SqliteTables(Enum):
     CONTROLLER_MESSAGES = "messages"
     HEALTH_CHECK = "health_check"
     PENDING_MQTT_MESSAGES = "pending_mqtt_messages"
+    LOG_BUFFER = "log_buffer"
+    QUEUE_DEPTHS = "queue_depths"
+    QUEUE_CURSORS = "queue_cursors"
+    PAYLOAD_DICTIONARIES = "payload_dictionaries"
+    REPUBLISH_JOBS = "republish_jobs"
+    UPLINK_STATE = "uplink_state"
+
+
+# Number of prepared statements cached per connection
+STATEMENT_CACHE_SIZE: int = 128
+
+# Set when a write failed because the disk is full
+storage_full_event = Event()
+
+
+def is_storage_full_error(error: Exception) -> bool:
+    """Check whether an SQLite error was caused by a full disk."""
+    return "database or disk is full" in str(error)
 
 
 class SqliteConnection:
@@ -61,10 +87,11 @@ class SqliteConnection:
         self.db_unavailable = True
         self.write_lock = Lock()
         try:
-            self.conn = sqlite3.connect(path, cached_statements=0, isolation_level=None, autocommit=True, check_same_thread=False)
+            self.conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE, isolation_level=None, autocommit=True, check_same_thread=False)
+            # auto_vacuum only takes effect before the database file is initialized, e.g. by switching to WAL
+            self.conn.execute("PRAGMA auto_vacuum  = FULL;")    # shrink the db file size when possible
             self.conn.execute("PRAGMA journal_mode=WAL;")       # enable write-ahead logging
             self.conn.execute("PRAGMA busy_timeout = 5000;")    # 5 seconds timeout for when the db is locked
-            self.conn.execute("PRAGMA auto_vacuum  = FULL;")    # shrink the db file size when possible
             self.db_unavailable = False
         except Exception as e:
             if dont_retry:
@@ -105,6 +132,19 @@ class SqliteConnection:
         """Check whether a table exists and contains at least one row."""
         return self.does_table_exist(table) and not self.is_table_empty(table)
 
+    def add_missing_columns(self, table: str, columns: dict[str, str]) -> None:
+        """Add columns that do not exist yet to a table.
+
+        Args:
+          table: Table name.
+          columns: Column definitions (e.g. ``"INTEGER NOT NULL DEFAULT 0"``) by column name.
+        """
+        existing_columns = {row[1] for row in self.execute(f"PRAGMA table_info({table})") or [] if len(row) > 1}
+        for column, definition in columns.items():
+            if column not in existing_columns:
+                info(f"[SQLITE]: Adding column '{column}' to table '{table}' at '{self.path}'")
+                self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
     def check(self) -> None:
         """Return the list of tables present in the database."""
         return self.execute(
@@ -130,11 +170,78 @@ class SqliteConnection:
             except Exception as e:
                 if "no such table" in str(e):
                     return [()]
+                if is_storage_full_error(e):
+                    # not logged via MQTT, buffering the log message would fail again
+                    print(f"[SQLITE][WARN] Disk full, dropping write to '{self.path}'")
+                    storage_full_event.set()
+                    return None
                 sleep(3)
                 self.reset_db_conn(e, 3, query)
                 return self.execute(query, params)
             return fetch
 
+    def execute_batch(self, operations: Sequence[tuple[str, Sequence[Any]]]) -> bool:
+        """Execute several statements within a single transaction.
+
+        Each operation is a ``(query, params_list)`` tuple and is executed once per
+        entry of ``params_list``. Either all operations are committed or none are, so
+        a batch of writes costs a single commit (and fsync) instead of one per
+        statement.
+
+        Args:
+          operations: Sequence of ``(query, params_list)`` tuples.
+
+        Returns:
+          ``True`` if the transaction was committed, otherwise ``False``.
+        """
+        if self.db_unavailable:
+            return False
+        with self.write_lock:
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                for query, params_list in operations:
+                    if len(params_list) == 1:
+                        cursor.execute(query, params_list[0])  # also allows non-DML statements
+                    else:
+                        cursor.executemany(query, params_list)
+                cursor.execute("COMMIT")
+            except Exception as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                if "no such table" in str(e):
+                    return False
+                if is_storage_full_error(e):
+                    print(f"[SQLITE][WARN] Disk full, dropping transaction on '{self.path}'")
+                    storage_full_event.set()
+                    return False
+                sleep(3)
+                self.reset_db_conn(e, 3, "; ".join(query for query, _ in operations))
+                return self.execute_batch(operations)
+            return True
+
+    def used_bytes(self) -> int:
+        """Return the size of the database pages in use, excluding free pages."""
+        result = self.execute(
+            "SELECT (page_count - freelist_count) * page_size FROM pragma_page_count, pragma_freelist_count, pragma_page_size")
+        if not result or len(result[0]) == 0:
+            return 0
+        return result[0][0]
+
+    def wait_until_idle(self, timeout_s: float) -> bool:
+        """Wait until no statement is running on the connection.
+
+        Used by signal handlers: the interrupted thread may hold the write lock,
+        which is not re-entrant.
+
+        Returns:
+          ``False`` if the write lock was not released within the timeout.
+        """
+        if not self.write_lock.acquire(timeout=timeout_s):
+            return False
+        self.write_lock.release()
+        return True
+
     def close(self) -> None:
         """Close the underlying SQLite connection."""
         self.conn.close()
@@ -162,3 +269,307 @@ class SqliteConnection:
             self.__init__(self.path, nr_retries - 1)  # type: ignore[misc]
         except Exception as e:
             fatal_error(f'Failed to reset sqlite db at "{self.path}": {e}')
+
+
+class DurableQueue:
+    """FIFO queue persisted in an SQLite table.
+
+    The table needs an ``id INTEGER PRIMARY KEY AUTOINCREMENT`` column; rows are
+    consumed in ``id`` order. Consumers peek at a batch of rows and acknowledge
+    them once processed, which deletes them from the table.
+
+    The number of queued rows is maintained by triggers in the
+    ``queue_depths`` table, so :meth:`depth` is a single primary key lookup and
+    also accounts for rows written by other processes (e.g. the controller).
+
+    Attributes
+    ----------
+    db:
+      Connection to the database holding the queue table.
+    table:
+      Name of the queue table.
+    columns:
+      Payload columns (excluding ``id``) written by :meth:`push_many` and returned
+      by :meth:`peek_batch`.
+    push_query / ack_through_query:
+      SQL statements that can be combined with other statements in
+      :meth:`SqliteConnection.execute_batch`.
+    """
+    def __init__(self, db: SqliteConnection, table: str, columns: Sequence[str]) -> None:
+        self.db = db
+        self.table = table
+        self.columns = list(columns)
+        column_list = ", ".join(self.columns)
+        self.push_query = f"INSERT INTO {table} ({column_list}) VALUES ({', '.join('?' * len(self.columns))})"
+        self.peek_query = f"SELECT id, {column_list} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+        self.ack_through_query = f"DELETE FROM {table} WHERE id <= ?"
+        self.ack_range_query = f"DELETE FROM {table} WHERE id BETWEEN ? AND ?"
+        self.last_id_query = f"SELECT MAX(id) FROM {table}"
+        self.depth_query = f"SELECT depth FROM {SqliteTables.QUEUE_DEPTHS.value} WHERE table_name = ?"
+        self.depth_counter_installed = self.install_depth_counter()
+
+    def install_depth_counter(self) -> bool:
+        """Create the triggers maintaining the row count of the queue table.
+
+        The counter is initialized with the current row count in the same
+        transaction, so concurrent inserts are neither lost nor counted twice.
+
+        Returns:
+          ``True`` if the counter is installed, ``False`` if the queue table does not exist yet.
+        """
+        depths_table = SqliteTables.QUEUE_DEPTHS.value
+        return self.db.execute_batch([
+            (f"CREATE TABLE IF NOT EXISTS {depths_table} (table_name TEXT PRIMARY KEY, depth INTEGER NOT NULL)", [()]),
+            (f"""CREATE TRIGGER IF NOT EXISTS {self.table}_depth_insert AFTER INSERT ON {self.table} BEGIN
+                UPDATE {depths_table} SET depth = depth + 1 WHERE table_name = '{self.table}'; END""", [()]),
+            (f"""CREATE TRIGGER IF NOT EXISTS {self.table}_depth_delete AFTER DELETE ON {self.table} BEGIN
+                UPDATE {depths_table} SET depth = depth - 1 WHERE table_name = '{self.table}'; END""", [()]),
+            (f"INSERT OR IGNORE INTO {depths_table} (table_name, depth) SELECT ?, COUNT(*) FROM {self.table}",
+             [(self.table,)]),
+        ])
+
+    def push_many(self, rows: Sequence[Sequence[Any]]) -> bool:
+        """Append rows to the queue in a single transaction.
+
+        Args:
+          rows: Values for :attr:`columns`, one sequence per row.
+
+        Returns:
+          ``True`` if the rows were written, otherwise ``False``.
+        """
+        if len(rows) == 0:
+            return True
+        return self.db.execute_batch([(self.push_query, rows)])
+
+    def peek_batch(self, n: int, after_id: int = 0) -> list[tuple]:
+        """Return the oldest rows of the queue without removing them.
+
+        Args:
+          n: Maximum number of rows.
+          after_id: Only return rows with an ``id`` greater than this.
+
+        Returns:
+          ``(id, *columns)`` tuples in ``id`` order.
+        """
+        rows = self.db.execute(self.peek_query, (after_id, n))
+        # a missing table is reported as [()]
+        return [row for row in rows or [] if len(row) == len(self.columns) + 1]
+
+    def last_id(self) -> int:
+        """Return the ``id`` of the newest row, ``0`` if the queue is empty."""
+        result = self.db.execute(self.last_id_query)
+        if not result or len(result[0]) == 0 or result[0][0] is None:
+            return 0
+        return result[0][0]
+
+    def ack_through(self, last_id: int) -> None:
+        """Remove all rows up to and including ``last_id`` from the queue."""
+        self.db.execute(self.ack_through_query, (last_id,))
+
+    def ack_ranges(self, id_ranges: Sequence[tuple[int, int]]) -> None:
+        """Remove the given inclusive ``(first_id, last_id)`` ranges in one transaction."""
+        if len(id_ranges) > 0:
+            self.db.execute_batch([(self.ack_range_query, id_ranges)])
+
+    def used_bytes(self) -> int:
+        """Return the disk usage of the queue table and its indexes, excluding other tables of the database.
+
+        Uses the ``dbstat`` virtual table if SQLite was built with it, otherwise
+        the size of the queued payloads.
+        """
+        names = self.db.execute("SELECT name FROM sqlite_master WHERE tbl_name = ? AND type IN ('table', 'index')",
+                                (self.table,))
+        used_bytes = 0
+        for row in names or []:
+            if len(row) != 1:
+                continue
+            result = self.db.execute("SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = ?", (row[0],))
+            if not result or len(result[0]) == 0:
+                # "no such table: dbstat", SQLite was built without it
+                payload_bytes = " + ".join(f"IFNULL(LENGTH(CAST({column} AS BLOB)), 0)" for column in self.columns)
+                result = self.db.execute(f"SELECT COALESCE(SUM(8 + {payload_bytes}), 0) FROM {self.table}")
+                return result[0][0] if result and len(result[0]) > 0 else 0
+            used_bytes += result[0][0]
+        return used_bytes
+
+    def drop_oldest(self, n: int) -> int:
+        """Remove up to ``n`` of the oldest rows without consuming them.
+
+        Returns:
+          Number of removed rows.
+        """
+        result = self.db.execute(
+            f"DELETE FROM {self.table} WHERE id IN (SELECT id FROM {self.table} ORDER BY id LIMIT ?) RETURNING id", (n,))
+        return len([row for row in result or [] if len(row) == 1])
+
+    def truncate_consumed(self, cursors: Sequence["QueueCursor"], min_rows: int = 1) -> int:
+        """Remove the rows consumed by all given cursors in a single statement.
+
+        Args:
+          cursors: All cursors reading from this queue.
+          min_rows: Only truncate once at least this many rows were consumed by every cursor.
+
+        Returns:
+          Number of rows removed.
+        """
+        if len(cursors) == 0:
+            return 0
+        consumed_rows = min(cursor.consumed_rows for cursor in cursors)
+        if consumed_rows == 0 or consumed_rows < min_rows:
+            return 0
+        self.ack_through(min(cursor.position for cursor in cursors))
+        for cursor in cursors:
+            cursor.count_consumed_rows()
+        return consumed_rows
+
+    def drop_cursors(self) -> None:
+        """Remove all persisted cursors of this queue.
+
+        Rows consumed by all of them are removed as well; rows consumed by only some
+        of them stay in the queue and will be consumed again.
+        """
+        cursors_table = SqliteTables.QUEUE_CURSORS.value
+        result = self.db.execute(f"SELECT MIN(position) FROM {cursors_table} WHERE table_name = ?", (self.table,))
+        # a missing cursors table is reported as [()], no cursors as [(None,)]
+        if not result or len(result[0]) == 0 or result[0][0] is None:
+            return
+        self.db.execute_batch([
+            (self.ack_through_query, [(result[0][0],)]),
+            (f"DELETE FROM {cursors_table} WHERE table_name = ?", [(self.table,)]),
+        ])
+
+    def depth(self) -> int:
+        """Return the number of rows in the queue.
+
+        Returns:
+          Number of queued rows, ``0`` if the queue table does not exist yet.
+        """
+        if not self.depth_counter_installed:
+            self.depth_counter_installed = self.install_depth_counter()
+            if not self.depth_counter_installed:
+                return 0
+        result = self.db.execute(self.depth_query, (self.table,))
+        if not result or len(result[0]) == 0:
+            return 0
+        return result[0][0]
+
+
+class QueueCursor:
+    """Persisted read position over a :class:`DurableQueue`.
+
+    A cursor consumes a queue without deleting each row: acknowledging rows only
+    advances the position stored in the ``queue_cursors`` table. Several cursors
+    can read the same queue independently; rows consumed by all of them are
+    removed in bulk with :meth:`DurableQueue.truncate_consumed`.
+
+    The cursor offers the same ``peek_batch``/``ack_through``/``ack_ranges``/
+    ``depth``/``last_id`` interface as :class:`DurableQueue`, so consumers work
+    with either.
+
+    Attributes
+    ----------
+    queue:
+      Queue the cursor reads from.
+    name:
+      Unique name of the cursor within the database.
+    position:
+      Highest row id consumed so far.
+    consumed_rows:
+      Number of rows up to :attr:`position` that are still in the queue table.
+    """
+    def __init__(self, queue: DurableQueue, name: str) -> None:
+        self.queue = queue
+        self.name = name
+        self.columns = queue.columns
+        self.db = queue.db
+        cursors_table = SqliteTables.QUEUE_CURSORS.value
+        self.position_query = f"SELECT position FROM {cursors_table} WHERE name = ?"
+        self.advance_query = f"UPDATE {cursors_table} SET position = ? WHERE name = ?"
+        self.range_count_query = f"SELECT COUNT(*) FROM {queue.table} WHERE id > ? AND id <= ?"
+        self.gap_query = f"SELECT EXISTS(SELECT 1 FROM {queue.table} WHERE id > ? AND id < ?)"
+        # acknowledged ranges that cannot be consumed yet because earlier rows are still pending
+        self.acked_ranges: list[tuple[int, int]] = []
+
+        self.db.execute_batch([
+            (f"""CREATE TABLE IF NOT EXISTS {cursors_table} (
+                name TEXT PRIMARY KEY, table_name TEXT NOT NULL, position INTEGER NOT NULL)""", [()]),
+            (f"INSERT OR IGNORE INTO {cursors_table} (name, table_name, position) VALUES (?, ?, 0)",
+             [(name, queue.table)]),
+        ])
+        result = self.db.execute(self.position_query, (name,))
+        self.position: int = result[0][0] if result and len(result[0]) > 0 else 0
+        self.consumed_rows = 0
+        self.count_consumed_rows()
+
+    def count_consumed_rows(self) -> None:
+        """Recount the consumed rows still present in the queue table."""
+        self.consumed_rows = self.count_rows(0, self.position)
+
+    def count_rows(self, after_id: int, through_id: int) -> int:
+        """Count the queue rows with ``after_id < id <= through_id``."""
+        result = self.db.execute(self.range_count_query, (after_id, through_id))
+        if not result or len(result[0]) == 0:
+            return 0
+        return result[0][0]
+
+    def peek_batch(self, n: int, after_id: int = 0) -> list[tuple]:
+        """Return the oldest rows after the cursor position.
+
+        Args:
+          n: Maximum number of rows.
+          after_id: Only return rows with an ``id`` greater than this.
+
+        Rows acknowledged out of order (see :meth:`ack_ranges`) are skipped.
+
+        Returns:
+          ``(id, *columns)`` tuples in ``id`` order.
+        """
+        after_id = max(after_id, self.position)
+        while True:
+            rows = self.queue.peek_batch(n, after_id=after_id)
+            if len(self.acked_ranges) == 0:
+                return rows
+            unacked_rows = [row for row in rows if not self.is_acked(row[0])]
+            if len(unacked_rows) > 0 or len(rows) < n:
+                return unacked_rows
+            after_id = rows[-1][0]
+
+    def is_acked(self, message_id: int) -> bool:
+        """Return whether a row after the position was acknowledged out of order."""
+        index = bisect_right(self.acked_ranges, (message_id, float("inf"))) - 1
+        return index >= 0 and self.acked_ranges[index][1] >= message_id
+
+    def last_id(self) -> int:
+        """Return the ``id`` of the newest row of the queue, ``0`` if it is empty."""
+        return self.queue.last_id()
+
+    def ack_through(self, last_id: int) -> None:
+        """Mark all rows up to and including ``last_id`` as consumed."""
+        if last_id <= self.position:
+            return
+        consumed_rows = self.count_rows(self.position, last_id)
+        self.db.execute(self.advance_query, (last_id, self.name))
+        self.position = last_id
+        self.consumed_rows += consumed_rows
+
+    def ack_ranges(self, id_ranges: Sequence[tuple[int, int]]) -> None:
+        """Mark the given inclusive ``(first_id, last_id)`` ranges as consumed.
+
+        The position only advances over ranges that directly follow it; ranges
+        acknowledged out of order are kept until the rows before them are consumed.
+        """
+        self.acked_ranges = sorted(self.acked_ranges + list(id_ranges))
+        new_position = self.position
+        while len(self.acked_ranges) > 0:
+            first_id, last_id = self.acked_ranges[0]
+            if first_id > new_position + 1:
+                result = self.db.execute(self.gap_query, (new_position, first_id))
+                if not result or len(result[0]) == 0 or result[0][0]:
+                    break
+            new_position = max(new_position, last_id)
+            self.acked_ranges.pop(0)
+        self.ack_through(new_position)
+
+    def depth(self) -> int:
+        """Return the number of rows not consumed by this cursor yet."""
+        return max(0, self.queue.depth() - self.consumed_rows)
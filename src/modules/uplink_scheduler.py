@@ -0,0 +1,182 @@
+"""Prioritized scheduling of the uplink traffic.
+
+All traffic to ThingsBoard shares one MQTT connection. The main loop used to
+drain its queues one after the other, each until it was empty: after a
+reconnect, a burst of buffered log messages delayed the live measurements and
+the auxiliary health telemetry until the whole log buffer was sent.
+
+The :class:`UplinkScheduler` serves named lanes instead, one batch at a time.
+
+Lanes
+-----
+- ``health``: Auxiliary health telemetry. A priority lane, served before all
+  other lanes whenever it is due.
+- ``logs``: The gateway log buffer.
+- ``live``: Controller messages waiting for upload (the pending queue and, in
+  cursor mode, the controller queue).
+- ``backfill``: With ``TEG_UPLINK_DRAIN_ORDER=newest_first``, the older controller
+  messages, which are published after the newest ones at a limited rate (see
+  :class:`modules.pending_publisher.NewestFirstDrain`).
+- ``backlog``: Archive republish jobs (see :mod:`modules.republish_jobs`). They
+  are published by their own thread, only while all other lanes are empty.
+
+RPC responses are not queued at all: the RPC handlers publish them right away,
+and the main loop processes inbound messages before serving any lane.
+
+Weighted fair scheduling
+------------------------
+Weighted lanes share the uplink in proportion to their weights. Every lane has a
+virtual time, which advances by the number of messages it sent divided by its
+weight. The lane with the lowest virtual time that has something to send is
+served next. A lane that was idle starts at the virtual time of the lane served
+last, so it cannot claim the uplink exclusively to make up for its idle time.
+
+Configuration
+-------------
+- ``TEG_UPLINK_LOGS_WEIGHT``: Weight of the ``logs`` lane (default: 1).
+- ``TEG_UPLINK_LIVE_WEIGHT``: Weight of the ``live`` lane (default: 4).
+- ``TEG_UPLINK_BACKFILL_WEIGHT``: Weight of the ``backfill`` lane (default: 1).
+
+Notes
+-----
+- The queue depth, the age of the oldest queued message and the number of sent
+  messages of every lane are reported with the auxiliary telemetry (see
+  :meth:`UplinkScheduler.get_telemetry_values`).
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from time import time_ns
+from typing import Any, Callable, Optional
+
+from modules.logging import debug
+
+UPLINK_LOGS_WEIGHT: float = float(os.environ.get("TEG_UPLINK_LOGS_WEIGHT") or 1)
+UPLINK_LIVE_WEIGHT: float = float(os.environ.get("TEG_UPLINK_LIVE_WEIGHT") or 4)
+UPLINK_BACKFILL_WEIGHT: float = float(os.environ.get("TEG_UPLINK_BACKFILL_WEIGHT") or 1)
+
+singleton_instance: Optional["UplinkScheduler"] = None
+
+
+@dataclass
+class UplinkLane:
+    """A named source of uplink traffic.
+
+    Attributes
+    ----------
+    name:
+      Lane name, used in the telemetry keys.
+    send:
+      Publishes the next batch of the lane and returns the number of messages
+      processed, ``0`` if there was nothing to send. ``None`` for lanes published
+      by their own thread.
+    depth:
+      Returns the number of queued messages.
+    oldest_timestamp_ms:
+      Returns the Unix timestamp in milliseconds of the oldest queued message,
+      ``None`` if the lane is empty.
+    weight:
+      Share of the uplink relative to the other weighted lanes, ``None`` for
+      priority lanes.
+    """
+    name: str
+    send: Optional[Callable[[], int]]
+    depth: Callable[[], int]
+    oldest_timestamp_ms: Callable[[], Optional[int]]
+    weight: Optional[float] = None
+    virtual_time: float = 0.0
+    sent_count: int = 0
+
+
+class UplinkScheduler:
+    """Decide which lane publishes next.
+
+    Implemented as a singleton, so threads publishing their own lanes can wait
+    for :attr:`idle`.
+
+    Attributes
+    ----------
+    lanes:
+      Lanes in the order they were added. Priority lanes are served in this order.
+    idle:
+      Set while no lane served by the main loop has queued messages.
+    """
+
+    def __init__(self) -> None:
+        global singleton_instance
+        if singleton_instance is None:
+            debug("[UPLINK] Initializing UplinkScheduler")
+            super().__init__()
+            singleton_instance = self
+            self.lanes: list[UplinkLane] = []
+            self.virtual_time = 0.0
+            self.idle = threading.Event()
+            self.idle.set()
+
+    # Singleton pattern
+    def __new__(cls: Any) -> Any:
+        global singleton_instance
+        if singleton_instance is not None:
+            return singleton_instance
+        return super(UplinkScheduler, cls).__new__(cls)
+
+    def add_lane(self, lane: UplinkLane) -> None:
+        """Add a lane, replacing any lane of the same name."""
+        self.lanes = [existing_lane for existing_lane in self.lanes if existing_lane.name != lane.name] + [lane]
+
+    def get_lane(self, name: str) -> Optional[UplinkLane]:
+        """Return a lane by name."""
+        return next((lane for lane in self.lanes if lane.name == name), None)
+
+    def send_next(self) -> int:
+        """Serve the due priority lane or the weighted lane that is next in line.
+
+        Returns:
+          Number of messages processed, ``0`` if no lane had anything to send.
+        """
+        for lane in self.lanes:
+            if lane.send is None or lane.weight is not None:
+                continue
+            processed = lane.send()
+            if processed > 0:
+                lane.sent_count += processed
+                self.idle.clear()
+                return processed
+
+        weighted_lanes = [lane for lane in self.lanes if lane.send is not None and lane.weight is not None]
+        for lane in sorted(weighted_lanes, key=lambda weighted_lane: weighted_lane.virtual_time):
+            assert lane.send is not None and lane.weight is not None
+            processed = lane.send()
+            if processed == 0:
+                # idle lanes do not accumulate credit
+                lane.virtual_time = max(lane.virtual_time, self.virtual_time)
+                continue
+            lane.sent_count += processed
+            self.virtual_time = lane.virtual_time
+            lane.virtual_time += processed / max(lane.weight, 1e-6)
+            self.idle.clear()
+            return processed
+
+        # lanes waiting for acknowledgements still have queued messages
+        if all(lane.depth() == 0 for lane in self.lanes if lane.send is not None):
+            self.idle.set()
+        return 0
+
+    def record_sent(self, name: str, count: int) -> None:
+        """Count messages published by a lane's own thread."""
+        lane = self.get_lane(name)
+        if lane is not None:
+            lane.sent_count += count
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return the queue depth, latency and sent messages of every lane for the auxiliary telemetry."""
+        now_ms = int(time_ns() / 1_000_000)
+        values: dict[str, Any] = {}
+        for lane in self.lanes:
+            oldest_timestamp_ms = lane.oldest_timestamp_ms()
+            values[f"uplink_{lane.name}_depth"] = lane.depth()
+            values[f"uplink_{lane.name}_latency_ms"] = \
+                max(0, now_ms - oldest_timestamp_ms) if oldest_timestamp_ms is not None else 0
+            values[f"uplink_{lane.name}_sent"] = lane.sent_count
+        return values
@@ -0,0 +1,185 @@
+"""Uplink state reported to the controller.
+
+The controller writes its messages into the communication queue database without
+knowing whether the gateway keeps up with uploading them. While the gateway is
+offline or the uplink is slower than the controller, the queue grows until the
+disk is full.
+
+The :class:`UplinkStateReporter` periodically writes the state of the uplink into
+the single row of the ``uplink_state`` table of the communication queue database
+(see :mod:`db_schemas.uplink_state_table`). Controllers read it to throttle or to
+switch to aggregated reporting; ``demo/example_controller/db.py`` shows how.
+
+States
+------
+- ``ok``: Connected, and at most ``TEG_BACKPRESSURE_QUEUE_DEPTH`` messages are
+  waiting for upload. No interval is recommended.
+- ``behind``: Connected, but more messages are waiting. The recommended interval
+  limits the fill rate to :data:`BACKPRESSURE_TARGET_UTILIZATION` of the measured
+  drain rate, so the backlog shrinks.
+- ``offline``: Not connected to ThingsBoard. The recommended interval makes the
+  free disk space last ``TEG_BACKPRESSURE_OFFLINE_HORIZON_DAYS``, based on the
+  average size of the queued messages. It is ``0`` if the space lasts at the
+  current fill rate.
+
+Rates are measured over the last :data:`UPLINK_STATE_RATE_WINDOW_S` seconds. The
+fill rate is derived from the row ids of the controller ``messages`` table, the
+drain rate from the rows removed from the uplink queues.
+
+Configuration
+-------------
+- ``TEG_BACKPRESSURE_QUEUE_DEPTH``: Queue depth above which the gateway is
+  ``behind`` (default: 1000).
+- ``TEG_BACKPRESSURE_OFFLINE_HORIZON_DAYS``: Time the free disk space should last
+  while offline (default: 7).
+"""
+
+import math
+import os
+import shutil
+from collections import deque
+from time import monotonic, time_ns
+from typing import Any, Optional, Sequence, Union
+
+from db_schemas.uplink_state_table import CREATE_UPLINK_STATE_TABLE_QUERY, UPLINK_STATE_COLUMNS
+from modules import sqlite
+from modules.logging import info
+from modules.pending_publisher import PendingMessagePublisher
+from modules.retention import MIN_FREE_DISK_BYTES
+
+BACKPRESSURE_QUEUE_DEPTH: int = int(os.environ.get("TEG_BACKPRESSURE_QUEUE_DEPTH") or 1_000)
+BACKPRESSURE_OFFLINE_HORIZON_DAYS: float = float(os.environ.get("TEG_BACKPRESSURE_OFFLINE_HORIZON_DAYS") or 7)
+# Share of the drain rate recommended as fill rate while the gateway is behind
+BACKPRESSURE_TARGET_UTILIZATION: float = 0.8
+# Interval between two updates of the uplink state
+UPLINK_STATE_UPDATE_INTERVAL_MS: int = 5_000
+# Time window the fill and drain rates are measured over
+UPLINK_STATE_RATE_WINDOW_S: int = 60
+# Message size assumed while no messages are queued
+UPLINK_STATE_DEFAULT_MESSAGE_BYTES: int = 1_024
+
+UPLINK_STATE_OK: str = "ok"
+UPLINK_STATE_BEHIND: str = "behind"
+UPLINK_STATE_OFFLINE: str = "offline"
+
+
+class UplinkStateReporter:
+    """Measure the uplink and write its state into the ``uplink_state`` table.
+
+    Attributes
+    ----------
+    db:
+      Connection to the communication queue database.
+    controller_queue:
+      Queue of controller messages (``messages`` table), whose row ids count the written messages.
+    uplink_queues:
+      Queues whose rows wait for upload.
+    publishers:
+      Publishers draining the uplink queues.
+    samples:
+      ``(monotonic time, written messages, drained messages)`` within the rate window.
+    state:
+      Last reported state row, by column.
+    """
+
+    def __init__(self, db: sqlite.SqliteConnection, controller_queue: sqlite.DurableQueue,
+                 uplink_queues: Sequence[Union[sqlite.DurableQueue, sqlite.QueueCursor]],
+                 publishers: Sequence[PendingMessagePublisher]) -> None:
+        self.db = db
+        self.controller_queue = controller_queue
+        self.uplink_queues = list(uplink_queues)
+        self.publishers = list(publishers)
+        self.samples: deque[tuple[float, int, int]] = deque()
+        self.state: dict[str, Any] = {}
+        self.last_update: Optional[float] = None
+        self.table = sqlite.SqliteTables.UPLINK_STATE.value
+        self.db.execute(CREATE_UPLINK_STATE_TABLE_QUERY)
+        self.update_query = f"""INSERT OR REPLACE INTO {self.table} (id, {', '.join(UPLINK_STATE_COLUMNS)})
+            VALUES (1, {', '.join('?' * len(UPLINK_STATE_COLUMNS))})"""
+
+    def measure_rates(self) -> tuple[float, float]:
+        """Add a sample and return the fill and drain rates in messages per second."""
+        now = monotonic()
+        self.samples.append((now, self.controller_queue.last_id(),
+                             sum(publisher.drained_count for publisher in self.publishers)))
+        while len(self.samples) > 2 and self.samples[0][0] < now - UPLINK_STATE_RATE_WINDOW_S:
+            self.samples.popleft()
+        first_time, first_written, first_drained = self.samples[0]
+        elapsed_s = now - first_time
+        if elapsed_s <= 0:
+            return 0.0, 0.0
+        # the ids restart after the controller queue was emptied and recreated
+        return max(0, self.samples[-1][1] - first_written) / elapsed_s, (self.samples[-1][2] - first_drained) / elapsed_s
+
+    def get_offline_interval_ms(self, queue_depth: int, fill_rate: float) -> int:
+        """Return the message interval at which the free disk space lasts the offline horizon."""
+        used_bytes = self.db.used_bytes()
+        message_bytes = used_bytes / queue_depth if queue_depth > 0 and used_bytes > 0 else UPLINK_STATE_DEFAULT_MESSAGE_BYTES
+        free_bytes = shutil.disk_usage(os.path.dirname(os.path.abspath(self.db.path))).free - MIN_FREE_DISK_BYTES
+        horizon_ms = BACKPRESSURE_OFFLINE_HORIZON_DAYS * 86_400_000
+        if free_bytes <= 0:
+            return int(horizon_ms)
+        interval_ms = horizon_ms * message_bytes / free_bytes
+        return 0 if fill_rate * interval_ms <= 1000 else math.ceil(interval_ms)
+
+    def update(self, connected: bool) -> None:
+        """Measure the uplink and write its state.
+
+        Args:
+          connected: Whether the gateway is connected to ThingsBoard.
+        """
+        self.last_update = monotonic()
+        fill_rate, drain_rate = self.measure_rates()
+        queue_depth = sum(queue.depth() for queue in self.uplink_queues)
+        oldest_timestamp_ms = min((timestamp_ms for timestamp_ms in
+                                   (publisher.oldest_timestamp_ms() for publisher in self.publishers)
+                                   if timestamp_ms is not None), default=None)
+        now_ms = int(time_ns() / 1_000_000)
+
+        if not connected:
+            state = UPLINK_STATE_OFFLINE
+            recommended_interval_ms = self.get_offline_interval_ms(queue_depth, fill_rate)
+        elif queue_depth <= BACKPRESSURE_QUEUE_DEPTH:
+            state = UPLINK_STATE_OK
+            recommended_interval_ms = 0
+        else:
+            state = UPLINK_STATE_BEHIND
+            if drain_rate > 0:
+                recommended_interval_ms = math.ceil(1000 / (BACKPRESSURE_TARGET_UTILIZATION * drain_rate))
+            else:
+                recommended_interval_ms = self.get_offline_interval_ms(queue_depth, fill_rate)
+
+        if state != self.state.get("state"):
+            info(f"[UPLINK] Uplink state is {state} - {queue_depth} messages queued, "
+                 f"recommended interval: {recommended_interval_ms} ms")
+        self.state = {
+            "updated_at_ms": now_ms,
+            "connected": int(connected),
+            "state": state,
+            "queue_depth": queue_depth,
+            "queue_latency_ms": max(0, now_ms - oldest_timestamp_ms) if oldest_timestamp_ms is not None else 0,
+            "fill_rate": round(fill_rate, 3),
+            "drain_rate": round(drain_rate, 3),
+            "recommended_interval_ms": recommended_interval_ms,
+        }
+        self.db.execute(self.update_query, tuple(self.state[column] for column in UPLINK_STATE_COLUMNS))
+
+    def update_if_due(self, connected: bool) -> None:
+        """Update the uplink state if :data:`UPLINK_STATE_UPDATE_INTERVAL_MS` passed since the last update."""
+        if self.ms_until_update() == 0:
+            self.update(connected)
+
+    def ms_until_update(self) -> float:
+        """Return the time until the next update is due."""
+        if self.last_update is None:
+            return 0
+        return max(0.0, UPLINK_STATE_UPDATE_INTERVAL_MS - (monotonic() - self.last_update) * 1000)
+
+    def get_telemetry_values(self) -> dict[str, Any]:
+        """Return the last reported state for the auxiliary telemetry."""
+        return {
+            "uplink_state": self.state.get("state"),
+            "uplink_fill_rate": self.state.get("fill_rate"),
+            "uplink_drain_rate": self.state.get("drain_rate"),
+            "uplink_recommended_interval_ms": self.state.get("recommended_interval_ms"),
+        }
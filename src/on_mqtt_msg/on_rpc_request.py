@@ -10,6 +10,12 @@ maintenance tasks, such as rebooting the device, restarting the controller,
 initializing remote file management attributes, or republishing archived
 telemetry.
 
+Execution
+---------
+Requests are executed by :class:`modules.rpc_executor.RpcExecutor`. Every entry
+of :data:`RPC_METHODS` declares whether the method runs inline on the main loop
+or on a worker thread, and how many requests of it may run at once.
+
 Security notes
 --------------
 Some RPC methods (notably ``run_command``) can execute arbitrary commands on the
@@ -18,26 +24,44 @@ permissions and dashboard access control.
 
 """
 
+import codecs
 import json
 import os
-import queue
+import selectors
 import signal
 import subprocess
-import threading
-from time import sleep, monotonic
+from collections import deque
+from time import sleep, monotonic, time_ns
 from typing import Any, Optional
 
-import utils.paths
-from modules import sqlite
+from modules.archive import GatewayArchive
+from modules.archive_query import ArchiveQueryError, query_archive
 from modules.docker_client import GatewayDockerClient
 from modules.file_writer import GatewayFileWriter
 from modules.mqtt import GatewayMqttClient
+from modules.republish_jobs import RepublishJobRunner, JOB_STATUS_CANCELLED, JOB_STATUS_PAUSED, JOB_STATUS_RUNNING
+from modules.rpc_executor import RpcExecutor
 
-from modules.logging import info, error, debug
+from modules.logging import info, error, debug, get_captured_records, get_log_levels, set_log_level, LOG_LEVEL_RANKS
 from on_mqtt_msg.check_for_file_hashes_update import FILE_HASHES_TB_KEY
 
 import utils.controller_restart
 
+# Maximum number of output characters in the response of run_command
+RUN_COMMAND_MAX_OUTPUT_CHARS: int = int(os.environ.get("TEG_RUN_COMMAND_MAX_OUTPUT_CHARS") or 16_384)
+# Maximum timeout of run_command, each request holds one of its worker slots for up to this long
+RUN_COMMAND_MAX_TIMEOUT_S: int = int(os.environ.get("TEG_RUN_COMMAND_MAX_TIMEOUT_S") or 3_600)
+# Interval and maximum size of the output chunks streamed by run_command
+RUN_COMMAND_STREAM_INTERVAL_S: float = 1.0
+RUN_COMMAND_STREAM_MAX_CHUNK_CHARS: int = 4_096
+# Maximum number of bytes read from the command output at once
+RUN_COMMAND_READ_SIZE: int = 65_536
+# Default and maximum number of records returned by log_dump
+LOG_DUMP_DEFAULT_RECORDS: int = 200
+LOG_DUMP_MAX_RECORDS: int = 1_000
+# Maximum number of message characters in the response of log_dump
+LOG_DUMP_MAX_MESSAGE_CHARS: int = 65_536
+
 def rpc_reboot(rpc_msg_id: str, _method: Any, _params: Any) -> None:
     """Reboot the Edge Gateway host system.
 
@@ -95,11 +119,66 @@ def rpc_init_files(rpc_msg_id: str, _method: Any, _params: Any) -> None:
     GatewayMqttClient().request_attributes({"sharedKeys": f"FILES"})
     send_rpc_response(rpc_msg_id, "Files client attributes initialized")
 
+class OutputTail:
+    """Keep the last characters of a command output.
+
+    Attributes
+    ----------
+    max_chars:
+      Maximum number of characters kept.
+    truncated_chars:
+      Number of characters dropped from the start of the output.
+    """
+
+    def __init__(self, max_chars: int) -> None:
+        self.max_chars = max_chars
+        self.chunks: deque[str] = deque()
+        self.length = 0
+        self.truncated_chars = 0
+
+    def append(self, text: str) -> None:
+        self.chunks.append(text)
+        self.length += len(text)
+        while self.length > self.max_chars:
+            excess = self.length - self.max_chars
+            if len(self.chunks[0]) <= excess:
+                dropped = len(self.chunks.popleft())
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                dropped = excess
+            self.length -= dropped
+            self.truncated_chars += dropped
+
+    def get_text(self) -> str:
+        """Return the kept output, preceded by a marker if characters were dropped."""
+        text = "".join(self.chunks)
+        if self.truncated_chars > 0:
+            return f"[... {self.truncated_chars} characters truncated ...]\n{text}"
+        return text
+
+
+def publish_command_output_chunk(rpc_msg_id: str, sequence_number: int, output: OutputTail) -> None:
+    """Publish a chunk of the output of a running command as telemetry."""
+    GatewayMqttClient().publish_telemetry(json.dumps({
+        "ts": int(time_ns() / 1_000_000),
+        "values": {
+            "run_command_rpc_id": rpc_msg_id,
+            "run_command_seq": sequence_number,
+            "run_command_output": output.get_text(),
+        }
+    }))
+
+
 def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any) -> None:
     """Execute a command on the Edge Gateway host.
 
-    This method executes an arbitrary command and returns its combined stdout/stderr
-    output. The command is killed if it exceeds the provided timeout.
+    This method executes an arbitrary command and returns the end of its combined
+    stdout/stderr output, at most ``TEG_RUN_COMMAND_MAX_OUTPUT_CHARS`` characters.
+    With ``stream_output``, the output is also published as ``run_command_output``
+    telemetry while the command runs, in chunks of at most
+    :data:`RUN_COMMAND_STREAM_MAX_CHUNK_CHARS` characters per
+    :data:`RUN_COMMAND_STREAM_INTERVAL_S`. The command is killed if it exceeds the
+    provided timeout.
 
     Parameters are validated strictly. This method is powerful and must be
     protected via ThingsBoard access control.
@@ -113,66 +192,89 @@ def rpc_run_command(rpc_msg_id: str, _method: Any, params: Any) -> None:
         return send_rpc_method_error(rpc_msg_id, "Running command failed: 'command' must be a list of strings")
     if "timeout_s" in params and type(params["timeout_s"]) is not int:
         return send_rpc_method_error(rpc_msg_id, "Running command failed: 'timeout_s' must be an integer")
+    if "timeout_s" in params and params["timeout_s"] > RUN_COMMAND_MAX_TIMEOUT_S:
+        return send_rpc_method_error(rpc_msg_id, f"Running command failed: 'timeout_s' must be at most "
+                                                 f"{RUN_COMMAND_MAX_TIMEOUT_S} (TEG_RUN_COMMAND_MAX_TIMEOUT_S)")
+    if "stream_output" in params and type(params["stream_output"]) is not bool:
+        return send_rpc_method_error(rpc_msg_id, "Running command failed: 'stream_output' must be a boolean")
     timeout_s = params["timeout_s"] if "timeout_s" in params else 30
+    stream_output = params.get("stream_output", False)
     command = params["command"]
 
     info(f"[RPC] Running command: ['{command}']")
-    # Helpers to stream subprocess output without blocking the gateway loop
-    def read_stream_to_queue(stream, out_q: queue.Queue[str]) -> None:
-        """Continuously read lines from `stream` and put them on a queue."""
-        with stream:  # closes the pipe on exit
-            for line in iter(stream.readline, ''):   # '' ⇒ EOF in text mode
-                out_q.put(line)
-    def read_lines_from_queue(line_queue: queue.Queue[str]) -> list[str]:
-        collected_lines = []
-        while True:
-             try:
-                 line = line_queue.get_nowait()
-             except queue.Empty:
-                 break
-             collected_lines.append(line)
-        return collected_lines
-
-    # Spawn subprocess and capture combined stdout/stderr as text
+    # Spawn subprocess and capture combined stdout/stderr
     start_timestamp = monotonic()
+    deadline = start_timestamp + timeout_s
     sub_process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,  # merge stderr → stdout
-        text=True,  # get str, not bytes
-        bufsize=1,  # line‑buffered
-        encoding='utf‑8', # decode stdout to string via utf-8
-        errors='replace' # replace invalid characters with placeholder char during utf-8 decoding
+        stdin=subprocess.DEVNULL,
     )
-
-    stdout_line_queue: queue.Queue[str] = queue.Queue()
-    pipe_reading_thread = threading.Thread(target=read_stream_to_queue, args=(sub_process.stdout, stdout_line_queue),
-                                           daemon=True)
-    pipe_reading_thread.start()
-
-    output_lines: list[str] = []
+    assert sub_process.stdout is not None
+    stdout_fd = sub_process.stdout.fileno()
+    os.set_blocking(stdout_fd, False)
+    # decode stdout to string via utf-8, replacing invalid characters with a placeholder char
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    output = OutputTail(RUN_COMMAND_MAX_OUTPUT_CHARS)
+    stream_chunk = OutputTail(RUN_COMMAND_STREAM_MAX_CHUNK_CHARS)
+    stream_sequence_number = 0
+    next_stream_timestamp = start_timestamp + RUN_COMMAND_STREAM_INTERVAL_S
+
+    def add_output(text: str) -> None:
+        output.append(text)
+        if stream_output:
+            stream_chunk.append(text)
+
+    def stream_pending_output() -> None:
+        nonlocal stream_chunk, stream_sequence_number
+        if stream_chunk.length > 0 or stream_chunk.truncated_chars > 0:
+            publish_command_output_chunk(rpc_msg_id, stream_sequence_number, stream_chunk)
+            stream_sequence_number += 1
+            stream_chunk = OutputTail(RUN_COMMAND_STREAM_MAX_CHUNK_CHARS)
+
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        selector.register(stdout_fd, selectors.EVENT_READ)
+        pipe_open = True
+        while pipe_open:
+            now = monotonic()
+            if now >= deadline:
+                timed_out = True
+                break
+            wait_s = deadline - now
+            if stream_output:
+                wait_s = min(wait_s, max(0.0, next_stream_timestamp - now))
+            if len(selector.select(wait_s)) > 0:
+                try:
+                    data = os.read(stdout_fd, RUN_COMMAND_READ_SIZE)
+                except BlockingIOError:
+                    data = None
+                if data == b"":
+                    pipe_open = False  # EOF
+                elif data is not None:
+                    add_output(decoder.decode(data))
+            if stream_output and monotonic() >= next_stream_timestamp:
+                stream_pending_output()
+                next_stream_timestamp = monotonic() + RUN_COMMAND_STREAM_INTERVAL_S
+    sub_process.stdout.close()
+    add_output(decoder.decode(b"", final=True))
+
+    # the output may be closed before the command ends
     try:
-        while sub_process.poll() is None:
-            # Drain any lines that are already waiting
-            output_lines.extend(read_lines_from_queue(stdout_line_queue))
-
-            if monotonic() - start_timestamp >= timeout_s:
-                sub_process.kill()
-                sub_process.wait()  # ensure process has ended
-                result = f"Error running command '{command}': Timeout after {timeout_s} seconds. Output: {'\n'.join(output_lines)}"
-                return send_rpc_method_error(rpc_msg_id, result)
-
-            sleep(0.05)  # small sleep: reduce CPU without blocking
-        sub_process.wait()
-    finally:
-        # If we exit early (timeout or exception) make sure the reader thread ends
-        pipe_reading_thread.join(timeout=1)
-
-    # read any remaining lines from the queue
-    while not stdout_line_queue.empty():
-        output_lines.extend(read_lines_from_queue(stdout_line_queue))
-
-    result = f"Command '{command}' exited with code {sub_process.returncode}. Output: {''.join(output_lines)}"
+        sub_process.wait(timeout=max(0.0, deadline - monotonic()))
+    except subprocess.TimeoutExpired:
+        timed_out = True
+    if timed_out:
+        sub_process.kill()
+        sub_process.wait()  # ensure process has ended
+    if stream_output:
+        stream_pending_output()
+
+    if timed_out:
+        result = f"Error running command '{command}': Timeout after {timeout_s} seconds. Output: {output.get_text()}"
+        return send_rpc_method_error(rpc_msg_id, result)
+    result = f"Command '{command}' exited with code {sub_process.returncode}. Output: {output.get_text()}"
     send_rpc_response(rpc_msg_id, f"OK - Command executed - {result}")
     return None
 
@@ -201,7 +303,7 @@ def verify_start_end_timestamp_params(params: Any) -> Optional[str]:
 
 
 def rpc_archive_republish_messages(rpc_msg_id: str, _method: Any, params: Any) -> None:
-    """Republish archived telemetry messages within a time range."""
+    """Republish archived telemetry messages within a time range in a background job."""
     params_verify_err = verify_start_end_timestamp_params(params)
     if params_verify_err is not None:
         return send_rpc_method_error(rpc_msg_id, f"Republishing archived messages failed: {params_verify_err}")
@@ -211,28 +313,54 @@ def rpc_archive_republish_messages(rpc_msg_id: str, _method: Any, params: Any) -
     if start_timestamp_ms <= 1735719469_000 or end_timestamp_ms >= 2524637869_000:
         return send_rpc_method_error(rpc_msg_id, "Republishing archived messages failed: 'start_timestamp_ms' and 'end_timestamp_ms' must be within the range of 1735719469_000 and 2524637869_000")
 
-    archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
-    if archive_sqlite_db.db_unavailable:
-        return send_rpc_method_error(rpc_msg_id, "Republishing archived messages failed: archive database unavailable")
-
     info(f"[RPC] Republishing messages - {start_timestamp_ms} -> {end_timestamp_ms}")
-    message_count = 0
-    while start_timestamp_ms < end_timestamp_ms:
-        messages = archive_sqlite_db.execute("""SELECT id, timestamp_ms, message 
-            FROM controller_archive 
-            WHERE timestamp_ms > ? AND timestamp_ms < ? 
-            ORDER BY timestamp_ms ASC LIMIT 200""",
-            (start_timestamp_ms, end_timestamp_ms)
-        )
-        for message in messages:
-            message_count += 1
-            debug(f"Republishing message with timestamp {message[1]}")
-            GatewayMqttClient().publish_telemetry(json.dumps({"ts": message[1], "values": json.loads(message[2])}))
-            start_timestamp_ms = message[1]
-        if len(messages) < 200:
-            break
-    archive_sqlite_db.close()
-    send_rpc_response(rpc_msg_id, f"OK - {message_count} messages republished - {start_timestamp_ms} -> {end_timestamp_ms}")
+    job = RepublishJobRunner().create_job(start_timestamp_ms, end_timestamp_ms)
+    if job is None:
+        return send_rpc_method_error(rpc_msg_id, "Republishing archived messages failed: could not create republish job")
+    send_rpc_response(rpc_msg_id, f"OK - Republish job {job.id} created - {job.total_count} messages - {start_timestamp_ms} -> {end_timestamp_ms}")
+    return None
+
+
+def rpc_archive_republish_jobs(rpc_msg_id: str, _method: Any, _params: Any) -> None:
+    """List the most recent archive republish jobs and their progress."""
+    send_rpc_response(rpc_msg_id, [job.to_dict() for job in RepublishJobRunner().get_jobs()])
+
+
+def rpc_archive_republish_job_set_status(rpc_msg_id: str, method: Any, params: Any) -> None:
+    """Pause, resume or cancel an archive republish job."""
+    status = {
+        "archive_republish_job_pause": JOB_STATUS_PAUSED,
+        "archive_republish_job_resume": JOB_STATUS_RUNNING,
+        "archive_republish_job_cancel": JOB_STATUS_CANCELLED,
+    }[method]
+    if type(params) is not dict or type(params.get("job_id")) is not int:
+        return send_rpc_method_error(rpc_msg_id, "Setting republish job status failed: 'job_id' must be an integer")
+    status_err = RepublishJobRunner().set_job_status(params["job_id"], status)
+    if status_err is not None:
+        return send_rpc_method_error(rpc_msg_id, f"Setting republish job status failed: {status_err}")
+    send_rpc_response(rpc_msg_id, f"OK - Republish job {params['job_id']} is {status}")
+    return None
+
+
+def rpc_archive_query(rpc_msg_id: str, _method: Any, params: Any) -> None:
+    """Return per-key statistics of archived telemetry in time buckets."""
+    params_verify_err = verify_start_end_timestamp_params(params)
+    if params_verify_err is not None:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archived messages failed: {params_verify_err}")
+    if type(params.get("bucket_s")) is not int or params["bucket_s"] <= 0:
+        return send_rpc_method_error(rpc_msg_id, "Querying archived messages failed: 'bucket_s' must be a positive integer")
+    keys = params.get("keys")
+    if keys is not None and (type(keys) is not list or not all(type(key) is str for key in keys)):
+        return send_rpc_method_error(rpc_msg_id, "Querying archived messages failed: 'keys' must be a list of strings")
+
+    start_timestamp_ms = params["start_timestamp_ms"]
+    end_timestamp_ms = params["end_timestamp_ms"]
+    info(f"[RPC] Querying archived messages - {start_timestamp_ms} -> {end_timestamp_ms} ({params['bucket_s']}s buckets)")
+    try:
+        result = query_archive(GatewayArchive(), start_timestamp_ms, end_timestamp_ms, params["bucket_s"] * 1000, keys)
+    except ArchiveQueryError as e:
+        return send_rpc_method_error(rpc_msg_id, f"Querying archived messages failed: {e}")
+    send_rpc_response(rpc_msg_id, result)
     return None
 
 
@@ -247,55 +375,195 @@ def rpc_archive_discard_messages(rpc_msg_id: str, _method: Any, params: Any) ->
     if end_timestamp_ms >= 2524637869_000:
         return send_rpc_method_error(rpc_msg_id, "Discarding archived messages failed: 'end_timestamp_ms' must be < 2524637869_000")
 
-    archive_sqlite_db = sqlite.SqliteConnection(utils.paths.GATEWAY_ARCHIVE_DB_PATH)
-    if archive_sqlite_db.db_unavailable:
-        return send_rpc_method_error(rpc_msg_id, "Discarding archived messages failed: archive database unavailable")
-
     info(f"[RPC] Discarding archived messages - {start_timestamp_ms} -> {end_timestamp_ms}")
-    message_count = archive_sqlite_db.execute("DELETE FROM controller_archive WHERE timestamp_ms > ? AND timestamp_ms < ?",
-                                              (start_timestamp_ms, end_timestamp_ms))
-    archive_sqlite_db.close()
+    message_count = GatewayArchive().discard(start_timestamp_ms, end_timestamp_ms)
     send_rpc_response(rpc_msg_id, f"OK - {message_count} messages discarded - {start_timestamp_ms} -> {end_timestamp_ms}")
     return None
 
 
+def rpc_jobs(rpc_msg_id: str, _method: Any, _params: Any) -> None:
+    """List the most recent RPC requests executed by worker threads."""
+    send_rpc_response(rpc_msg_id, [job.to_dict() for job in RpcExecutor().get_jobs()])
+
+
+def rpc_job_status(rpc_msg_id: str, _method: Any, params: Any) -> None:
+    """Return the status and the response of an RPC job."""
+    if type(params) is not dict or type(params.get("job_id")) is not int:
+        return send_rpc_method_error(rpc_msg_id, "Getting RPC job status failed: 'job_id' must be an integer")
+    job = RpcExecutor().get_job(params["job_id"])
+    if job is None:
+        return send_rpc_method_error(rpc_msg_id, f"Getting RPC job status failed: job {params['job_id']} not found")
+    send_rpc_response(rpc_msg_id, job.to_dict(with_result=True))
+    return None
+
+
+def rpc_log_level_set(rpc_msg_id: str, _method: Any, params: Any) -> None:
+    """Set the log level of a module, or the default log level, at runtime."""
+    if type(params) is not dict:
+        return send_rpc_method_error(rpc_msg_id, "Setting log level failed: params must be an object")
+    level = params.get("level")
+    module = params.get("module")
+    if level is not None and level not in LOG_LEVEL_RANKS:
+        return send_rpc_method_error(rpc_msg_id, f"Setting log level failed: 'level' must be one of "
+                                                 f"{', '.join(LOG_LEVEL_RANKS)} or null")
+    if module is not None and (type(module) is not str or len(module) == 0):
+        return send_rpc_method_error(rpc_msg_id, "Setting log level failed: 'module' must be a non-empty string")
+    set_log_level(level, module)
+    info(f"[RPC] Log level of {module or 'all modules'} set to {level or 'default'}")
+    send_rpc_response(rpc_msg_id, get_log_levels())
+    return None
+
+
+def rpc_log_levels(rpc_msg_id: str, _method: Any, _params: Any) -> None:
+    """Return the default log level and the levels set for modules at runtime."""
+    send_rpc_response(rpc_msg_id, get_log_levels())
+
+
+def rpc_log_dump(rpc_msg_id: str, _method: Any, params: Any) -> None:
+    """Return the most recent records of the log capture ring, filtered by the params."""
+    params = params if params is not None else {}
+    if type(params) is not dict:
+        return send_rpc_method_error(rpc_msg_id, "Dumping logs failed: params must be an object")
+    for key in ["module", "contains"]:
+        if params.get(key) is not None and type(params[key]) is not str:
+            return send_rpc_method_error(rpc_msg_id, f"Dumping logs failed: '{key}' must be a string")
+    for key in ["since_ms", "limit"]:
+        if params.get(key) is not None and (type(params[key]) is not int or params[key] < 0):
+            return send_rpc_method_error(rpc_msg_id, f"Dumping logs failed: '{key}' must be a non-negative integer")
+    if params.get("min_level") is not None and params["min_level"] not in LOG_LEVEL_RANKS:
+        return send_rpc_method_error(rpc_msg_id, f"Dumping logs failed: 'min_level' must be one of "
+                                                 f"{', '.join(LOG_LEVEL_RANKS)}")
+
+    limit = min(params.get("limit") or LOG_DUMP_DEFAULT_RECORDS, LOG_DUMP_MAX_RECORDS)
+    records = get_captured_records(params.get("module"), params.get("min_level"), params.get("contains"),
+                                   params.get("since_ms"), limit)
+    # keep the most recent records within the size limit of the response
+    message_chars = 0
+    first_index = len(records)
+    while first_index > 0 and message_chars + len(records[first_index - 1]["message"]) <= LOG_DUMP_MAX_MESSAGE_CHARS:
+        first_index -= 1
+        message_chars += len(records[first_index]["message"])
+    send_rpc_response(rpc_msg_id, {
+        "records": records[first_index:],
+        "omitted_records": first_index,
+    })
+    return None
+
+
 # Registry of supported RPC methods. Used by the ``list`` command and dispatcher.
+# Methods run on a worker thread (see modules.rpc_executor), with at most
+# ``max_concurrent`` requests at once, unless they are ``inline``. Long-running
+# methods (``job``) respond with a job id if they take longer than a few seconds.
 RPC_METHODS: dict[str, dict[str, Any]] = {
     "reboot": {
         "description": "Reboot the device",
-        "exec": rpc_reboot
+        "exec": rpc_reboot,
+        "max_concurrent": 1,
+        "timeout_s": 30
     },
     "shutdown": {
         "description": "Shutdown the device",
-        "exec": rpc_shutdown
+        "exec": rpc_shutdown,
+        "max_concurrent": 1,
+        "timeout_s": 30
     },
     "exit": {
         "description": "Exits the gateway process (triggers gateway restart)",
-        "exec": rpc_exit
+        "exec": rpc_exit,
+        "max_concurrent": 1,
+        "timeout_s": 30
     },
     "ping": {
         "description": "Ping the device (returns 'pong' reply)",
-        "exec": rpc_ping
+        "exec": rpc_ping,
+        "inline": True
     },
     "init_files": {
         "description": "Initialize file-related client attributes (FILE_HASHES, FILE_READ_*)",
-        "exec": rpc_init_files
+        "exec": rpc_init_files,
+        "max_concurrent": 1,
+        "timeout_s": 30
     },
     "restart_controller": {
         "description": "Restart the controller docker container",
-        "exec": rpc_restart_controller
+        "exec": rpc_restart_controller,
+        "max_concurrent": 1,
+        # 3 s response delay plus up to 60 s for the container to stop
+        "timeout_s": 90
     },
     "run_command": {
-        "description": "Run arbitrary command ({command: list [str], timeout_s: int [default 30s]}) - use with caution!",
-        "exec": rpc_run_command
+        "description": "Run arbitrary command ({command: list [str], timeout_s: int [default 30s], stream_output: bool [default false]}) - use with caution!",
+        "exec": rpc_run_command,
+        "max_concurrent": 2,
+        # the command is killed after its own timeout, leave time to collect its output
+        "timeout_s": RUN_COMMAND_MAX_TIMEOUT_S + 30,
+        "job": True
     },
     "archive_republish_messages": {
         "description": "Republish messages from archive ({start_timestamp_ms: int, end_timestamp_ms: int})",
-        "exec": rpc_archive_republish_messages
+        "exec": rpc_archive_republish_messages,
+        "max_concurrent": 1,
+        "timeout_s": 300,
+        "job": True
+    },
+    "archive_republish_jobs": {
+        "description": "List archive republish jobs and their progress",
+        "exec": rpc_archive_republish_jobs,
+        "inline": True
+    },
+    "archive_republish_job_pause": {
+        "description": "Pause an archive republish job ({job_id: int})",
+        "exec": rpc_archive_republish_job_set_status,
+        "inline": True
+    },
+    "archive_republish_job_resume": {
+        "description": "Resume a paused archive republish job ({job_id: int})",
+        "exec": rpc_archive_republish_job_set_status,
+        "inline": True
+    },
+    "archive_republish_job_cancel": {
+        "description": "Cancel an archive republish job ({job_id: int})",
+        "exec": rpc_archive_republish_job_set_status,
+        "inline": True
+    },
+    "archive_query": {
+        "description": "Aggregate archived values in time buckets ({start_timestamp_ms: int, end_timestamp_ms: int, bucket_s: int, keys: list [str] [optional]})",
+        "exec": rpc_archive_query,
+        "max_concurrent": 1,
+        "timeout_s": 600,
+        "job": True
     },
     "archive_discard_messages": {
         "description": "Discard messages from archive ({start_timestamp_ms: int, end_timestamp_ms: int})",
-        "exec": rpc_archive_discard_messages
+        "exec": rpc_archive_discard_messages,
+        "max_concurrent": 1,
+        "timeout_s": 600,
+        "job": True
+    },
+    "rpc_jobs": {
+        "description": "List recent RPC jobs (requests run on worker threads) and their status",
+        "exec": rpc_jobs,
+        "inline": True
+    },
+    "rpc_job_status": {
+        "description": "Get the status and the response of an RPC job ({job_id: int})",
+        "exec": rpc_job_status,
+        "inline": True
+    },
+    "log_level_set": {
+        "description": "Set the log level at runtime ({level: str [DEBUG, INFO, WARN, ERROR or null to reset], module: str [optional, default: all modules]})",
+        "exec": rpc_log_level_set,
+        "inline": True
+    },
+    "log_levels": {
+        "description": "Get the default log level and the log levels set for modules",
+        "exec": rpc_log_levels,
+        "inline": True
+    },
+    "log_dump": {
+        "description": "Get recent log records including unpublished DEBUG records ({module: str, min_level: str, contains: str, since_ms: int, limit: int [default 200]} [all optional])",
+        "exec": rpc_log_dump,
+        "inline": True
     },
 }
 
@@ -310,12 +578,7 @@ def on_rpc_request(rpc_msg_id: str, method: str, params: Any) -> None:
     """
     info(f"RPC request: {rpc_msg_id} {method} ({params})")
     if method in RPC_METHODS:
-        try:
-            RPC_METHODS[method]["exec"](rpc_msg_id, method, params) # type: ignore[operator]
-        except Exception as e:
-            error(f"Error executing RPC method '{method}': {e}")
-            GatewayMqttClient().publish_log("ERROR", f"Error executing RPC method '{method}': {e}")
-            send_rpc_response(rpc_msg_id, f"Error executing RPC method '{method}': {e}")
+        RpcExecutor().execute(rpc_msg_id, method, params, RPC_METHODS[method])
     elif method == "list":
         help_text = ["Available RPC methods:"]
         for method_name, method_data in RPC_METHODS.items():
@@ -323,16 +586,12 @@ def on_rpc_request(rpc_msg_id: str, method: str, params: Any) -> None:
         send_rpc_response(rpc_msg_id, help_text)
     else:
         error(f"Unknown RPC method: {method}")
-        GatewayMqttClient().publish_log("ERROR", f"Unknown RPC method: {method}")
         send_rpc_response(rpc_msg_id, f"Unknown RPC method: '{method}' - use command 'list' to get a list of available methods")
 
 
 def send_rpc_response(rpc_msg_id: str, response: Any) -> bool:
-    """Send an RPC response"""
-    return GatewayMqttClient().publish_message_raw(
-        "v1/devices/me/rpc/response/" + rpc_msg_id,
-        json.dumps({"message": response})
-    )
+    """Send an RPC response, or keep it with its job if the requester got the job id."""
+    return RpcExecutor().send_response(rpc_msg_id, response)
 
 def send_rpc_method_error(rpc_msg_id: str, msg: str) -> None:
     """Send a standardized error response for an RPC method."""
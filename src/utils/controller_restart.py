@@ -8,9 +8,18 @@ To avoid rapid restart loops, restarts are rate-limited and use an exponential
 backoff strategy. If no previous version is known, the watchdog requests OTA
 version information from ThingsBoard and reports a FAILED software state.
 
+The watchdog checks the controller every ``DEFAULT_CONTAINER_RESTART_DELAY_MS``
+(times the backoff). When the Docker events report that the controller exited,
+it checks the controller ``CONTROLLER_EXIT_CHECK_DELAY_MS`` later instead, which
+leaves Docker the time to restart the container by its restart policy. While
+the backoff is raised after repeated restarts, the check after an exit is
+delayed by the amount the backoff exceeds the default delay.
+
 Notes
 -----
 - Controller lifecycle operations are executed via :class:`modules.docker_client.GatewayDockerClient`.
+  The watchdog holds its lifecycle lock while checking and restarting the
+  controller, so it never starts the controller while another thread stops it.
 - OTA software state reporting is published via :class:`modules.mqtt.GatewayMqttClient`.
 """
 
@@ -22,6 +31,8 @@ from modules.logging import info, error
 from modules.mqtt import GatewayMqttClient
 
 DEFAULT_CONTAINER_RESTART_DELAY_MS: int = 600_000
+# Time between an exit of the controller and the check of the watchdog
+CONTROLLER_EXIT_CHECK_DELAY_MS: int = 15_000
 CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR: float = 1.6
 container_restart_delay_ms: float = DEFAULT_CONTAINER_RESTART_DELAY_MS
 last_container_restart_ts: int = 0
@@ -40,31 +51,57 @@ def restart_controller_if_needed() -> bool:
     """
     global container_restart_delay_ms, last_container_restart_ts
 
-    if int(time_ns() / 1_000_000) - last_container_restart_ts > container_restart_delay_ms:
-        last_container_restart_ts = int(time_ns() / 1_000_000)
+    now_ms = int(time_ns() / 1_000_000)
+    periodic_check = now_ms - last_container_restart_ts > container_restart_delay_ms
+    if periodic_check or now_ms >= get_next_restart_check_ts():
+        last_container_restart_ts = now_ms
         docker_client = GatewayDockerClient()
-        if not docker_client.is_controller_running():
-            container_restart_delay_ms *= CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR
-            info("Controller is not running, starting new container in 10s...")
-            info("New controller restart exponential backoff: " + str(int(container_restart_delay_ms/1000.0)) + "s")
-            sleep(10)
-            last_launched_version = docker_client.get_last_launched_controller_version()
-            if last_launched_version is not None:
-                docker_client.start_controller_safely(last_launched_version)
-                return True
-            else:
-                error("Failed to determine last launched controller version, unable to start new container...")
-                GatewayMqttClient().request_attributes({"sharedKeys": "sw_title,sw_url,sw_version"})
-                GatewayMqttClient().publish_sw_state("UNKNOWN", "FAILED",
-                                                     "No previous version known to launch from, requested version info from ThingsBoard")
-                error("Requested controller version from Thingsboard. Delaying main loop by 20s...")
-                sleep(20)  # it is unlikely that the version to build will be available immediately
-                return True
-        elif container_restart_delay_ms > DEFAULT_CONTAINER_RESTART_DELAY_MS:
-            info("New controller restart exponential backoff: " + str(int(container_restart_delay_ms / 1000.0)) + "s")
-            container_restart_delay_ms = max(
-                DEFAULT_CONTAINER_RESTART_DELAY_MS,
-                int(container_restart_delay_ms / CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR)
-            )
-
-    return False
\ No newline at end of file
+        # wait for a start or stop of another thread, and keep it from interfering with this one
+        with docker_client.lifecycle_lock:
+            if not docker_client.is_controller_running():
+                container_restart_delay_ms *= CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR
+                info("Controller is not running, starting new container in 10s...")
+                info("New controller restart exponential backoff: " + str(int(container_restart_delay_ms/1000.0)) + "s")
+                sleep(10)
+                last_launched_version = docker_client.get_last_launched_controller_version()
+                if last_launched_version is not None:
+                    docker_client.start_controller_safely(last_launched_version)
+                    return True
+                else:
+                    error("Failed to determine last launched controller version, unable to start new container...")
+                    GatewayMqttClient().request_attributes({"sharedKeys": "sw_title,sw_url,sw_version"})
+                    GatewayMqttClient().publish_sw_state("UNKNOWN", "FAILED",
+                                                         "No previous version known to launch from, requested version info from ThingsBoard")
+                    error("Requested controller version from Thingsboard. Delaying main loop by 20s...")
+                    sleep(20)  # it is unlikely that the version to build will be available immediately
+                    return True
+            elif periodic_check and container_restart_delay_ms > DEFAULT_CONTAINER_RESTART_DELAY_MS:
+                info("New controller restart exponential backoff: " + str(int(container_restart_delay_ms / 1000.0)) + "s")
+                container_restart_delay_ms = max(
+                    DEFAULT_CONTAINER_RESTART_DELAY_MS,
+                    int(container_restart_delay_ms / CONTAINER_RESTART_EXPONENTIAL_BACKOFF_FACTOR)
+                )
+
+    return False
+
+def get_next_restart_check_ts() -> float:
+    """Return the Unix timestamp in milliseconds of the next check of the watchdog.
+
+    The check is due earlier if the controller exited since the last check.
+    """
+    next_check_ts = last_container_restart_ts + container_restart_delay_ms
+    exited_at_ms = GatewayDockerClient().get_controller_exited_at_ms()
+    if exited_at_ms is not None and exited_at_ms > last_container_restart_ts:
+        next_check_ts = min(next_check_ts, max(
+            exited_at_ms + CONTROLLER_EXIT_CHECK_DELAY_MS,
+            last_container_restart_ts + container_restart_delay_ms - DEFAULT_CONTAINER_RESTART_DELAY_MS
+        ))
+    return next_check_ts
+
+def ms_until_next_restart_check() -> float:
+    """Return the time until the watchdog checks the controller container again.
+
+    Returns:
+      Milliseconds until :func:`restart_controller_if_needed` performs its next check.
+    """
+    return max(0.0, get_next_restart_check_ts() - int(time_ns() / 1_000_000))
@@ -51,6 +51,14 @@ GATEWAY_LOGS_BUFFER_DB_PATH: str = join(str(GATEWAY_DATA_PATH), GATEWAY_LOGS_BUF
 GATEWAY_ARCHIVE_DB_NAME: str = "gateway_archive.db"
 GATEWAY_ARCHIVE_DB_PATH: str = join(str(GATEWAY_DATA_PATH), GATEWAY_ARCHIVE_DB_NAME)
 
+# Directory of the time-partitioned archive shards
+GATEWAY_ARCHIVE_SHARDS_NAME: str = "gateway_archive"
+GATEWAY_ARCHIVE_SHARDS_PATH: str = join(str(GATEWAY_DATA_PATH), GATEWAY_ARCHIVE_SHARDS_NAME)
+
+# Background job state (e.g. archive republish jobs)
+GATEWAY_JOBS_DB_NAME: str = "gateway_jobs.db"
+GATEWAY_JOBS_DB_PATH: str = join(str(GATEWAY_DATA_PATH), GATEWAY_JOBS_DB_NAME)
+
 # Controller communication queue database
 COMMUNICATION_QUEUE_DB_NAME: str = "communication_queue.db"
 COMMUNICATION_QUEUE_DB_PATH: str = join(str(CONTROLLER_DATA_PATH), COMMUNICATION_QUEUE_DB_NAME)
@@ -65,4 +73,6 @@ debug(f'CONTROLLER_GIT_PATH: {CONTROLLER_GIT_PATH}')
 
 debug(f'GATEWAY_LOGS_BUFFER_DB_PATH: {GATEWAY_LOGS_BUFFER_DB_PATH}')
 debug(f'GATEWAY_ARCHIVE_DB_PATH: {GATEWAY_ARCHIVE_DB_PATH}')
+debug(f'GATEWAY_ARCHIVE_SHARDS_PATH: {GATEWAY_ARCHIVE_SHARDS_PATH}')
+debug(f'GATEWAY_JOBS_DB_PATH: {GATEWAY_JOBS_DB_PATH}')
 debug(f'COMMUNICATION_QUEUE_DB_PATH: {COMMUNICATION_QUEUE_DB_PATH}')
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""Main loop wakeup signalling for the Edge Gateway.
+
+Instead of polling its queues on a fixed interval, the gateway main loop sleeps
+until something happens. This module provides the shared wakeup signal and the
+sources that trigger it:
+
+- Inbound MQTT messages and publish acknowledgements (signalled by
+  :class:`modules.mqtt.GatewayMqttClient`).
+- Changes to the communication queue database made by the controller, detected
+  by a background watcher thread.
+- Timer deadlines, which the main loop passes as the wait timeout.
+
+Database change detection
+-------------------------
+On Linux, the watcher uses ``inotify`` on the database directory and reacts to
+writes to the database file and its write-ahead log (``-wal``), so an idle
+gateway does not wake up at all. If ``inotify`` is unavailable, the watcher falls
+back to polling ``PRAGMA data_version`` on a dedicated connection, which changes
+whenever another connection commits to the database.
+
+In the asyncio runtime (see :mod:`async_runtime`), the tasks of the event loop
+register :class:`asyncio.Event` objects with :func:`register_async_wakeup`, which
+are set by the same sources.
+
+Notes
+-----
+- Spurious wakeups are harmless: the main loop simply re-checks its queues.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import sqlite3
+import struct
+import threading
+from time import sleep
+
+from modules.logging import warn, debug
+
+# Interval for polling PRAGMA data_version if inotify is unavailable
+DB_CHANGE_POLL_INTERVAL_MS: int = 100
+
+# inotify event masks, see inotify(7)
+IN_MODIFY: int = 0x00000002
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+wakeup_event = threading.Event()
+# events of asyncio tasks waiting for wakeups, with their event loop
+async_wakeup_events: list[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+
+def notify_main_loop() -> None:
+    """Wake up the main loop if it is waiting."""
+    wakeup_event.set()
+    for loop, event in async_wakeup_events:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # the event loop was closed
+
+
+def register_async_wakeup() -> asyncio.Event:
+    """Return an event that is set whenever the main loop is notified.
+
+    Must be called from a running event loop.
+    """
+    event = asyncio.Event()
+    async_wakeup_events.append((asyncio.get_running_loop(), event))
+    return event
+
+
+async def wait_for_async_wakeup(event: asyncio.Event, timeout_s: float) -> bool:
+    """Wait until the given event of :func:`register_async_wakeup` is set or the timeout expires.
+
+    Returns:
+      ``True`` if the main loop was notified, ``False`` on timeout.
+    """
+    try:
+        await asyncio.wait_for(event.wait(), max(0.0, timeout_s))
+        notified = True
+    except TimeoutError:
+        notified = False
+    event.clear()
+    return notified
+
+
+def wait_for_wakeup(timeout_s: float) -> bool:
+    """Block until the main loop is notified or the timeout expires.
+
+    Args:
+      timeout_s: Maximum time to wait in seconds.
+
+    Returns:
+      ``True`` if the main loop was notified, ``False`` on timeout.
+    """
+    notified = wakeup_event.wait(max(0.0, timeout_s))
+    wakeup_event.clear()
+    return notified
+
+
+def start_db_change_watcher(db_path: str) -> threading.Thread:
+    """Start a daemon thread that wakes up the main loop when a database changes.
+
+    Args:
+      db_path: Path to the SQLite database file to watch.
+
+    Returns:
+      The started watcher thread.
+    """
+    watcher_thread = threading.Thread(target=watch_db_changes, args=(db_path,), daemon=True)
+    watcher_thread.start()
+    return watcher_thread
+
+
+def watch_db_changes(db_path: str) -> None:
+    """Watch a database for changes, using inotify if possible."""
+    try:
+        watch_db_changes_inotify(db_path)
+    except Exception as e:
+        warn(f"[WAKEUP] inotify unavailable ({e}), polling '{db_path}' for changes instead")
+    watch_db_changes_polling(db_path)
+
+
+def watch_db_changes_inotify(db_path: str) -> None:
+    """Notify the main loop on writes to the database file or its write-ahead log."""
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        raise OSError("libc not found")
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+    if inotify_fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    db_directory = os.path.dirname(os.path.abspath(db_path))
+    watch_descriptor = libc.inotify_add_watch(inotify_fd, db_directory.encode(), IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+    if watch_descriptor < 0:
+        os.close(inotify_fd)
+        raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for '{db_directory}'")
+
+    watched_names = {os.path.basename(db_path), os.path.basename(db_path) + "-wal"}
+    debug(f"[WAKEUP] Watching {watched_names} in '{db_directory}' via inotify")
+    while True:
+        events = os.read(inotify_fd, 4096)
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(events):
+            _wd, _mask, _cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(events, offset)
+            name_start = offset + INOTIFY_EVENT_HEADER.size
+            name = events[name_start:name_start + name_length].rstrip(b"\0").decode(errors="replace")
+            offset = name_start + name_length
+            if name in watched_names:
+                notify_main_loop()
+                break
+
+
+def watch_db_changes_polling(db_path: str) -> None:
+    """Notify the main loop whenever another connection commits to the database."""
+    last_data_version = None
+    connection = None
+    while True:
+        try:
+            if connection is None:
+                connection = sqlite3.connect(db_path, check_same_thread=False)
+            data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+            if last_data_version is not None and data_version != last_data_version:
+                notify_main_loop()
+            last_data_version = data_version
+        except Exception as e:
+            warn(f"[WAKEUP] Failed to poll '{db_path}' for changes: {e}")
+            connection = None
+            sleep(5)
+        sleep(DB_CHANGE_POLL_INTERVAL_MS / 1000)
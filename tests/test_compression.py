@@ -0,0 +1,74 @@
+"""Tests for :mod:`modules.compression`.
+
+Run from the repository root with ``python -m unittest discover -s tests``.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+os.environ.setdefault("TEG_DATA_PATH", tempfile.mkdtemp())
+
+from db_schemas.controller_messages_table import CONTROLLER_MESSAGES_COLUMNS, CREATE_CONTROLLER_MESSAGES_TABLE_QUERY
+from db_schemas.payload_dictionaries_table import CREATE_PAYLOAD_DICTIONARIES_TABLE_QUERY
+from db_schemas.pending_messages_table import CREATE_PENDING_MESSAGES_TABLE_QUERY, PENDING_MESSAGES_COLUMNS
+from modules import compression, sqlite
+from modules.message_transfer import ControllerMessageTransfer
+
+
+class NullArchive:
+    """Archive accepting all rows."""
+
+    def insert_many(self, rows) -> bool:
+        return True
+
+
+class PayloadCodecRetrainTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = sqlite.SqliteConnection(os.path.join(self.directory.name, "communication.db"))
+        for query in (CREATE_CONTROLLER_MESSAGES_TABLE_QUERY, CREATE_PENDING_MESSAGES_TABLE_QUERY,
+                      CREATE_PAYLOAD_DICTIONARIES_TABLE_QUERY):
+            self.db.execute(query)
+        self.controller_queue = sqlite.DurableQueue(
+            self.db, sqlite.SqliteTables.CONTROLLER_MESSAGES.value, CONTROLLER_MESSAGES_COLUMNS)
+        self.pending_queue = sqlite.DurableQueue(
+            self.db, sqlite.SqliteTables.PENDING_MQTT_MESSAGES.value, PENDING_MESSAGES_COLUMNS)
+        self.retrain_interval = compression.DICTIONARY_RETRAIN_INTERVAL_ROWS
+        compression.DICTIONARY_RETRAIN_INTERVAL_ROWS = 100
+
+    def tearDown(self) -> None:
+        compression.DICTIONARY_RETRAIN_INTERVAL_ROWS = self.retrain_interval
+        self.db.conn.close()
+        self.directory.cleanup()
+
+    def test_retrain_due_within_batch_keeps_rows_decodable(self) -> None:
+        messages = [json.dumps({"ts": 1_700_000_000_000 + i, "values": {"temperature": i, "state": f"s{i % 7}"}})
+                    for i in range(250)]
+        self.db.execute_batch([(self.controller_queue.push_query, [("telemetry", message) for message in messages])])
+
+        codec = compression.PayloadCodec(self.db, compress=True)
+        transfer = ControllerMessageTransfer(self.controller_queue, self.pending_queue, NullArchive(), codec)  # type: ignore[arg-type]
+        transferred = transfer.transfer_batch()
+        self.assertEqual(transferred, 250)
+        self.assertIsNotNone(codec.dictionary_id)
+
+        # more batches retrain again and prune the dictionaries without queued rows
+        self.db.execute_batch([(self.controller_queue.push_query, [("telemetry", message) for message in messages])])
+        while transfer.transfer_batch() > 0:
+            pass
+
+        rows = self.db.execute(f"SELECT message, payload_format, dictionary_id FROM {self.pending_queue.table} ORDER BY id")
+        self.assertEqual(len(rows), 500)
+        # decode with a fresh codec, as after a restart of the gateway
+        decoder = compression.PayloadCodec(self.db, compress=True)
+        decoded = [decoder.decode(*row) for row in rows]
+        self.assertEqual(decoded, messages + messages)
+
+
+if __name__ == "__main__":
+    unittest.main()